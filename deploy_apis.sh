@@ -12,3 +12,8 @@ cd functions/api-round-attempts/python > /dev/null
 sh ./deploy.sh > deploy.log 2>&1 &
 cd ../../.. > /dev/null
 
+# api-user-history function
+echo "deploying user-history api"
+cd functions/api-user-history/python > /dev/null
+sh ./deploy.sh > deploy.log 2>&1 &
+cd ../../.. > /dev/null
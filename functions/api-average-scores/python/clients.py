@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Process-wide Google Cloud clients.
+
+Each client is created on first use and reused by every later invocation
+on the same instance, so a warm request skips credential discovery and
+channel setup. The client libraries are only imported at that point, which
+keeps them off the cold start path.
+
+Every function deploys its own directory, so this module is kept identical
+in each of them.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def firestore_client():
+    """
+    Returns the shared Firestore client.
+    """
+    return _get_client('firestore', _new_firestore_client)
+
+
+def storage_client():
+    """
+    Returns the shared Cloud Storage client.
+    """
+    return _get_client('storage', _new_storage_client)
+
+
+def reset():
+    """
+    Drops the cached clients, so the next call creates new ones.
+    """
+    with _lock:
+        _clients.clear()
+
+
+def _get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _new_firestore_client():
+    from google.cloud import firestore
+    return firestore.Client()
+
+
+def _new_storage_client():
+    from google.cloud import storage
+    return storage.Client()
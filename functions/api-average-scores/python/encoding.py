@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shape and content encoding of the API responses.
+
+With `format=columnar` the `data` list of objects is sent as one list of
+values per field, so each field name appears once:
+
+    {"data": {"roundid": [455, 454], "best_attempt": [2, 1], ...}, ...}
+
+Bodies are compressed with brotli or gzip when the client accepts it and
+the body is large enough to gain from it. Brotli is only offered when its
+package is installed.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the API functions.
+"""
+
+import gzip
+
+from pagination import BadRequest
+
+ROWS = 'rows'
+COLUMNAR = 'columnar'
+
+# bodies smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 256
+
+# bodies are compressed once per cached response, so spend the CPU
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+# preferred first, when the client weighs them equally
+ENCODINGS = ['br', 'gzip'] if _brotli() else ['gzip']
+
+
+def response_format(request):
+    """
+    Returns the response shape asked for with `format`.
+
+    Exception:
+        BadRequest: when the format is unknown
+    """
+    value = request.args.get('format') or ROWS
+    if value not in (ROWS, COLUMNAR):
+        raise BadRequest(f'format must be {ROWS} or {COLUMNAR}')
+    return value
+
+
+def to_columns(response):
+    """
+    Returns a copy of `response` with its `data` rows turned into columns.
+    """
+    fields = {}
+    for row in response['data']:
+        fields.update(dict.fromkeys(row))
+    columns = {field: [row.get(field) for row in response['data']]
+               for field in fields}
+    return dict(response, data=columns)
+
+
+def negotiate_encoding(request, size):
+    """
+    Returns the content coding to send a body of `size` bytes with, or None
+    to send it as is.
+    """
+    if size < MIN_COMPRESS_BYTES:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def compress(body, encoding):
+    """
+    Returns `body` compressed with `encoding`, one of ENCODINGS.
+    """
+    if encoding == 'br':
+        return _brotli().compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        # no timestamp, so a body always compresses to the same bytes
+        return gzip.compress(body, GZIP_LEVEL, mtime=0)
+    raise ValueError(f'Unknown content coding {encoding}')
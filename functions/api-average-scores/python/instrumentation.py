@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timings and counters of a function invocation, logged as one JSON line
+when it ends:
+
+    {"invocation": "store-scores", "duration_ms": 812.4, "error": null,
+     "spans": {"firestore.commit": {"count": 9, "ms": 301.7}, ...},
+     "counters": {"docs_written": 4014, ...}, "file": "tweets-1.json"}
+
+Spans add up the time spent in a named step, such as a Firestore call
+type, over the invocation. Steps that run in parallel threads are each
+added, so spans may add up to more than the duration. Spans and counters
+are meant for steps and batches; per-item work is counted, not timed.
+
+Per-item log lines are printed for a LOG_SAMPLE_RATE fraction of the
+items, none by default. INSTRUMENTATION=off turns off the spans, counters
+and the summary line.
+
+Threads started during an invocation record into it when they run in a
+copy of the starting thread's context, `contextvars.copy_context().run`.
+
+Every function deploys its own directory, so this module is kept identical
+in each of them.
+"""
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+
+ENABLED = os.environ.get('INSTRUMENTATION', 'on') != 'off'
+
+# fraction of the per-item log lines that are printed
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0'))
+
+_current = contextvars.ContextVar('invocation', default=None)
+
+
+class Invocation:
+    """
+    Spans and counters of one invocation.
+
+    Parameters:
+        name (str): Name of the function
+        clock (callable): Returns the current time in seconds
+    """
+
+    def __init__(self, name, clock=time.perf_counter):
+        self.name = name
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self.fields = {}
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [1, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, error=None):
+        """
+        Returns the summary logged when the invocation ends.
+        """
+        with self._lock:
+            summary = {
+                'invocation': self.name,
+                'duration_ms': round((self._clock() - self._start) * 1000,
+                                     1),
+                'error': error,
+                'spans': {name: {'count': count, 'ms': round(seconds * 1000,
+                                                             1)}
+                          for name, (count, seconds) in self.spans.items()},
+                'counters': dict(self.counters)
+            }
+            summary.update(self.fields)
+            return summary
+
+
+class _Span:
+    __slots__ = ('_invocation', '_name', '_start')
+
+    def __init__(self, invocation, name):
+        self._invocation = invocation
+        self._name = name
+
+    def __enter__(self):
+        self._start = self._invocation._clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._invocation.add_time(
+            self._name, self._invocation._clock() - self._start)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class invocation:
+    """
+    Records the spans and counters of the code run inside it, and prints
+    their summary as one JSON line at the end, also when it raises.
+
+    A class rather than a generator based context manager, since it wraps
+    every request of the read APIs.
+
+    Parameters:
+        name (str): Name of the function
+        fields: Values added to the summary, such as the file name
+    """
+    __slots__ = ('_current', '_token')
+
+    def __init__(self, name, **fields):
+        self._current = None
+        if ENABLED:
+            self._current = Invocation(name)
+            self._current.fields.update(fields)
+
+    def __enter__(self):
+        if self._current is not None:
+            self._token = _current.set(self._current)
+        return self._current
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._current is None:
+            return False
+        _current.reset(self._token)
+        error = f'{exc_type.__name__}: {exc}' if exc_type else None
+        print(json.dumps(self._current.summary(error), default=str))
+        return False
+
+
+def span(name):
+    """
+    Returns a context manager that adds the time spent in it to the span
+    `name` of the current invocation.
+    """
+    current = _current.get()
+    if current is None:
+        return _NO_SPAN
+    return _Span(current, name)
+
+
+def add_time(name, seconds):
+    """
+    Adds `seconds` to the span `name` of the current invocation, for steps
+    that are timed piecewise.
+    """
+    current = _current.get()
+    if current is not None:
+        current.add_time(name, seconds)
+
+
+def count(name, value=1):
+    """
+    Adds `value` to the counter `name` of the current invocation.
+    """
+    current = _current.get()
+    if current is not None:
+        current.count(name, value)
+
+
+def annotate(**fields):
+    """
+    Adds fields to the summary of the current invocation.
+    """
+    current = _current.get()
+    if current is not None:
+        current.fields.update(fields)
+
+
+def sampled():
+    """
+    Returns whether to print the log line of an item, for a LOG_SAMPLE_RATE
+    fraction of the items. Check it before formatting the line.
+    """
+    return LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE
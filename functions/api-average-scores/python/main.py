@@ -14,15 +14,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import traceback
+import json
+import os
 import functions_framework
-from google.cloud import firestore
-from flask import jsonify
+
+from clients import firestore_client
+from deadline import call_timeout, request_budget
+from encoding import COLUMNAR, ROWS, response_format, to_columns
+from instrumentation import annotate, count, invocation, sampled, span
+from pagination import BadRequest, bad_request, decode_cursor, \
+    encode_cursor, page_limit
+from profile_cache import ProfileCache, fetch_profiles
+from response_cache import FRESHNESS_HEADER, ResponseCache, \
+    cached_json_response
 
 METADATA_COLLECTION = u'metadata'
 SCORE_COLLECTION = u'scores'
 USER_COLLECTION = u'users'
+PROFILE_COLLECTION = u'profiles'
 ROUND_DOCID = u'rounds'
+LEADERBOARD_COLLECTION = u'leaderboards'
+AVERAGE_LEADERBOARD_DOCID = u'average'
+RANK_INDEX_COLLECTION = u'rank_index'
+
+# users per page unless the request sets a limit
+PAGE_SIZE = 10
+
+# users store-scores keeps in the leaderboard snapshot
+LEADERBOARD_SIZE = 10
+
+PROFILE_FIELDS = [u'username', u'name', u'profile_image_url']
+
+# rank index layout written by store-scores: users counted per tenth of
+# average score and RANK_TOTAL_BUCKET total score points, in one doc per
+# whole average point
+RANK_TOTAL_BUCKET = 10
+RANK_INDEX_DOCS = 7
+
+# most users of a bucket read for an exact rank; past them the rank is
+# the approximate one
+MAX_RANK_BUCKET_USERS = int(os.environ.get('MAX_RANK_BUCKET_USERS', '500'))
+
+# seconds a response is served before checking the data version again
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '60'))
+
+# most responses kept by the instance
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+
+# seconds a request may spend on Firestore calls to build a response, and
+# on each call; past them the last good response is served, marked stale,
+# and rebuilt again after STALE_RETRY_SECONDS
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', '4'))
+CALL_TIMEOUT_SECONDS = float(os.environ.get('CALL_TIMEOUT_SECONDS', '2'))
+STALE_RETRY_SECONDS = int(os.environ.get('STALE_RETRY_SECONDS', '5'))
+RESPONSE_CACHE = ResponseCache(CACHE_TTL_SECONDS, retry=STALE_RETRY_SECONDS,
+                               max_size=RESPONSE_CACHE_SIZE)
+
+# user profiles kept by the instance, each for up to PROFILE_TTL_SECONDS
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_TTL_SECONDS = int(os.environ.get('PROFILE_TTL_SECONDS', '600'))
+PROFILE_CACHE = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_TTL_SECONDS)
 
 @functions_framework.http
 def http_receiver(request):
@@ -44,7 +95,7 @@ def http_receiver(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'GET',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
             'Access-Control-Max-Age': '3600'
         }
 
@@ -52,83 +103,373 @@ def http_receiver(request):
 
     # Set CORS headers for the main request
     headers = {
-        'Access-Control-Allow-Origin': '*'
-    }    
-    return (jsonify(fetch_top_average_scores()), 200, headers)    
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': f'ETag, {FRESHNESS_HEADER}'
+    }
+    with invocation('api-average-scores'):
+        if request.path.rstrip('/').endswith('/rank'):
+            return rank_response(request, headers)
+        try:
+            limit = page_limit(request, PAGE_SIZE)
+            cursor = parse_cursor(decode_cursor(request))
+            shape = response_format(request)
+        except BadRequest as e:
+            annotate(status=400)
+            return bad_request(e, headers)
+
+        key = ('average-scores', limit, shape,
+               tuple(cursor.values()) if cursor else None)
+        with request_budget(REQUEST_BUDGET_SECONDS, CALL_TIMEOUT_SECONDS):
+            response = cached_json_response(
+                RESPONSE_CACHE, request, key, fetch_data_version,
+                lambda: build_response(limit, cursor, shape), headers)
+        annotate(status=response[1])
+        return response
+
+
+def rank_response(request, headers):
+    """
+    Serves `/rank`: the rank and percentile of the user `userid` on the
+    leaderboard.
+    """
+    annotate(endpoint='rank')
+    userid = request.args.get('userid')
+    if not userid or '/' in userid:
+        annotate(status=400)
+        return bad_request(BadRequest('userid is required'), headers)
+
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+    try:
+        with request_budget(REQUEST_BUDGET_SECONDS, CALL_TIMEOUT_SECONDS):
+            response = fetch_user_rank(userid)
+    except Exception as e:
+        print(f"Could not rank user {userid} {e}")
+        count('unavailable_responses')
+        annotate(status=503)
+        headers['Cache-Control'] = 'no-store'
+        headers['Retry-After'] = str(STALE_RETRY_SECONDS)
+        return (json.dumps({'error': 'data is temporarily unavailable'}),
+                503, headers)
+    if response is None:
+        annotate(status=404)
+        headers['Cache-Control'] = 'no-store'
+        return (json.dumps({'error': f'user {userid} has no scores'}), 404,
+                headers)
+    # per user, so kept out of the instance's response cache
+    headers['Cache-Control'] = f'public, max-age={CACHE_TTL_SECONDS}'
+    annotate(status=200)
+    return (json.dumps(response), 200, headers)
+
+
+def build_response(limit=PAGE_SIZE, cursor=None, shape=ROWS):
+    """
+    Returns the response data and whether it may be cached.
+    """
+    response = fetch_top_average_scores(limit, cursor)
+    if shape == COLUMNAR:
+        response = to_columns(response)
+    return response, True
+
+
+def parse_cursor(position):
+    """
+    Returns the sort key a cursor of this endpoint points after.
+
+    Exception:
+        BadRequest: when the cursor is not one of this endpoint's
+    """
+    if position is None:
+        return None
+    if not isinstance(position, list) or len(position) != 4 \
+            or not all(isinstance(value, (int, float))
+                       for value in position[:3]) \
+            or not isinstance(position[3], str):
+        raise BadRequest('cursor is invalid')
+    return dict(zip(
+        ['average_score', 'total_score', 'max_streak', 'userid'], position))
+
+
+def page_cursor(key):
+    """
+    Returns the cursor of the page after the entry with the sort `key`.
+    """
+    return encode_cursor([key['average_score'], key['total_score'],
+                          key['max_streak'], key['userid']])
+
+
+def fetch_data_version():
+    """
+    Returns the version store-scores and store-usernames bump in the rounds
+    metadata after every ingest that changed what the API serves. Drops the
+    cached profiles when store-usernames changed them.
+    """
+    db = firestore_client()
+    round_doc = db.collection(METADATA_COLLECTION).document(ROUND_DOCID) \
+        .get(timeout=call_timeout(), retry=None)
+    if not round_doc.exists:
+        return None
+    metadata = round_doc.to_dict()
+    PROFILE_CACHE.observe_version(metadata.get('profiles_version'))
+    return metadata.get('version')
+
+
+def add_profiles(db, data, userids):
+    """
+    Overwrites the profile fields of each entry of `data` with the user's
+    profile, read through the instance's profile cache. Entries of users
+    without a profile doc keep the fields they have.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        data (list): Entries of the response, updated in place
+        userids (list): Id of the user of each entry
+    """
+    profiles = PROFILE_CACHE.get_many(
+        userids,
+        lambda missing: fetch_profiles(db, PROFILE_COLLECTION, missing,
+                                       timeout=call_timeout()))
+    for entry, userid in zip(data, userids):
+        profile = profiles.get(userid)
+        if profile is not None:
+            entry.update((field, profile.get(field, entry.get(field)))
+                         for field in PROFILE_FIELDS)
 
 
-def fetch_top_average_scores():
+def fetch_top_average_scores(limit=PAGE_SIZE, cursor=None):
     """
     Returns the top average scores from Firestore
     The data should contain userdata - username, name, profile_image_url
     and total scores. Ordered by total scores.
+
+    Parameters:
+        limit (int): Number of users on the page
+        cursor (dict): Sort key of the last user of the previous page, or
+            None for the first page
+
+    Returns:
+        The page of users with the cursor of the next page, which is None
+        when the page is not full
+
+    Exception:
+        Errors of the Firestore calls, such as DeadlineExceeded when one
+        runs past its timeout, and BudgetExceeded
+    """
+    # reuse the instance's firestore client
+    db = firestore_client()
+
+    # store-scores writes the top of the leaderboard, already shaped as the
+    # response, after every ingest
+    if cursor is None:
+        with span('firestore.get'):
+            leaderboard_doc = db.collection(LEADERBOARD_COLLECTION) \
+                .document(AVERAGE_LEADERBOARD_DOCID) \
+                .get(timeout=call_timeout(), retry=None)
+        count('docs_read')
+        if leaderboard_doc.exists:
+            leaderboard = leaderboard_doc.to_dict()
+            data = leaderboard['data']
+            # a snapshot written before pagination has no sort keys, so its
+            # page has no next page until the next ingest, and keeps the
+            # profiles it was written with
+            keys = leaderboard.get('keys')
+            if keys:
+                add_profiles(db, data, [key['userid'] for key in keys])
+            if limit < len(data) or (limit == len(data) and not keys):
+                return {
+                    "data": data[:limit],
+                    "count": limit,
+                    "next_cursor": page_cursor(keys[limit - 1])
+                    if keys else None
+                }
+            if len(data) < LEADERBOARD_SIZE:
+                # the snapshot holds every user
+                return {
+                    "data": data,
+                    "count": len(data),
+                    "next_cursor": None
+                }
+            if limit == len(data):
+                # the page ends with the full snapshot, which only has a
+                # next page when a user ranks below it
+                return {
+                    "data": data,
+                    "count": limit,
+                    "next_cursor": page_cursor(keys[-1])
+                    if has_users_after(db, keys[-1]) else None
+                }
+
+    return query_top_average_scores(db, limit, cursor)
+
+
+def ranked_users_query(db, cursor=None):
     """
-    # initialize firestore client
-    db = firestore.Client()
+    Returns the query of the users in leaderboard order, after `cursor`
+    when given.
+    """
+    from google.cloud import firestore
+
     user_coll = db.collection(USER_COLLECTION)
+    query = user_coll. \
+        order_by('average_score', direction=firestore.Query.DESCENDING) \
+            .order_by('total_score', direction=firestore.Query.DESCENDING) \
+            .order_by('max_streak', direction=firestore.Query.DESCENDING) \
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+    if cursor is not None:
+        query = query.start_after({
+            'average_score': cursor['average_score'],
+            'total_score': cursor['total_score'],
+            'max_streak': cursor['max_streak'],
+            '__name__': cursor['userid']
+        })
+    return query
 
-    try:
-        user_docs = user_coll. \
-            order_by('average_score', direction=firestore.Query.DESCENDING) \
-                .order_by('total_score', direction=firestore.Query.DESCENDING) \
-                .order_by('max_streak', direction=firestore.Query.DESCENDING) \
-                .limit(10).stream()
-
-        data = []
-        for user_doc in user_docs:
-            doc = user_doc.to_dict()
-            data.append({
-                u'username': doc.get('username'), 
-                u'name': doc.get('name', ''),
-                u'profile_image_url': doc.get('profile_image_url', ''),
-                u'average_score': doc.get('average_score'),
-                u'max_streak': doc.get('max_streak'),
-                u'total_score': doc.get('total_score')
-            })
-            print(f"user {doc.get('username')} scored {doc.get('average_score')}")
-
-        return {
-            "data": data,
-            "count": len(data)
-        }
-    except Exception as e:
-        print(f"Encountered error {e}")
-        traceback.print_exc()
-        return get_canned_response()
-
-
-def get_canned_response():
-    """
-    Static json for respose format and as a backup.
-    """
-    response = {
-        "data": [
-            {
-                "username": "abc",
-                "name": "abc name", 
-                "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
-                "average_score": 5.5,
-                "max_streak": 3,
-                "total_score": 15
-            },
-            {
-                "username": "def",
-                "name": "def name", 
-                "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
-                "average_score": 4.4,
-                "max_streak": 2,
-                "total_score": 8
-            },
-            {
-                "username": "xyz",
-                "name": "xyz name", 
-                "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
-                "average_score": 3.21,
-                "max_streak": 4,
-                "total_score": 12
-            }
-        ],
-        "count": 3
+
+def has_users_after(db, key):
+    """
+    Returns whether any user ranks after the user with the sort `key`,
+    reading at most one doc.
+    """
+    with span('firestore.query'):
+        user_docs = list(ranked_users_query(db, key)
+                         .select(['average_score']).limit(1)
+                         .stream(timeout=call_timeout(), retry=None))
+    count('docs_read', len(user_docs))
+    return bool(user_docs)
+
+
+def query_top_average_scores(db, limit=PAGE_SIZE, cursor=None):
+    """
+    Queries a page of the top average scores from the users collection.
+    Used for the pages past the leaderboard snapshot, and until the first
+    snapshot has been written.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        limit (int): Number of users on the page
+        cursor (dict): Sort key of the last user of the previous page
+    """
+    query = ranked_users_query(db, cursor)
+    with span('firestore.query'):
+        user_docs = list(query.limit(limit).stream(
+            timeout=call_timeout(), retry=None))
+    count('docs_read', len(user_docs))
+
+    data = []
+    userids = []
+    key = None
+    for user_doc in user_docs:
+        doc = user_doc.to_dict()
+        data.append({
+            u'username': doc.get('username'), 
+            u'name': doc.get('name', ''),
+            u'profile_image_url': doc.get('profile_image_url', ''),
+            u'average_score': doc.get('average_score'),
+            u'max_streak': doc.get('max_streak'),
+            u'total_score': doc.get('total_score')
+        })
+        if sampled():
+            print(f"user {doc.get('username')} scored "
+                  f"{doc.get('average_score')}")
+        key = dict(doc, userid=user_doc.id)
+        userids.append(user_doc.id)
+
+    add_profiles(db, data, userids)
+    return {
+        "data": data,
+        "count": len(data),
+        "next_cursor": page_cursor(key) if len(data) == limit else None
     }
 
-    return response
+
+def fetch_user_rank(userid):
+    """
+    Returns a user's rank on the leaderboard, ordered like its pages.
+
+    The user doc and the rank index are read with one `get_all`, which
+    gives the users in buckets ahead of the user's, and an approximate
+    rank that spreads the user's bucket evenly over its totals. The exact
+    rank also queries the users ahead of the user in its own bucket, at
+    most MAX_RANK_BUCKET_USERS of them; when there are more, the rank is
+    the approximate one, but never ahead of the users read.
+
+    Parameters:
+        userid (str): Id of the user
+
+    Returns:
+        Dictionary of the user's stats, exact and approximate rank, number
+        of users ranked and percentile, the percent of them ranked below
+        the user; None when the user has no scores
+    """
+    db = firestore_client()
+    user_ref = db.collection(USER_COLLECTION).document(userid)
+    index_coll = db.collection(RANK_INDEX_COLLECTION)
+    refs = [user_ref] + [index_coll.document(str(point))
+                         for point in range(RANK_INDEX_DOCS)]
+    with span('firestore.get_all'):
+        docs = list(db.get_all(refs, timeout=call_timeout(), retry=None))
+    count('docs_read', len(refs))
+
+    user_snapshot = next((doc for doc in docs
+                          if doc.reference == user_ref and doc.exists), None)
+    user_doc = user_snapshot.to_dict() if user_snapshot else None
+    if user_doc is None or user_doc.get('average_score') is None:
+        return None
+    average_score = user_doc['average_score']
+    total_score = user_doc.get('total_score', 0)
+    max_streak = user_doc.get('max_streak', 0)
+    tenths = round(average_score * 10)
+    bucket = total_score // RANK_TOTAL_BUCKET
+
+    users = ahead = in_bucket = 0
+    for doc in docs:
+        if doc.reference == user_ref or not doc.exists:
+            continue
+        for doc_tenths, buckets in doc.to_dict().get('counts', {}).items():
+            for doc_bucket, bucket_users in buckets.items():
+                users += bucket_users
+                key = (int(doc_tenths), int(doc_bucket))
+                if key > (tenths, bucket):
+                    ahead += bucket_users
+                elif key == (tenths, bucket):
+                    in_bucket += bucket_users
+
+    # share of the bucket's totals above the user's
+    above = ((bucket + 1) * RANK_TOTAL_BUCKET - 1 - total_score) \
+        / RANK_TOTAL_BUCKET
+    approximate_rank = ahead + 1 + round(max(in_bucket - 1, 0) * above)
+
+    # the users of the bucket ordered after the user are ranked ahead of
+    # it; needs a composite index on (average_score, total_score,
+    # max_streak)
+    query = db.collection(USER_COLLECTION) \
+        .where('average_score', '==', average_score) \
+        .where('total_score', '>=', bucket * RANK_TOTAL_BUCKET) \
+        .where('total_score', '<', (bucket + 1) * RANK_TOTAL_BUCKET) \
+        .order_by('total_score') \
+        .order_by('max_streak') \
+        .order_by('__name__') \
+        .start_after(user_snapshot) \
+        .limit(MAX_RANK_BUCKET_USERS) \
+        .select(['total_score', 'max_streak'])
+    with span('firestore.query'):
+        bucket_docs = list(query.stream(timeout=call_timeout(),
+                                        retry=None))
+    count('docs_read', len(bucket_docs))
+    rank = ahead + 1 + len(bucket_docs)
+    if len(bucket_docs) == MAX_RANK_BUCKET_USERS:
+        count('rank_bucket_capped')
+        rank = max(rank, approximate_rank)
+
+    # the index may trail the user docs by an ingest
+    users = max(users, rank, approximate_rank)
+    return {
+        "userid": userid,
+        "average_score": average_score,
+        "total_score": total_score,
+        "max_streak": max_streak,
+        "rank": rank,
+        "approximate_rank": approximate_rank,
+        "users": users,
+        "percentile": round(100 * (users - rank) / users, 1)
+    }
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import flask
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from pagination import decode_cursor
+from profile_cache import ProfileCache
+import clients
+import main
+
+# leaderboard snapshot in the shape store-scores writes
+LEADERBOARD_SNAPSHOT = {
+    "data": [
+        {
+            "username": "abc",
+            "name": "abc name",
+            "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
+            "average_score": 5.5,
+            "max_streak": 3,
+            "total_score": 15
+        },
+        {
+            "username": "def",
+            "name": "def name",
+            "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
+            "average_score": 4.4,
+            "max_streak": 2,
+            "total_score": 8
+        },
+        {
+            "username": "xyz",
+            "name": "xyz name",
+            "profile_image_url": "https://cdn.quasar.dev/img/boy-avatar.png",
+            "average_score": 3.21,
+            "max_streak": 4,
+            "total_score": 12
+        }
+    ],
+    "count": 3
+}
+
+
+def seed_users(db, users):
+    for userid, stats in users.items():
+        db.collection(main.USER_COLLECTION).document(userid).set(
+            dict(stats, userid=userid, username=f'{userid} handle'))
+
+
+class TestFetchTopAverageScores(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        patcher = mock.patch.object(main, 'PROFILE_CACHE',
+                                    ProfileCache(100, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_serves_snapshot_with_one_read(self):
+        snapshot = LEADERBOARD_SNAPSHOT
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set(dict(snapshot, version=7))
+        self.db.reset_counts()
+
+        response = main.fetch_top_average_scores()
+
+        self.assertEqual(response, dict(snapshot, next_cursor=None))
+        self.assertEqual(self.db.rpc_counts, {'get': 1})
+
+    def test_falls_back_to_query_without_snapshot(self):
+        seed_users(self.db, {
+            'a': {'average_score': 4.0, 'total_score': 8, 'max_streak': 2},
+            'b': {'average_score': 5.0, 'total_score': 5, 'max_streak': 1},
+            'c': {'average_score': 4.0, 'total_score': 12, 'max_streak': 3},
+        })
+
+        response = main.fetch_top_average_scores()
+
+        self.assertEqual(response['count'], 3)
+        self.assertEqual([user['username'] for user in response['data']],
+                         ['b handle', 'c handle', 'a handle'])
+        self.assertIsNone(response['next_cursor'])
+
+
+def ranked_users(count):
+    # ties on every stat, so pages are split by the userid tiebreak
+    return {f'user{i:02}': {'average_score': float(i // 4),
+                            'total_score': i // 2, 'max_streak': 1}
+            for i in range(count)}
+
+
+def expected_order(users):
+    return sorted(users, reverse=True, key=lambda userid: (
+        users[userid]['average_score'], users[userid]['total_score'],
+        users[userid]['max_streak'], userid))
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        patcher = mock.patch.object(main, 'PROFILE_CACHE',
+                                    ProfileCache(100, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = flask.Flask(__name__)
+
+        self.users = ranked_users(25)
+        seed_users(self.db, self.users)
+        self.order = expected_order(self.users)
+
+    def write_snapshot(self):
+        top = self.order[:main.LEADERBOARD_SIZE]
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID).set({
+                'data': [{'username': f'{userid} handle'} for userid in top],
+                'count': len(top),
+                'keys': [dict(self.users[userid], userid=userid)
+                         for userid in top]
+            })
+
+    def get(self, path):
+        with self.app.test_request_context(path):
+            return main.http_receiver(flask.request)
+
+    def page_through(self, limit):
+        usernames = []
+        cursor = None
+        while True:
+            self.db.reset_counts()
+            response = main.fetch_top_average_scores(limit, cursor)
+            # the page's users and their profiles, plus the snapshot on
+            # the first page
+            self.assertLessEqual(self.db.doc_reads, 2 * limit + 1)
+            usernames.extend(user['username'] for user in response['data'])
+            if response['next_cursor'] is None:
+                return usernames
+            cursor = main.parse_cursor(decode_cursor(mock.Mock(
+                args={'cursor': response['next_cursor']})))
+
+    def test_pages_through_every_user_by_query(self):
+        self.assertEqual(self.page_through(7),
+                         [f'{userid} handle' for userid in self.order])
+
+    def test_continues_after_the_snapshot(self):
+        self.write_snapshot()
+
+        self.assertEqual(self.page_through(5),
+                         [f'{userid} handle' for userid in self.order])
+
+    def test_first_page_from_snapshot(self):
+        self.write_snapshot()
+        self.db.reset_counts()
+
+        response = main.fetch_top_average_scores(4)
+
+        self.assertEqual(response['count'], 4)
+        self.assertIsNotNone(response['next_cursor'])
+        # the profiles of the snapshot's users are read once
+        self.assertEqual(self.db.rpc_counts, {'get': 1, 'batch_get': 1})
+        self.db.reset_counts()
+        main.fetch_top_average_scores(4)
+        self.assertEqual(self.db.rpc_counts, {'get': 1})
+
+    def test_full_snapshot_page(self):
+        self.write_snapshot()
+        self.db.reset_counts()
+
+        response = main.fetch_top_average_scores(main.LEADERBOARD_SIZE)
+
+        self.assertEqual(response['count'], main.LEADERBOARD_SIZE)
+        self.assertIsNotNone(response['next_cursor'])
+        self.assertEqual(self.page_through(main.LEADERBOARD_SIZE),
+                         [f'{userid} handle' for userid in self.order])
+
+    def test_snapshot_of_every_user_has_no_next_page(self):
+        for userid in self.order[main.LEADERBOARD_SIZE:]:
+            self.db.collection(main.USER_COLLECTION).document(userid) \
+                .delete()
+        self.write_snapshot()
+        self.db.reset_counts()
+
+        response = main.fetch_top_average_scores(main.LEADERBOARD_SIZE)
+
+        self.assertEqual(response['count'], main.LEADERBOARD_SIZE)
+        self.assertIsNone(response['next_cursor'])
+        # the snapshot, its profiles and a query finding no more users
+        self.assertEqual(self.db.rpc_counts,
+                         {'get': 1, 'batch_get': 1, 'query': 1})
+
+    def test_joins_profiles(self):
+        self.write_snapshot()
+        top = self.order[0]
+        self.db.collection(main.PROFILE_COLLECTION).document(top).set({
+            'username': 'renamed', 'name': 'Renamed',
+            'profile_image_url': 'https://example.com/renamed.png'})
+
+        usernames = self.page_through(5)
+
+        self.assertEqual(usernames[0], 'renamed')
+        self.assertEqual(usernames[1:],
+                         [f'{userid} handle' for userid in self.order[1:]])
+
+    def test_limit_is_capped(self):
+        seed_users(self.db, ranked_users(120))
+
+        body, status, _ = self.get('/?limit=500')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(flask.json.loads(body)['count'], 100)
+
+    def test_rejects_bad_parameters(self):
+        for path in ('/?limit=0', '/?limit=ten', '/?cursor=%%%',
+                     '/?cursor=WzFd'):
+            body, status, headers = self.get(path)
+
+            self.assertEqual(status, 400, path)
+            self.assertIn('error', flask.json.loads(body))
+            self.assertEqual(headers['Cache-Control'], 'no-store')
+
+
+def seed_rank_index(db, users):
+    # as store-scores maintains it
+    counts = {}
+    for stats in users.values():
+        tenths = round(stats['average_score'] * 10)
+        bucket = stats['total_score'] // main.RANK_TOTAL_BUCKET
+        point = counts.setdefault(str(tenths // 10), {}) \
+            .setdefault(str(tenths), {})
+        point[str(bucket)] = point.get(str(bucket), 0) + 1
+    for point in range(main.RANK_INDEX_DOCS):
+        db.collection(main.RANK_INDEX_COLLECTION).document(str(point)).set(
+            {'counts': counts.get(str(point), {})})
+
+
+class TestUserRank(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        self.app = flask.Flask(__name__)
+
+        # buckets shared by several users, and ties broken by max_streak
+        # and userid
+        self.users = {f'user{i:02}': {
+            'average_score': round(3 + (i % 5) / 10, 1),
+            'total_score': 10 + (i * 7) % 25,
+            'max_streak': i % 3} for i in range(40)}
+        seed_users(self.db, self.users)
+        seed_rank_index(self.db, self.users)
+        self.order = expected_order(self.users)
+
+    def get(self, path):
+        with self.app.test_request_context(path):
+            body, status, headers = main.http_receiver(flask.request)
+        return flask.json.loads(body), status, headers
+
+    def test_matches_leaderboard_order(self):
+        for position, userid in enumerate(self.order):
+            response = main.fetch_user_rank(userid)
+
+            self.assertEqual(response['rank'], position + 1, userid)
+            self.assertEqual(response['users'], len(self.users))
+            self.assertEqual(response['percentile'], round(
+                100 * (len(self.users) - position - 1) / len(self.users), 1))
+            # off by at most the users sharing the bucket
+            self.assertLess(
+                abs(response['approximate_rank'] - response['rank']), 10)
+
+    def test_constant_reads(self):
+        self.db.reset_counts()
+        response, status, headers = self.get('/rank?userid=user07')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(response['rank'], self.order.index('user07') + 1)
+        self.assertEqual(self.db.rpc_counts,
+                         {'batch_get': 1, 'query': 1})
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+
+    def test_caps_bucket_reads(self):
+        capped = 0
+        for position, userid in enumerate(self.order):
+            self.db.reset_counts()
+            with mock.patch.object(main, 'MAX_RANK_BUCKET_USERS', 1):
+                response = main.fetch_user_rank(userid)
+
+            # the user, the index and at most one user of the bucket
+            self.assertEqual(self.db.doc_reads, 1 + main.RANK_INDEX_DOCS + 1)
+            if response['rank'] != position + 1:
+                capped += 1
+                self.assertLessEqual(response['rank'], max(
+                    position + 1, response['approximate_rank']))
+                self.assertLess(abs(response['rank'] - position - 1), 10)
+        self.assertGreater(capped, 0)
+
+    def test_calls_are_not_retried(self):
+        with mock.patch.object(self.db, 'get_all',
+                               wraps=self.db.get_all) as get_all:
+            response, status, _ = self.get('/rank?userid=user07')
+
+        self.assertEqual(status, 200)
+        self.assertIsNone(get_all.call_args.kwargs['retry'])
+        self.assertGreater(get_all.call_args.kwargs['timeout'], 0)
+
+    def test_unavailable_when_firestore_times_out(self):
+        self.db.latency = 0.05
+        with mock.patch.object(main, 'CALL_TIMEOUT_SECONDS', 0.01):
+            response, status, headers = self.get('/rank?userid=user07')
+
+        self.assertEqual(status, 503)
+        self.assertIn('error', response)
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+        self.assertEqual(headers['Retry-After'],
+                         str(main.STALE_RETRY_SECONDS))
+
+    def test_unknown_user(self):
+        response, status, headers = self.get('/rank?userid=nobody')
+
+        self.assertEqual(status, 404)
+        self.assertIn('error', response)
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+
+    def test_rejects_bad_userid(self):
+        self.db.reset_counts()
+        for path in ('/rank', '/rank?userid=a/b'):
+            response, status, _ = self.get(path)
+
+            self.assertEqual(status, 400, path)
+            self.assertIn('error', response)
+        self.assertEqual(self.db.rpcs, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Query parameters of the paginated API responses.
+
+A page is requested with `limit`, capped at MAX_LIMIT, and `cursor`, the
+`next_cursor` of the previous page. A cursor is the position after the
+last item of a page, serialized as url-safe base64 of JSON, so the next
+page is read with `start_after` and costs reads for its own items only.
+Clients should treat it as opaque.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the API functions.
+"""
+
+import base64
+import binascii
+import json
+
+MAX_LIMIT = 100
+
+
+class BadRequest(ValueError):
+    """
+    A query parameter has an invalid value.
+    """
+
+
+def int_arg(request, name, default=None, minimum=1, maximum=None):
+    """
+    Returns an integer query parameter, or `default` when it is absent.
+    Values above `maximum` are capped.
+
+    Exception:
+        BadRequest: when the value is not an integer or below `minimum`
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(f'{name} must be an integer') from None
+    if value < minimum:
+        raise BadRequest(f'{name} must be at least {minimum}')
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def page_limit(request, default):
+    """
+    Returns the page size asked for, capped at MAX_LIMIT.
+    """
+    return int_arg(request, 'limit', default, maximum=MAX_LIMIT)
+
+
+def encode_cursor(position):
+    """
+    Serializes a position, any JSON value, into an opaque cursor.
+    """
+    data = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(request):
+    """
+    Returns the position of the `cursor` query parameter, or None when it
+    is absent.
+
+    Exception:
+        BadRequest: when the cursor was not made by `encode_cursor`
+    """
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return json.loads(data)
+    except (binascii.Error, ValueError):
+        raise BadRequest('cursor is invalid') from None
+
+
+def bad_request(error, headers):
+    """
+    Returns the 400 response of a BadRequest.
+    """
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+    headers['Cache-Control'] = 'no-store'
+    body = json.dumps({'error': str(error)})
+    return (body, 400, headers)
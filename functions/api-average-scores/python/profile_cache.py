@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-instance read-through cache of user profiles.
+
+store-usernames writes the profile of every user, the fields shown next to
+their stats, to `profiles/{userid}`:
+
+    {"username": ..., "name": ..., "profile_image_url": ...}
+
+apart from the stats store-scores writes to `users/{userid}`. The API
+joins them through this cache: the profiles missing from it are read with
+one `get_all`, and kept for `ttl` seconds in an LRU of at most `max_size`
+users. Users without a profile doc are cached too, as None.
+
+After writing profiles, store-usernames bumps `profiles_version` in
+`metadata/rounds`, and the whole cache is dropped once the API sees the
+new version.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import count, span
+
+# Firestore limit on documents per get_all
+MAX_GET_ALL = 500
+
+
+class ProfileCache:
+    """
+    LRU cache of user profiles, each kept for `ttl` seconds.
+
+    Parameters:
+        max_size (int): Most profiles kept
+        ttl (float): Seconds a profile is served before it is read again
+        clock (callable): Returns the current time in seconds
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_many(self, userids, fetch):
+        """
+        Returns the profiles of `userids`, reading the ones not cached.
+
+        Parameters:
+            userids (list): Ids of the users
+            fetch (callable): Returns a dictionary of the profiles of a
+                list of userids, None for a user without one
+
+        Returns:
+            Dictionary of profile, or None, keyed by userid
+        """
+        now = self._clock()
+        profiles = {}
+        missing = []
+        with self._lock:
+            for userid in dict.fromkeys(userids):
+                entry = self._entries.get(userid)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(userid)
+                    profiles[userid] = entry[0]
+                else:
+                    missing.append(userid)
+        count('profile_cache_hits', len(profiles))
+        if not missing:
+            return profiles
+
+        count('profile_cache_misses', len(missing))
+
+        fetched = fetch(missing)
+        expires = now + self.ttl
+        with self._lock:
+            for userid in missing:
+                profile = fetched.get(userid)
+                profiles[userid] = profile
+                self._entries[userid] = (profile, expires)
+                self._entries.move_to_end(userid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return profiles
+
+    def observe_version(self, version):
+        """
+        Drops every cached profile when the profiles version changed since
+        the last one observed.
+        """
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def fetch_profiles(db, collection, userids, timeout=None):
+    """
+    Reads the profile docs of `userids` with one `get_all` per 500 users,
+    each given `timeout` seconds and not retried.
+
+    Returns:
+        Dictionary of profile, or None, keyed by userid
+    """
+    coll_ref = db.collection(collection)
+    profiles = {}
+    for start in range(0, len(userids), MAX_GET_ALL):
+        refs = [coll_ref.document(userid)
+                for userid in userids[start:start + MAX_GET_ALL]]
+        with span('firestore.get_all'):
+            for doc in db.get_all(refs, timeout=timeout, retry=None):
+                profiles[doc.id] = doc.to_dict() if doc.exists else None
+        count('docs_read', len(refs))
+    return profiles
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from profile_cache import ProfileCache, fetch_profiles
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProfileCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ProfileCache(3, 60, clock=self.clock)
+        self.fetch = mock.Mock(side_effect=lambda userids: {
+            userid: {'username': f'{userid} handle'} for userid in userids
+            if userid != 'ghost'})
+
+    def test_reads_only_missing_profiles(self):
+        self.cache.get_many(['a', 'b'], self.fetch)
+        profiles = self.cache.get_many(['b', 'c', 'c'], self.fetch)
+
+        self.assertEqual(profiles['c'], {'username': 'c handle'})
+        self.assertEqual([call.args[0] for call in self.fetch.mock_calls],
+                         [['a', 'b'], ['c']])
+
+    def test_caches_users_without_profile(self):
+        self.assertEqual(self.cache.get_many(['ghost'], self.fetch),
+                         {'ghost': None})
+        self.cache.get_many(['ghost'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.get_many(['a', 'b', 'c'], self.fetch)
+        self.cache.get_many(['a'], self.fetch)
+        self.cache.get_many(['d'], self.fetch)
+
+        self.cache.get_many(['a', 'c', 'd'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 2)
+        self.cache.get_many(['b'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 3)
+
+    def test_expires_after_ttl(self):
+        self.cache.get_many(['a'], self.fetch)
+        self.clock.now += 61
+        self.cache.get_many(['a'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_new_version_drops_profiles(self):
+        self.cache.observe_version(1)
+        self.cache.get_many(['a'], self.fetch)
+        self.cache.observe_version(1)
+        self.cache.get_many(['a'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 1)
+
+        self.cache.observe_version(2)
+        self.cache.get_many(['a'], self.fetch)
+        self.assertEqual(self.fetch.call_count, 2)
+
+
+class TestFetchProfiles(unittest.TestCase):
+    def test_one_get_all_per_500_users(self):
+        db = FakeClient()
+        db.collection('profiles').document('u1').set({'username': 'one'})
+        db.reset_counts()
+
+        profiles = fetch_profiles(
+            db, 'profiles', [f'u{i}' for i in range(600)])
+
+        self.assertEqual(profiles['u1'], {'username': 'one'})
+        self.assertIsNone(profiles['u2'])
+        self.assertEqual(db.rpc_counts, {'batch_get': 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
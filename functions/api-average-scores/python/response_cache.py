@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-instance cache of serialized API responses.
+
+The data behind the APIs only changes when store-scores ingests a tweets
+file or store-usernames changes profiles, which bumps the `version` of
+`metadata/rounds`. A cached response is
+served without touching Firestore for `ttl` seconds; after that, one read
+of the version decides whether it is still current or must be rebuilt.
+
+Responses are keyed by the endpoint and the parsed values of the
+parameters it accepts, so unknown parameters and spellings of the same
+value share an entry. At most `max_size` responses are kept, the least
+recently used dropped first, and a response is dropped once it has gone
+`max_stale` seconds past its TTL without being confirmed current.
+
+Responses carry a strong ETag, so a client that sends it back in
+`If-None-Match` gets a 304 with no body.
+
+A response is serialized once when it is built, and compressed once per
+content coding the first time a client asks for it; later requests are
+served those bytes as they are.
+
+When a response cannot be rebuilt, for instance because Firestore did not
+answer within the request's budget, the last good copy is served instead,
+marked stale in the FRESHNESS_HEADER, and its rebuild is only retried
+after `retry` seconds so the requests in between are not held up again.
+Without a copy the request gets a 503, never made-up data.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the API functions.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from encoding import compress, negotiate_encoding
+from instrumentation import annotate, count, span
+
+# response header telling whether the data is current
+FRESHNESS_HEADER = 'X-Data-Freshness'
+FRESH = 'fresh'
+STALE = 'stale'
+
+
+class CacheEntry:
+    def __init__(self, body, version, expires):
+        self.body = body
+        self.version = version
+        self.expires = expires
+        # until when the response may be served as a stale fallback
+        self.keep_until = expires
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        # served in place of a response that could not be rebuilt
+        self.stale = False
+        self._encoded = {None: body}
+
+    def encoded(self, encoding):
+        """
+        Returns the body in the content coding `encoding`, compressing it
+        on first use.
+        """
+        body = self._encoded.get(encoding)
+        if body is None:
+            # two requests may both compress it; either result is kept
+            with span('compress'):
+                body = self._encoded[encoding] = compress(self.body,
+                                                          encoding)
+        return body
+
+    def etag_for(self, encoding):
+        """
+        Returns the ETag of the body in the content coding `encoding`; each
+        coding is a different representation.
+        """
+        return f'{self.etag}-{encoding}' if encoding else self.etag
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses, keyed by endpoint and parameters.
+
+    Parameters:
+        ttl (float): Seconds a response is served before its version is
+            checked again
+        clock (callable): Returns the current time in seconds
+        retry (float): Seconds a stale response is served before it is
+            rebuilt again
+        max_size (int): Most responses kept
+        max_stale (float): Seconds past its TTL a response is kept as a
+            stale fallback
+    """
+
+    def __init__(self, ttl, clock=time.monotonic, retry=5, max_size=1000,
+                 max_stale=600):
+        self.ttl = ttl
+        self.retry = retry
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key, read_version, build):
+        """
+        Returns the cache entry for `key`, rebuilding it when it expired and
+        the data version changed.
+
+        Parameters:
+            key (tuple): The endpoint and its parameters
+            read_version (callable): Reads the current data version
+            build (callable): Returns the response data and whether it may
+                be cached
+
+        Returns:
+            Tuple of the entry, or None when the response was not
+            cacheable, and the serialized body. The entry is marked stale
+            when it could not be rebuilt.
+
+        Exception:
+            Whatever `build` raised, when there is no entry to serve
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.keep_until + self.max_stale <= now:
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        if entry is not None and entry.expires > now:
+            count('cache_hits')
+            return entry, entry.body
+
+        try:
+            with span('firestore.get'):
+                version = read_version()
+            count('docs_read')
+        except Exception as e:
+            print(f"Could not read data version {e}")
+            if entry is not None:
+                return self._serve_stale(entry, now)
+            version = None
+
+        if entry is not None and entry.version == version:
+            count('cache_revalidated')
+            entry.stale = False
+            entry.expires = entry.keep_until = now + self.ttl
+            return entry, entry.body
+
+        count('cache_misses')
+        try:
+            with span('build'):
+                data, cacheable = build()
+        except Exception as e:
+            count('build_errors')
+            print(f"Could not build response {e}")
+            traceback.print_exc()
+            if entry is None:
+                raise
+            return self._serve_stale(entry, now)
+        with span('serialize'):
+            body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        if not cacheable:
+            return None, body
+
+        entry = CacheEntry(body, version, now + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            # entries left unused since they went past their fallback
+            # window sit at the front
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.keep_until + self.max_stale > now:
+                    break
+                self._entries.popitem(last=False)
+        return entry, body
+
+    def _serve_stale(self, entry, now):
+        """
+        Marks `entry` stale and serves it for `retry` seconds.
+        """
+        entry.stale = True
+        entry.expires = now + self.retry
+        return entry, entry.body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def cached_json_response(cache, request, key, read_version, build, headers):
+    """
+    Serves a GET request from the cache, answering a matching
+    `If-None-Match` with a 304. The body is compressed when the request
+    accepts it. A response that could not be built is a 503.
+
+    Parameters:
+        cache (ResponseCache): The instance's response cache
+        request (flask.Request): The request object
+        key (tuple): Name of the endpoint and the parsed values of the
+            parameters the response depends on
+        read_version (callable): Reads the current data version
+        build (callable): Returns the response data and whether it may be
+            cached
+        headers (dict): Headers to add to the response
+
+    Returns:
+        Tuple of response body, status and headers
+    """
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+    try:
+        entry, body = cache.lookup(key, read_version, build)
+    except Exception:
+        count('unavailable_responses')
+        annotate(freshness='unavailable')
+        headers['Cache-Control'] = 'no-store'
+        headers['Retry-After'] = str(int(cache.retry))
+        return (json.dumps({'error': 'data is temporarily unavailable'}),
+                503, headers)
+
+    freshness = STALE if entry is not None and entry.stale else FRESH
+    count(f'{freshness}_responses')
+    annotate(freshness=freshness)
+    headers[FRESHNESS_HEADER] = freshness
+    headers['Vary'] = 'Accept-Encoding'
+    encoding = negotiate_encoding(request, len(body))
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if entry is None:
+        headers['Cache-Control'] = 'no-store'
+        if encoding:
+            with span('compress'):
+                body = compress(body, encoding)
+        return (body, 200, headers)
+
+    etag = entry.etag_for(encoding)
+    headers['ETag'] = f'"{etag}"'
+    headers['Cache-Control'] = \
+        f'public, max-age={int(cache.retry if entry.stale else cache.ttl)}'
+    if request.if_none_match.contains(etag):
+        headers.pop('Content-Encoding', None)
+        count('not_modified')
+        return ('', 304, headers)
+    return (entry.encoded(encoding), 200, headers)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import os
+import sys
+import unittest
+from unittest import mock
+
+import flask
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from deadline import BudgetExceeded, call_timeout, request_budget
+from fake_firestore import FakeClient
+from main_test import LEADERBOARD_SNAPSHOT
+from response_cache import FRESHNESS_HEADER, ResponseCache
+import encoding
+import clients
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCachedResponses(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+
+        self.clock = FakeClock()
+        patcher = mock.patch.object(
+            main, 'RESPONSE_CACHE', ResponseCache(60, clock=self.clock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.app = flask.Flask(__name__)
+        self.set_leaderboard(LEADERBOARD_SNAPSHOT['data'][:2])
+        self.set_version(1)
+
+    def set_leaderboard(self, data):
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set({'data': data, 'count': len(data)})
+
+    def set_version(self, version):
+        self.db.collection(main.METADATA_COLLECTION) \
+            .document(main.ROUND_DOCID) \
+            .set({'latest_round': 450, 'version': version})
+
+    def get(self, path='/', headers=None):
+        self.db.reset_counts()
+        with self.app.test_request_context(path, headers=headers or {}):
+            return main.http_receiver(flask.request)
+
+    def test_etag_and_cache_control(self):
+        body, status, headers = self.get()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(flask.json.loads(body)['count'], 2)
+        self.assertRegex(headers['ETag'], r'^"[0-9a-f]{32}"$')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(headers[FRESHNESS_HEADER], 'fresh')
+
+    def test_served_from_cache_within_ttl(self):
+        first = self.get()
+        second = self.get()
+
+        self.assertEqual(second, first)
+        self.assertEqual(self.db.rpcs, 0)
+
+    def test_not_modified_without_firestore(self):
+        _, _, headers = self.get()
+
+        body, status, not_modified_headers = self.get(
+            headers={'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 304)
+        self.assertEqual(body, '')
+        self.assertEqual(not_modified_headers['ETag'], headers['ETag'])
+        self.assertEqual(self.db.rpcs, 0)
+
+    def test_revalidates_version_after_ttl(self):
+        first = self.get()
+        self.clock.now += 61
+
+        second = self.get()
+
+        self.assertEqual(second, first)
+        # only the version was read
+        self.assertEqual(self.db.rpc_counts, {'get': 1})
+
+    def test_rebuilds_after_version_change(self):
+        _, _, headers = self.get()
+        self.set_leaderboard(LEADERBOARD_SNAPSHOT['data'][:1])
+        self.set_version(2)
+        self.clock.now += 61
+
+        body, status, new_headers = self.get(
+            headers={'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(flask.json.loads(body)['count'], 1)
+        self.assertNotEqual(new_headers['ETag'], headers['ETag'])
+
+    def test_query_parameters_are_cached_separately(self):
+        self.get('/?limit=1')
+        self.get('/?limit=2')
+        # unknown parameters and other spellings share the entries
+        self.get('/?limit=01&page=3')
+        self.get('/?limit=2&format=rows')
+
+        self.assertEqual(len(main.RESPONSE_CACHE._entries), 2)
+
+    def test_least_recently_used_dropped(self):
+        main.RESPONSE_CACHE.max_size = 2
+        self.get('/?limit=1')
+        self.get('/?limit=2')
+        self.get('/?limit=1')
+        self.get('/?limit=3')
+
+        self.assertEqual(
+            [key[1] for key in main.RESPONSE_CACHE._entries], [1, 3])
+
+    def test_unused_responses_dropped(self):
+        self.get('/?limit=1')
+        self.clock.now += 61 + 600
+        self.get('/?limit=2')
+
+        self.assertEqual(
+            [key[1] for key in main.RESPONSE_CACHE._entries], [2])
+
+    def test_stale_when_rebuild_fails(self):
+        first, _, headers = self.get()
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set({'count': 0})
+        self.set_version(2)
+        self.clock.now += 61
+
+        body, status, stale_headers = self.get()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, first)
+        self.assertEqual(stale_headers[FRESHNESS_HEADER], 'stale')
+        self.assertEqual(stale_headers['ETag'], headers['ETag'])
+        self.assertEqual(stale_headers['Cache-Control'], 'public, max-age=5')
+
+        # served as is until the rebuild is retried
+        self.clock.now += 4
+        _, _, stale_headers = self.get()
+        self.assertEqual(self.db.rpcs, 0)
+        self.assertEqual(stale_headers[FRESHNESS_HEADER], 'stale')
+
+        self.set_leaderboard(LEADERBOARD_SNAPSHOT['data'][:1])
+        self.clock.now += 2
+        body, _, fresh_headers = self.get()
+        self.assertEqual(flask.json.loads(body)['count'], 1)
+        self.assertEqual(fresh_headers[FRESHNESS_HEADER], 'fresh')
+
+    def test_unavailable_without_good_response(self):
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set({'count': 0})
+
+        body, status, headers = self.get()
+
+        self.assertEqual(status, 503)
+        self.assertIn('error', flask.json.loads(body))
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+        self.assertEqual(headers['Retry-After'], '5')
+        self.assertNotIn('ETag', headers)
+        self.assertEqual(main.RESPONSE_CACHE._entries, {})
+
+
+class TestRequestBudget(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+
+        self.clock = FakeClock()
+        for name, value in (
+                ('RESPONSE_CACHE', ResponseCache(60, clock=self.clock)),
+                ('CALL_TIMEOUT_SECONDS', 0.01)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.app = flask.Flask(__name__)
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set(LEADERBOARD_SNAPSHOT)
+        self.db.collection(main.METADATA_COLLECTION) \
+            .document(main.ROUND_DOCID) \
+            .set({'latest_round': 450, 'version': 1})
+
+    def get(self):
+        with self.app.test_request_context('/'):
+            return main.http_receiver(flask.request)
+
+    def test_call_timeout_within_budget(self):
+        self.assertIsNone(call_timeout())
+        with request_budget(3, 2, clock=self.clock):
+            self.assertEqual(call_timeout(), 2)
+            self.clock.now += 2
+            self.assertEqual(call_timeout(), 1)
+            self.clock.now += 1
+            with self.assertRaises(BudgetExceeded):
+                call_timeout()
+        self.assertIsNone(call_timeout())
+
+    def test_slow_firestore_serves_stale(self):
+        first, _, _ = self.get()
+        self.db.latency = 0.05
+        self.clock.now += 61
+
+        body, status, headers = self.get()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, first)
+        self.assertEqual(headers[FRESHNESS_HEADER], 'stale')
+
+    def test_slow_firestore_without_response(self):
+        self.db.latency = 0.05
+
+        _, status, headers = self.get()
+
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], '5')
+
+
+class TestEncodedResponses(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+
+        patcher = mock.patch.object(main, 'RESPONSE_CACHE', ResponseCache(60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the same whether or not brotli is installed
+        patcher = mock.patch.object(encoding, 'ENCODINGS', ['gzip'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.app = flask.Flask(__name__)
+        self.db.collection(main.LEADERBOARD_COLLECTION) \
+            .document(main.AVERAGE_LEADERBOARD_DOCID) \
+            .set(LEADERBOARD_SNAPSHOT)
+        self.db.collection(main.METADATA_COLLECTION) \
+            .document(main.ROUND_DOCID) \
+            .set({'latest_round': 450, 'version': 1})
+
+    def get(self, path='/', headers=None):
+        with self.app.test_request_context(path, headers=headers or {}):
+            return main.http_receiver(flask.request)
+
+    def test_gzip_when_accepted(self):
+        plain, _, plain_headers = self.get()
+        body, status, headers = self.get(
+            headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(body), plain)
+        self.assertNotIn('Content-Encoding', plain_headers)
+        self.assertNotEqual(headers['ETag'], plain_headers['ETag'])
+
+    def test_not_modified_per_encoding(self):
+        _, _, headers = self.get(headers={'Accept-Encoding': 'gzip'})
+
+        _, status, _ = self.get(headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+        _, plain_status, _ = self.get(
+            headers={'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 304)
+        self.assertEqual(plain_status, 200)
+
+    def test_compressed_once(self):
+        with mock.patch('response_cache.compress',
+                        wraps=encoding.compress) as compress:
+            first = self.get(headers={'Accept-Encoding': 'gzip'})
+            second = self.get(headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(first[0], second[0])
+
+    def test_small_bodies_not_compressed(self):
+        _, _, headers = self.get('/?limit=1',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_columnar_format(self):
+        rows = flask.json.loads(self.get()[0])
+        body, _, _ = self.get('/?format=columnar')
+        columns = flask.json.loads(body)
+
+        self.assertEqual(columns['count'], rows['count'])
+        self.assertEqual(columns['data']['username'],
+                         [row['username'] for row in rows['data']])
+        self.assertEqual(
+            [dict(zip(columns['data'], values))
+             for values in zip(*columns['data'].values())], rows['data'])
+
+    def test_unknown_format(self):
+        _, status, _ = self.get('/?format=xml')
+        self.assertEqual(status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time budget of a request, so a slow Firestore call fails the request's
+build in bounded time instead of holding it until the platform timeout.
+
+Code run inside `request_budget` passes `timeout=call_timeout()` to each
+Firestore call: the per-call timeout, cut down to what is left of the
+budget. A call that runs past it raises DeadlineExceeded from the client,
+and once the budget is spent `call_timeout` raises BudgetExceeded rather
+than start another call. Outside of a budget, calls have no timeout.
+
+Calls also pass `retry=None`: the client's default retry would retry a
+DeadlineExceeded for up to its own deadline of minutes, well past the
+budget.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the API functions.
+"""
+
+import contextvars
+import time
+
+from instrumentation import count
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a request has no time left for another Firestore call.
+    """
+
+
+class request_budget:
+    """
+    Gives the code run inside it `seconds` for all its Firestore calls,
+    and at most `per_call` seconds for each.
+
+    Parameters:
+        seconds (float): Budget of the request
+        per_call (float): Timeout of a single call
+        clock (callable): Returns the current time in seconds
+    """
+    __slots__ = ('_deadline', '_token')
+
+    def __init__(self, seconds, per_call, clock=time.monotonic):
+        self._deadline = (clock() + seconds, per_call, clock)
+
+    def __enter__(self):
+        self._token = _deadline.set(self._deadline)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _deadline.reset(self._token)
+        return False
+
+
+def call_timeout():
+    """
+    Returns the timeout of the next Firestore call, or None outside of a
+    budget.
+
+    Exception:
+        BudgetExceeded: when the budget is spent
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    expires, per_call, clock = deadline
+    remaining = expires - clock()
+    if remaining <= 0:
+        count('budget_exceeded')
+        raise BudgetExceeded('request budget spent')
+    return min(per_call, remaining)
@@ -15,14 +15,50 @@
 # limitations under the License.
 
 import functions_framework
-import traceback
-from google.cloud import firestore
-from flask import jsonify
+import os
+
+from clients import firestore_client
+from deadline import call_timeout, request_budget
+from encoding import COLUMNAR, ROWS, response_format, to_columns
+from instrumentation import annotate, count, invocation, sampled, span
+from pagination import BadRequest, bad_request, decode_cursor, \
+    encode_cursor, int_arg, page_limit
+from response_cache import FRESHNESS_HEADER, ResponseCache, \
+    cached_json_response
 
 METADATA_COLLECTION = u'metadata'
 SCORE_COLLECTION = u'scores'
 USER_COLLECTION = u'users'
 ROUND_DOCID = u'rounds'
+ROUND_STATS_COLLECTION = u'round_stats'
+ROUND_SERIES_COLLECTION = u'round_series'
+
+# rounds per page unless the request sets a limit
+ROUND_COUNT = 20
+
+# round series layout written by store-scores: SERIES_CHUNK_ROUNDS rounds
+# per doc, each with a histogram of ATTEMPT_KEYS in `attempts`
+SERIES_CHUNK_ROUNDS = 100
+ATTEMPT_KEYS = [u'1', u'2', u'3', u'4', u'5', u'6', u'X']
+
+# rounds of history unless the request sets a range, and the most served
+HISTORY_ROUND_COUNT = 100
+MAX_HISTORY_ROUNDS = 1000
+
+# seconds a response is served before checking the data version again
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '60'))
+
+# most responses kept by the instance
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+
+# seconds a request may spend on Firestore calls to build a response, and
+# on each call; past them the last good response is served, marked stale,
+# and rebuilt again after STALE_RETRY_SECONDS
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', '4'))
+CALL_TIMEOUT_SECONDS = float(os.environ.get('CALL_TIMEOUT_SECONDS', '2'))
+STALE_RETRY_SECONDS = int(os.environ.get('STALE_RETRY_SECONDS', '5'))
+RESPONSE_CACHE = ResponseCache(CACHE_TTL_SECONDS, retry=STALE_RETRY_SECONDS,
+                               max_size=RESPONSE_CACHE_SIZE)
 
 @functions_framework.http
 def http_receiver(request):
@@ -44,7 +80,7 @@ def http_receiver(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'GET',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
             'Access-Control-Max-Age': '3600'
         }
 
@@ -52,91 +88,257 @@ def http_receiver(request):
 
     # Set CORS headers for the main request
     headers = {
-        'Access-Control-Allow-Origin': '*'
-    }    
-    return (jsonify(fetch_per_round_best_attempt()), 200, headers)
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': f'ETag, {FRESHNESS_HEADER}'
+    }
+    with invocation('api-round-attempts'):
+        if request.path.rstrip('/').endswith('/history'):
+            return round_history_response(request, headers)
+        try:
+            params = {
+                'limit': page_limit(request, ROUND_COUNT),
+                'from_round': int_arg(request, 'from_round'),
+                'to_round': int_arg(request, 'to_round'),
+                'start_round': parse_cursor(decode_cursor(request))
+            }
+            shape = response_format(request)
+        except BadRequest as e:
+            annotate(status=400)
+            return bad_request(e, headers)
+
+        key = ('round-attempts', shape) + tuple(params.values())
+        with request_budget(REQUEST_BUDGET_SECONDS, CALL_TIMEOUT_SECONDS):
+            response = cached_json_response(
+                RESPONSE_CACHE, request, key, fetch_data_version,
+                lambda: build_response(shape, **params), headers)
+        annotate(status=response[1])
+        return response
+
+
+def round_history_response(request, headers):
+    """
+    Serves `/history`: the stats of every round from `from_round` to
+    `to_round`, oldest first.
+    """
+    annotate(endpoint='history')
+    try:
+        from_round = int_arg(request, 'from_round')
+        to_round = int_arg(request, 'to_round')
+        if None not in (from_round, to_round) and from_round > to_round:
+            raise BadRequest('from_round must not be after to_round')
+        shape = response_format(request)
+    except BadRequest as e:
+        annotate(status=400)
+        return bad_request(e, headers)
+
+    def build():
+        response = fetch_round_history(from_round, to_round)
+        if shape == COLUMNAR:
+            response = to_columns(response)
+        return response, True
+
+    with request_budget(REQUEST_BUDGET_SECONDS, CALL_TIMEOUT_SECONDS):
+        response = cached_json_response(
+            RESPONSE_CACHE, request,
+            ('round-history', shape, from_round, to_round),
+            fetch_data_version, build, headers)
+    annotate(status=response[1])
+    return response
+
+
+def build_response(shape=ROWS, **params):
+    """
+    Returns the response data and whether it may be cached.
+    """
+    response = fetch_per_round_best_attempt(**params)
+    if shape == COLUMNAR:
+        response = to_columns(response)
+    return response, True
+
 
+def parse_cursor(position):
+    """
+    Returns the round a cursor of this endpoint starts at.
 
-def fetch_per_round_best_attempt():
+    Exception:
+        BadRequest: when the cursor is not one of this endpoint's
+    """
+    if position is None:
+        return None
+    if type(position) is not int or position < 1:
+        raise BadRequest('cursor is invalid')
+    return position
+
+
+def fetch_data_version():
+    """
+    Returns the version store-scores and store-usernames bump in the rounds
+    metadata after every ingest that changed what the APIs serve.
+    """
+    db = firestore_client()
+    round_doc = db.collection(METADATA_COLLECTION).document(ROUND_DOCID) \
+        .get(timeout=call_timeout(), retry=None)
+    if not round_doc.exists:
+        return None
+    return round_doc.to_dict().get('version')
+
+
+def fetch_per_round_best_attempt(limit=ROUND_COUNT, from_round=None,
+                                 to_round=None, start_round=None):
     """
     Returns the best attempts for each round from Firestore
     The data should contain round information - round number, and score
     and number of users that solved in this many attempts
     Ordered by latest round first.
+
+    Parameters:
+        limit (int): Number of rounds on the page
+        from_round (int): Oldest round to return, or None for round 1
+        to_round (int): Newest round to return, or None for the latest
+        start_round (int): Newest round of the page, from the cursor
+
+    Returns:
+        The page of rounds with the cursor of the next, older page, which
+        is None on the last page
+
+    Exception:
+        Errors of the Firestore calls, such as DeadlineExceeded when one
+        runs past its timeout, and BudgetExceeded
     """
 
-    # initialize firestore client
-    db = firestore.Client()
-    round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
-    round_doc = round_ref.get()
+    # reuse the instance's firestore client
+    db = firestore_client()
+    bounds = [roundid for roundid in (start_round, to_round)
+              if roundid is not None]
+    start = min(bounds) if bounds else None
+    if start is None:
+        # the latest round is only read when the page does not start at a
+        # given round
+        round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+        with span('firestore.get'):
+            round_doc = round_ref.get(timeout=call_timeout(), retry=None)
+        count('docs_read')
 
-    if not round_doc.exists:
-        return get_canned_response()
+        start = round_doc.get('latest_round') if round_doc.exists else None
+        if start is None:
+            # no round has been played yet
+            return {"data": [], "count": 0, "next_cursor": None}
 
-    try:
-        data = []
-        score_ref = db.collection(SCORE_COLLECTION)
-        latest_round = round_doc.get('latest_round')
-        for roundid in range(latest_round, latest_round - 20, -1):
-            least_attempt_doc = score_ref \
-                .where(u'roundid', u'==', roundid) \
-                .where(u'attempts', u'>', 0) \
-                .order_by(u'attempts') \
-                .limit(1) \
-                .get()
-
-            if len(least_attempt_doc) == 0:
-                print(f"No attempts for round {roundid}!!!")
-            else:
-                best_attempt = least_attempt_doc[0].get('attempts')
-                best_attempt_count = 0
-                attempts_docs = score_ref \
-                    .where(u'roundid', u'==', roundid) \
-                    .where(u'attempts', u'==', best_attempt) \
-                    .stream()
-                best_attempt_count = len(list(attempts_docs))
-
-                data.append({
-                    u'roundid': roundid,
-                    u'best_attempt': best_attempt,
-                    u'user_count': best_attempt_count
-                })
-                print(f"Best attempt = {best_attempt} for round {roundid}" + 
-                        f" with {best_attempt_count} attempts")
-
-        return {
-            "data": data,
-            "count": len(data)
-        }
-    except Exception as e:
-        print(f"Encountered error {e}")
-        traceback.print_exc()
-        return get_canned_response()
+    data = []
+    round_stats_coll = db.collection(ROUND_STATS_COLLECTION)
+    lowest = from_round or 1
+    roundids = range(start, max(start - limit, lowest - 1), -1)
+    if not roundids:
+        return {"data": data, "count": 0, "next_cursor": None}
+    with span('firestore.get_all'):
+        round_stats = {int(doc.id): doc.to_dict()
+                       for doc in db.get_all(
+                           [round_stats_coll.document(str(roundid))
+                            for roundid in roundids],
+                           timeout=call_timeout(), retry=None)
+                       if doc.exists}
+    count('docs_read', len(roundids))
+
+    for roundid in roundids:
+        attempts = round_stats.get(roundid, {}).get('attempts', {})
+        best_attempt = next((attempt for attempt in range(1, 7)
+                             if attempts.get(str(attempt), 0) > 0), None)
+
+        if best_attempt is None:
+            count('rounds_without_attempts')
+            if sampled():
+                print(f"No attempts for round {roundid}")
+        else:
+            best_attempt_count = attempts[str(best_attempt)]
 
+            data.append({
+                u'roundid': roundid,
+                u'best_attempt': best_attempt,
+                u'user_count': best_attempt_count
+            })
+            if sampled():
+                print(f"Best attempt = {best_attempt} for round "
+                      f"{roundid} with {best_attempt_count} attempts")
 
-def get_canned_response():
+    return {
+        "data": data,
+        "count": len(data),
+        "next_cursor": encode_cursor(start - limit)
+        if start - limit >= lowest else None
+    }
+
+
+def fetch_round_history(from_round=None, to_round=None):
     """
-    Static json for respose format and as a backup.
+    Returns the players, failures and best attempt of each round of a
+    range, read from the round series with one doc per
+    SERIES_CHUNK_ROUNDS rounds. Rounds nobody played are left out.
+
+    Parameters:
+        from_round (int): Oldest round to return, or None for
+            HISTORY_ROUND_COUNT rounds up to `to_round`
+        to_round (int): Newest round to return, or None for the latest
+
+    Returns:
+        The rounds, oldest first, with the range served, which keeps the
+        newest MAX_HISTORY_ROUNDS rounds of a longer one
     """
-    response = {
-        "data": [
-            {
-                "roundid": 455,
-                "best_attempt": 2,
-                "user_count": 4               
-            },
-            {
-                "roundid": 454,
-                "best_attempt": 1,
-                "user_count": 1
-            },
-            {
-                "roundid": 453,
-                "best_attempt": 4,
-                "user_count": 53
-            }
-        ],
-        "count": 3
-    }
+    db = firestore_client()
+    if to_round is None:
+        round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+        with span('firestore.get'):
+            round_doc = round_ref.get(timeout=call_timeout(), retry=None)
+        count('docs_read')
+        to_round = round_doc.get('latest_round') if round_doc.exists \
+            else None
+        if to_round is None:
+            return {"data": [], "count": 0, "from_round": None,
+                    "to_round": None}
+    if from_round is None:
+        from_round = to_round - HISTORY_ROUND_COUNT + 1
+    from_round = max(from_round, to_round - MAX_HISTORY_ROUNDS + 1, 1)
+    if from_round > to_round:
+        return {"data": [], "count": 0, "from_round": from_round,
+                "to_round": to_round}
 
-    return response
+    series_coll = db.collection(ROUND_SERIES_COLLECTION)
+    refs = [series_coll.document(str(chunk)) for chunk in range(
+        from_round // SERIES_CHUNK_ROUNDS, to_round // SERIES_CHUNK_ROUNDS + 1)]
+    with span('firestore.get_all'):
+        chunks = sorted((doc.to_dict() for doc
+                         in db.get_all(refs, timeout=call_timeout(),
+                                       retry=None)
+                         if doc.exists),
+                        key=lambda chunk: chunk['first_round'])
+    count('docs_read', len(refs))
+
+    data = []
+    for chunk in chunks:
+        first_round = chunk['first_round']
+        for roundid in range(max(from_round, first_round),
+                             min(to_round + 1,
+                                 first_round + SERIES_CHUNK_ROUNDS)):
+            offset = roundid - first_round
+            players = chunk['players'][offset]
+            if not players:
+                continue
+            start = offset * len(ATTEMPT_KEYS)
+            attempts = chunk['attempts'][start:start + len(ATTEMPT_KEYS)]
+            best_attempt = next((index + 1 for index in range(6)
+                                 if attempts[index] > 0), None)
+            data.append({
+                u'roundid': roundid,
+                u'players': players,
+                u'failures': attempts[-1],
+                u'failure_rate': round(attempts[-1] / players, 4),
+                u'best_attempt': best_attempt,
+                u'user_count': attempts[best_attempt - 1]
+                if best_attempt else 0
+            })
+
+    return {
+        "data": data,
+        "count": len(data),
+        "from_round": from_round,
+        "to_round": to_round
+    }
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+import flask
+
+from fake_firestore import FakeClient
+from response_cache import FRESHNESS_HEADER, ResponseCache
+import clients
+import main
+
+
+def seed_rounds(db, histograms):
+    latest_round = max(histograms)
+    db.collection(main.METADATA_COLLECTION).document(main.ROUND_DOCID).set({
+        'latest_round': latest_round
+    })
+    for roundid, attempts in histograms.items():
+        db.collection(main.ROUND_STATS_COLLECTION).document(str(roundid)) \
+            .set({'players': sum(attempts.values()), 'attempts': attempts})
+
+
+def seed_series(db, histograms):
+    chunks = {}
+    for roundid, attempts in histograms.items():
+        chunk = roundid // main.SERIES_CHUNK_ROUNDS
+        series = chunks.setdefault(chunk, {
+            'first_round': chunk * main.SERIES_CHUNK_ROUNDS,
+            'players': [0] * main.SERIES_CHUNK_ROUNDS,
+            'attempts': [0] * main.SERIES_CHUNK_ROUNDS * 7
+        })
+        offset = roundid - series['first_round']
+        series['players'][offset] = sum(attempts.values())
+        for index, key in enumerate(main.ATTEMPT_KEYS):
+            series['attempts'][offset * 7 + index] = attempts.get(key, 0)
+    for chunk, series in chunks.items():
+        db.collection(main.ROUND_SERIES_COLLECTION).document(str(chunk)) \
+            .set(series)
+
+
+class TestFetchPerRoundBestAttempt(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+
+    def test_best_attempt_per_round(self):
+        seed_rounds(self.db, {
+            455: {'2': 4, '3': 10, 'X': 1},
+            454: {'1': 1, '4': 7},
+            453: {'X': 5},
+            452: {'4': 53, '5': 2},
+        })
+
+        response = main.fetch_per_round_best_attempt()
+
+        self.assertEqual(response, {
+            'data': [
+                {'roundid': 455, 'best_attempt': 2, 'user_count': 4},
+                {'roundid': 454, 'best_attempt': 1, 'user_count': 1},
+                {'roundid': 452, 'best_attempt': 4, 'user_count': 53},
+            ],
+            'count': 3,
+            'next_cursor': main.encode_cursor(435)
+        })
+
+    def test_single_batched_read(self):
+        seed_rounds(self.db, {
+            roundid: {'3': 1} for roundid in range(400, 500)})
+        self.db.reset_counts()
+
+        response = main.fetch_per_round_best_attempt()
+
+        self.assertEqual(response['count'], main.ROUND_COUNT)
+        self.assertEqual(self.db.rpc_counts['query'], 0)
+        self.assertEqual(self.db.rpc_counts['batch_get'], 1)
+        self.assertEqual(self.db.rpc_counts['get'], 1)
+
+    def test_http_receiver_caches_response(self):
+        seed_rounds(self.db, {455: {'2': 4}})
+        main.RESPONSE_CACHE.clear()
+        self.addCleanup(main.RESPONSE_CACHE.clear)
+        app = flask.Flask(__name__)
+
+        with app.test_request_context('/'):
+            body, status, headers = main.http_receiver(flask.request)
+        self.db.reset_counts()
+        with app.test_request_context(
+                '/', headers={'If-None-Match': headers['ETag']}):
+            _, not_modified, _ = main.http_receiver(flask.request)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(flask.json.loads(body)['data'][0]['roundid'], 455)
+        self.assertEqual(not_modified, 304)
+        self.assertEqual(self.db.rpcs, 0)
+
+    def test_no_rounds_yet(self):
+        response = main.fetch_per_round_best_attempt()
+        self.assertEqual(response,
+                         {'data': [], 'count': 0, 'next_cursor': None})
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        main.RESPONSE_CACHE.clear()
+        self.addCleanup(main.RESPONSE_CACHE.clear)
+        self.app = flask.Flask(__name__)
+
+        seed_rounds(self.db, {
+            roundid: {'3': roundid} for roundid in range(1, 131)})
+
+    def get(self, path):
+        with self.app.test_request_context(path):
+            body, status, headers = main.http_receiver(flask.request)
+        return flask.json.loads(body), status, headers
+
+    def test_pages_through_every_round(self):
+        roundids = []
+        path = '/?limit=40'
+        while path:
+            self.db.reset_counts()
+            response, status, _ = self.get(path)
+            self.assertEqual(status, 200)
+            # the version, the latest round on the first page only, and
+            # one batched read of the page
+            self.assertLessEqual(self.db.doc_reads, 40 + 2)
+            roundids.extend(item['roundid'] for item in response['data'])
+            cursor = response['next_cursor']
+            path = f'/?limit=40&cursor={cursor}' if cursor else None
+
+        self.assertEqual(roundids, list(range(130, 0, -1)))
+
+    def test_round_range(self):
+        response, _, _ = self.get('/?from_round=95&to_round=100&limit=4')
+
+        self.assertEqual([item['roundid'] for item in response['data']],
+                         [100, 99, 98, 97])
+
+        response, _, _ = self.get(
+            f"/?from_round=95&to_round=100&limit=4"
+            f"&cursor={response['next_cursor']}")
+
+        self.assertEqual([item['roundid'] for item in response['data']],
+                         [96, 95])
+        self.assertIsNone(response['next_cursor'])
+
+    def test_range_reads_no_metadata(self):
+        self.db.reset_counts()
+
+        response = main.fetch_per_round_best_attempt(
+            limit=5, to_round=50)
+
+        self.assertEqual(response['count'], 5)
+        self.assertEqual(self.db.rpc_counts, {'batch_get': 1})
+
+    def test_limit_is_capped(self):
+        response, _, _ = self.get('/?limit=1000')
+        self.assertEqual(response['count'], 100)
+
+    def test_rejects_bad_parameters(self):
+        for path in ('/?limit=-1', '/?from_round=x', '/?to_round=0',
+                     '/?cursor=!!', '/?cursor=ImEi'):
+            response, status, headers = self.get(path)
+
+            self.assertEqual(status, 400, path)
+            self.assertIn('error', response)
+            self.assertEqual(headers['Cache-Control'], 'no-store')
+
+
+class TestRoundHistory(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        main.RESPONSE_CACHE.clear()
+        self.addCleanup(main.RESPONSE_CACHE.clear)
+        self.app = flask.Flask(__name__)
+
+        histograms = {roundid: {'3': roundid % 50, '5': 2, 'X': 1}
+                      for roundid in range(1, 481)}
+        seed_rounds(self.db, histograms)
+        seed_series(self.db, histograms)
+
+    def get(self, path):
+        with self.app.test_request_context(path):
+            body, status, headers = main.http_receiver(flask.request)
+        return flask.json.loads(body), status, headers
+
+    def test_reads_a_doc_per_chunk(self):
+        self.db.reset_counts()
+
+        response = main.fetch_round_history(from_round=95, to_round=405)
+
+        self.assertEqual(self.db.rpc_counts, {'batch_get': 1})
+        self.assertEqual(self.db.doc_reads, 5)
+        self.assertEqual(response['count'], 311)
+        self.assertEqual(
+            [item['roundid'] for item in response['data']],
+            list(range(95, 406)))
+        self.assertEqual(response['data'][5], {
+            'roundid': 100,
+            'players': 3,
+            'failures': 1,
+            'failure_rate': 0.3333,
+            'best_attempt': 5,
+            'user_count': 2
+        })
+        self.assertEqual(response['data'][6]['best_attempt'], 3)
+
+    def test_defaults_to_the_latest_rounds(self):
+        response, status, _ = self.get('/history')
+
+        self.assertEqual(status, 200)
+        self.assertEqual((response['from_round'], response['to_round']),
+                         (381, 480))
+        self.assertEqual(response['count'], main.HISTORY_ROUND_COUNT)
+
+    def test_matches_round_stats(self):
+        history = main.fetch_round_history(from_round=431, to_round=450)
+        best = main.fetch_per_round_best_attempt(from_round=431,
+                                                 to_round=450)
+
+        self.assertEqual(
+            [{key: item[key] for key in ('roundid', 'best_attempt',
+                                         'user_count')}
+             for item in reversed(history['data'])],
+            best['data'])
+
+    def test_caps_the_range(self):
+        with mock.patch.object(main, 'MAX_HISTORY_ROUNDS', 150):
+            response = main.fetch_round_history(from_round=1)
+
+        self.assertEqual(response['from_round'], 331)
+        self.assertEqual(response['data'][-1]['roundid'], 480)
+
+    def test_columnar(self):
+        response, _, _ = self.get(
+            '/history/?from_round=10&to_round=12&format=columnar')
+        self.assertEqual(response['data']['roundid'], [10, 11, 12])
+
+    def test_rejects_bad_range(self):
+        response, status, _ = self.get('/history?from_round=9&to_round=3')
+        self.assertEqual(status, 400)
+        self.assertIn('error', response)
+
+
+class TestRequestBudget(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        self.cache = ResponseCache(60, clock=lambda: self.now)
+        self.now = 1000.0
+        for name, value in (('RESPONSE_CACHE', self.cache),
+                            ('CALL_TIMEOUT_SECONDS', 0.01)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = flask.Flask(__name__)
+
+        histograms = {449: {'3': 2}, 450: {'2': 1, '4': 3}}
+        seed_rounds(self.db, histograms)
+        seed_series(self.db, histograms)
+
+    def get(self, path):
+        with self.app.test_request_context(path):
+            return main.http_receiver(flask.request)
+
+    def test_slow_firestore_serves_last_good_response(self):
+        for path in ('/', '/history'):
+            first, _, headers = self.get(path)
+            self.assertEqual(headers[FRESHNESS_HEADER], 'fresh')
+            self.db.latency = 0.05
+            self.now += 61
+
+            body, status, headers = self.get(path)
+
+            self.assertEqual(status, 200, path)
+            self.assertEqual(body, first)
+            self.assertEqual(headers[FRESHNESS_HEADER], 'stale')
+            self.db.latency = 0
+
+    def test_slow_firestore_without_response(self):
+        self.db.latency = 0.05
+        for path in ('/', '/history'):
+            body, status, headers = self.get(path)
+
+            self.assertEqual(status, 503, path)
+            self.assertIn('error', flask.json.loads(body))
+            self.assertEqual(headers['Cache-Control'], 'no-store')
+
+
+if __name__ == "__main__":
+    unittest.main()
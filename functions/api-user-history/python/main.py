@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functions_framework
+import hashlib
+import json
+import os
+
+from clients import firestore_client
+from deadline import call_timeout, request_budget
+from encoding import COLUMNAR, compress, negotiate_encoding, \
+    response_format, to_columns
+from instrumentation import annotate, count, invocation, span
+from pagination import BadRequest, bad_request
+from scoring import stored_score
+
+USER_COLLECTION = u'users'
+
+STAT_FIELDS = [u'rounds_played', u'last_round', u'average_score',
+               u'total_score', u'max_streak', u'current_streak']
+
+# round history layout written by store-scores: a byte per round from
+# `rounds_base`, holding the attempts, FAILED_CODE for a failed round, or
+# 0 when the round was not played or was played before the history was
+# kept, with HARD_MODE_BIT set in hard mode
+FAILED_CODE = 7
+HARD_MODE_BIT = 0x80
+ATTEMPT_KEYS = [u'1', u'2', u'3', u'4', u'5', u'6', u'X']
+
+# seconds clients and proxies may reuse a response
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '60'))
+
+# seconds a request may spend on Firestore calls, and on each call; past
+# them a 503 tells the client to retry after STALE_RETRY_SECONDS
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', '4'))
+CALL_TIMEOUT_SECONDS = float(os.environ.get('CALL_TIMEOUT_SECONDS', '2'))
+STALE_RETRY_SECONDS = int(os.environ.get('STALE_RETRY_SECONDS', '5'))
+
+@functions_framework.http
+def http_receiver(request):
+    """
+    HTTP Trigger called when this function is called via HTTP
+
+    Parameters:
+        request (flask.Request): The request object.
+        <https://flask.palletsprojects.com/en/1.1.x/api/#incoming-request-data>
+    Returns:
+        The response text, or any set of values that can be turned into a
+        Response object using `make_response`
+        <https://flask.palletsprojects.com/en/1.1.x/api/#flask.make_response>
+    """
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        # Allows GET requests from any origin with the Content-Type
+        # header and caches preflight response for an 3600s
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+            'Access-Control-Max-Age': '3600'
+        }
+
+        return ('', 204, headers)
+
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+    with invocation('api-user-history'):
+        try:
+            userid = user_arg(request)
+            shape = response_format(request)
+        except BadRequest as e:
+            annotate(status=400)
+            return bad_request(e, headers)
+
+        try:
+            with request_budget(REQUEST_BUDGET_SECONDS,
+                                CALL_TIMEOUT_SECONDS):
+                response = fetch_user_history(userid)
+        except Exception as e:
+            print(f"Could not read the history of user {userid} {e}")
+            count('unavailable_responses')
+            annotate(status=503)
+            headers['Content-Type'] = 'application/json'
+            headers['Cache-Control'] = 'no-store'
+            headers['Retry-After'] = str(STALE_RETRY_SECONDS)
+            return (json.dumps({'error': 'data is temporarily unavailable'}),
+                    503, headers)
+        if response is None:
+            annotate(status=404)
+            headers['Content-Type'] = 'application/json'
+            headers['Cache-Control'] = 'no-store'
+            return (json.dumps({'error': f'user {userid} not found'}), 404,
+                    headers)
+        if shape == COLUMNAR:
+            response = to_columns(response)
+
+        response = json_response(request, response, headers)
+        annotate(status=response[1])
+        return response
+
+
+def user_arg(request):
+    """
+    Returns the `userid` query parameter.
+
+    Exception:
+        BadRequest: when it is missing or is not a valid document id
+    """
+    userid = request.args.get('userid')
+    if not userid:
+        raise BadRequest('userid is required')
+    if '/' in userid or userid in ('.', '..'):
+        raise BadRequest('userid is invalid')
+    return userid
+
+
+def json_response(request, data, headers):
+    """
+    Serializes a response with a strong ETag, answering a matching
+    `If-None-Match` with a 304. The body is compressed when the request
+    accepts it.
+    """
+    with span('serialize'):
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    encoding = negotiate_encoding(request, len(body))
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    if encoding:
+        etag = f'{etag}-{encoding}'
+
+    headers = dict(headers)
+    headers['Content-Type'] = 'application/json'
+    headers['Vary'] = 'Accept-Encoding'
+    headers['ETag'] = f'"{etag}"'
+    headers['Cache-Control'] = f'public, max-age={CACHE_TTL_SECONDS}'
+    if request.if_none_match.contains(etag):
+        count('not_modified')
+        return ('', 304, headers)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        with span('compress'):
+            body = compress(body, encoding)
+    return (body, 200, headers)
+
+
+def fetch_user_history(userid):
+    """
+    Returns a user's stats, attempt distribution and round history, from
+    a single read of their user doc.
+
+    Parameters:
+        userid (str): Id of the user
+
+    Returns:
+        The response data, or None when the user has no doc
+    """
+    # reuse the instance's firestore client
+    db = firestore_client()
+    with span('firestore.get'):
+        user_doc = db.collection(USER_COLLECTION).document(userid) \
+            .get(timeout=call_timeout(), retry=None)
+    count('docs_read')
+    if not user_doc.exists:
+        return None
+
+    user_doc = user_doc.to_dict()
+    data = decode_history(user_doc)
+    distribution = {key: 0 for key in ATTEMPT_KEYS}
+    for item in data:
+        if item['attempts'] is not None:
+            distribution[str(item['attempts']) if item['attempts']
+                         else u'X'] += 1
+
+    return {
+        "userid": userid,
+        "stats": {field: user_doc.get(field) for field in STAT_FIELDS},
+        "distribution": distribution,
+        "data": data,
+        "count": len(data)
+    }
+
+
+def decode_history(user_doc):
+    """
+    Returns the rounds a user played, oldest first, with the attempts
+    (0 for a failed round), the score and the hard mode flag of each. The
+    three are None for a round played before the history was kept.
+
+    Parameters:
+        user_doc (dict): The user doc written by store-scores
+    """
+    base = user_doc.get(u'rounds_base')
+    if base is None:
+        return []
+    played = int.from_bytes(user_doc.get(u'played_bits') or b'', 'little')
+    history = user_doc.get(u'round_history') or b''
+
+    data = []
+    position = 0
+    while played:
+        if played & 1:
+            code = history[position] if position < len(history) else 0
+            item = {u'roundid': base + position, u'attempts': None,
+                    u'score': None, u'hard_mode': None}
+            if code:
+                attempts = code & ~HARD_MODE_BIT
+                attempts = 0 if attempts == FAILED_CODE else attempts
+                item[u'attempts'] = attempts
+                item[u'score'] = stored_score(attempts)
+                item[u'hard_mode'] = bool(code & HARD_MODE_BIT)
+            data.append(item)
+        played >>= 1
+        position += 1
+    return data
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+import flask
+
+from fake_firestore import FakeClient
+import clients
+import main
+
+
+class TestUserHistory(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        clients.reset()
+        patcher = mock.patch.object(
+            clients, '_new_firestore_client', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        self.app = flask.Flask(__name__)
+
+        # rounds 448 to 452: 448 before the history was kept, 449 skipped,
+        # 451 failed and 452 in hard mode
+        self.db.collection(main.USER_COLLECTION).document('u1').set({
+            'userid': 'u1',
+            'rounds_played': 4,
+            'last_round': 452,
+            'average_score': 2.5,
+            'total_score': 10,
+            'max_streak': 2,
+            'current_streak': 1,
+            'rounds_base': 448,
+            'played_bits': bytes([0b11101]),
+            'scored_bits': bytes([0b10101]),
+            'round_history': bytes([0, 0, 3, 7, 0x82])
+        })
+        self.db.reset_counts()
+
+    def get(self, path, **headers):
+        with self.app.test_request_context(path, headers=headers):
+            body, status, headers = main.http_receiver(flask.request)
+        return (flask.json.loads(body) if body else None), status, headers
+
+    def test_single_read(self):
+        response, status, headers = self.get('/?userid=u1')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.db.rpc_counts, {'get': 1})
+        self.assertEqual(response['stats']['rounds_played'], 4)
+        self.assertEqual(response['distribution'], {
+            '1': 0, '2': 1, '3': 1, '4': 0, '5': 0, '6': 0, 'X': 1})
+        self.assertEqual(response['data'], [
+            {'roundid': 448, 'attempts': None, 'score': None,
+             'hard_mode': None},
+            {'roundid': 450, 'attempts': 3, 'score': 4, 'hard_mode': False},
+            {'roundid': 451, 'attempts': 0, 'score': 0, 'hard_mode': False},
+            {'roundid': 452, 'attempts': 2, 'score': 5, 'hard_mode': True},
+        ])
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+
+    def test_unavailable_when_firestore_times_out(self):
+        self.db.latency = 0.05
+        with mock.patch.object(main, 'CALL_TIMEOUT_SECONDS', 0.01):
+            response, status, headers = self.get('/?userid=u1')
+
+        self.assertEqual(status, 503)
+        self.assertIn('error', response)
+        self.assertEqual(headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+        self.assertEqual(headers['Retry-After'],
+                         str(main.STALE_RETRY_SECONDS))
+
+    def test_not_modified(self):
+        _, _, headers = self.get('/?userid=u1')
+        body, status, _ = self.get('/?userid=u1',
+                                   **{'If-None-Match': headers['ETag']})
+
+        self.assertEqual(status, 304)
+        self.assertIsNone(body)
+
+    def test_columnar(self):
+        response, _, _ = self.get('/?userid=u1&format=columnar')
+        self.assertEqual(response['data']['roundid'], [448, 450, 451, 452])
+
+    def test_unknown_user(self):
+        response, status, headers = self.get('/?userid=u2')
+
+        self.assertEqual(status, 404)
+        self.assertIn('error', response)
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+
+    def test_rejects_bad_parameters(self):
+        for path in ('/', '/?userid=a/b', '/?userid=u1&format=csv'):
+            response, status, _ = self.get(path)
+
+            self.assertEqual(status, 400, path)
+            self.assertIn('error', response)
+        self.assertEqual(self.db.rpcs, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rebuilds the `rank_index` docs from the stats of every user doc. Run it
+once before deploying the store-scores that maintains the index, or while
+no ingest runs, since increments made during the rebuild are overwritten.
+
+Usage:
+    python backfill_rank_index.py [--project PROJECT] [--dry-run]
+"""
+
+import argparse
+
+from rank_index import rank_index_ref, rebuild_rank_index
+from schema import USER_COLLECTION
+
+
+def backfill_rank_index(db, dry_run=False):
+    """
+    Recomputes the rank index from the user docs and overwrites its docs.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        dry_run (bool): Only compute the index
+
+    Returns:
+        Dictionary of index docs keyed by doc id
+    """
+    user_docs = (doc.to_dict() for doc in db.collection(USER_COLLECTION)
+                 .select([u'average_score', u'total_score'])
+                 .stream())
+    index = rebuild_rank_index(user_docs)
+
+    if not dry_run:
+        batch = db.batch()
+        for docid, index_doc in index.items():
+            batch.set(rank_index_ref(db, docid), index_doc)
+        batch.commit()
+
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild the rank index from the user docs.')
+    parser.add_argument('--project', help='Google Cloud project id')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='compute the index without writing it')
+    args = parser.parse_args()
+
+    from google.cloud import firestore
+    db = firestore.Client(project=args.project)
+    index = backfill_rank_index(db, dry_run=args.dry_run)
+    users = sum(count for index_doc in index.values()
+                for buckets in index_doc['counts'].values()
+                for count in buckets.values())
+    print(f"Indexed {users} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rebuilds every `round_stats` histogram, the `round_series` chunks and the
+`round_counters` shards from the `scores` collection. The totals are
+written to the first shard and the other shards are reset.
+
+Usage:
+    python backfill_round_stats.py [--project PROJECT] [--dry-run]
+"""
+
+import argparse
+
+from ingest import MAX_BATCH_WRITES, chunked
+from round_counters import rebuild_round_totals, totals_writes
+from round_series import rebuild_round_series, series_ref
+from round_stats import rebuild_round_stats, round_stats_ref
+from schema import SCORE_COLLECTION
+
+
+def backfill_round_stats(db, dry_run=False):
+    """
+    Recomputes the histograms and totals of all rounds and overwrites the
+    round stats docs, series chunks and counter shards with them.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        dry_run (bool): Only compute the histograms and totals
+
+    Returns:
+        Dictionary of round stats docs keyed by roundid
+    """
+    score_docs = [doc.to_dict() for doc in db.collection(SCORE_COLLECTION)
+                  .select([u'roundid', u'attempts', u'score'])
+                  .stream()]
+    histograms = rebuild_round_stats(score_docs)
+    series = rebuild_round_series(histograms)
+    totals = rebuild_round_totals(score_docs)
+
+    if not dry_run:
+        for chunk in chunked(sorted(histograms), MAX_BATCH_WRITES):
+            batch = db.batch()
+            for roundid in chunk:
+                batch.set(round_stats_ref(db, roundid), histograms[roundid])
+            batch.commit()
+
+        for chunk in chunked(sorted(series), MAX_BATCH_WRITES):
+            batch = db.batch()
+            for series_chunk in chunk:
+                batch.set(series_ref(db, series_chunk), series[series_chunk])
+            batch.commit()
+
+        for chunk in chunked(totals_writes(db, totals), MAX_BATCH_WRITES):
+            batch = db.batch()
+            for doc_ref, data in chunk:
+                batch.set(doc_ref, data)
+            batch.commit()
+
+    return histograms
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild the per-round attempt histograms, the round '
+                    'series and the round counters.')
+    parser.add_argument('--project', help='Google Cloud project id')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='compute the histograms and totals without '
+                             'writing them')
+    args = parser.parse_args()
+
+    from google.cloud import firestore
+    db = firestore.Client(project=args.project)
+    histograms = backfill_round_stats(db, dry_run=args.dry_run)
+    print(f"Rebuilt {len(histograms)} rounds")
+
+
+if __name__ == "__main__":
+    main()
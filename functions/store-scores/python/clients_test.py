@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import clients
+
+
+class TestClients(unittest.TestCase):
+    def setUp(self):
+        clients.reset()
+        self.addCleanup(clients.reset)
+
+    def test_client_created_once(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        with mock.patch.object(clients, '_new_firestore_client', factory):
+            first = clients.firestore_client()
+            second = clients.firestore_client()
+
+        self.assertIs(first, second)
+        self.assertEqual(factory.call_count, 1)
+
+    def test_reset_creates_new_client(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        with mock.patch.object(clients, '_new_storage_client', factory):
+            first = clients.storage_client()
+            clients.reset()
+            second = clients.storage_client()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(factory.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
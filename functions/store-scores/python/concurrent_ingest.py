@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Concurrent ingest of scores, sharded by user.
+
+A user's stats are a read-modify-write that depends on the order of the
+user's scores, so every score of a user is routed to the same worker,
+which ingests its scores in the order they were submitted. Different
+users are ingested by different workers in parallel.
+
+The workers do share docs. Every worker's batches increment the same
+`rank_index` docs and one shard of each round counter. Increments carry no
+precondition, so they never make a batch fail or retry. Firestore still
+applies the writes to one doc one at a time, so these docs are the
+contended ones and bound how fast the workers write. Each batch sums its
+increments into one write per doc, so a worker adds one write per batch
+to each of them, not one per score.
+
+Each worker has a bounded queue: `submit` blocks while the worker of that
+user is busy, so reading the file never runs ahead of the writes by more
+than `queue_size` scores per worker. A worker drains whatever is queued,
+up to `batch_size` scores, into one `ingest_scores` call. `flush` waits
+until every score submitted so far is ingested, so a caller can checkpoint
+the input read up to there.
+"""
+
+import contextvars
+import queue
+import threading
+import zlib
+
+from ingest import MAX_GET_ALL, ingest_scores
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_QUEUE_SIZE = 2000
+
+_DONE = object()
+
+
+class ShardedIngest:
+    """
+    Pool of ingest workers, one queue each, with the scores of a user
+    always going to the same worker.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        concurrency (int): Number of workers
+        queue_size (int): Scores buffered per worker before `submit` blocks
+        batch_size (int): Most scores a worker ingests at a time
+        ingest (callable): Ingests a list of scores and returns the summary,
+            `ingest.ingest_scores` by default
+    """
+
+    def __init__(self, db, concurrency=DEFAULT_CONCURRENCY,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=MAX_GET_ALL,
+                 ingest=ingest_scores):
+        if concurrency < 1:
+            raise ValueError(f'Concurrency of {concurrency} is invalid')
+        self._db = db
+        self._batch_size = batch_size
+        self._ingest = ingest
+        self._queues = [queue.Queue(maxsize=queue_size)
+                        for _ in range(concurrency)]
+        self._lock = threading.Lock()
+        # signalled whenever the scores submitted are all ingested
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._failed = threading.Event()
+        self._errors = []
+        self._closed = False
+        self.summary = {
+            u'scores_written': 0,
+            u'duplicates_skipped': 0,
+            u'users_updated': 0
+        }
+        # each worker records its spans into the caller's invocation
+        self._workers = [
+            threading.Thread(target=contextvars.copy_context().run,
+                             args=(self._work, q), daemon=True)
+            for q in self._queues]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def shard(self, userid):
+        """
+        Returns the index of the worker that ingests `userid`'s scores.
+        """
+        return zlib.crc32(str(userid).encode('utf-8')) % len(self._queues)
+
+    def submit(self, score_doc):
+        """
+        Queues a score for its user's worker, blocking while that worker's
+        queue is full.
+
+        Parameters:
+            score_doc (Object): A dictionary of score, roundid, userid,
+                tweetid
+
+        Exception:
+            Exception: the error a worker failed with
+        """
+        with self._lock:
+            self._pending += 1
+        self._put(self._queues[self.shard(score_doc['userid'])], score_doc)
+
+    def flush(self):
+        """
+        Waits for every score submitted so far to be ingested, keeping the
+        workers running.
+
+        Returns:
+            The summary so far, like `close`
+
+        Exception:
+            Exception: the first error a worker failed with
+        """
+        with self._idle:
+            while self._pending and not self._failed.is_set():
+                self._idle.wait(0.1)
+        self._raise_error()
+        return dict(self.summary)
+
+    def close(self):
+        """
+        Waits for every queued score to be ingested and stops the workers.
+
+        Returns:
+            Dictionary with the number of scores written, duplicates skipped
+            and users updated, summed over the workers' batches
+
+        Exception:
+            Exception: the first error a worker failed with
+        """
+        if not self._closed:
+            self._closed = True
+            for q in self._queues:
+                self._put(q, _DONE, raise_error=False)
+            for worker in self._workers:
+                worker.join()
+        self._raise_error()
+        return dict(self.summary)
+
+    def abort(self):
+        """
+        Stops the workers without waiting for the queued scores.
+        """
+        self._closed = True
+        self._failed.set()
+        for worker in self._workers:
+            worker.join()
+
+    def _put(self, q, item, raise_error=True):
+        while not self._failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def _work(self, q):
+        done = False
+        while not done and not self._failed.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+
+            score_docs = [item]
+            while len(score_docs) < self._batch_size:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                score_docs.append(item)
+
+            try:
+                summary = self._ingest(self._db, score_docs)
+            except Exception as e:
+                print(f"Encountered error {e}")
+                with self._lock:
+                    self._errors.append(e)
+                self._failed.set()
+                return
+
+            with self._lock:
+                for key, value in summary.items():
+                    self.summary[key] = self.summary.get(key, 0) + value
+                self._pending -= len(score_docs)
+                if not self._pending:
+                    self._idle.notify_all()
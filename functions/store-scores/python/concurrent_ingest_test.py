@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from concurrent_ingest import ShardedIngest
+from ingest_test import make_tweets
+from main import save_scores, write_and_update_score
+from round_counters import read_round_totals
+from schema import ROUND_STATS_COLLECTION, SCORE_COLLECTION, \
+    USER_COLLECTION
+
+
+def ingest_concurrently(db, score_docs, **kwargs):
+    with ShardedIngest(db, **kwargs) as pipeline:
+        for score_doc in score_docs:
+            pipeline.submit(score_doc)
+        return pipeline.close()
+
+
+class TestShardedIngest(unittest.TestCase):
+    def test_matches_sequential_path(self):
+        # rounds out of order, so streaks depend on each user's order
+        score_docs = make_tweets(users=50, rounds=8)
+        score_docs = score_docs[200:] + score_docs[:200]
+
+        sequential_db = FakeClient()
+        for score_doc in score_docs:
+            write_and_update_score(sequential_db, score_doc)
+
+        concurrent_db = FakeClient()
+        summary = ingest_concurrently(
+            concurrent_db, score_docs, concurrency=4, batch_size=7)
+
+        self.assertEqual(summary['scores_written'], 400)
+        for collection in (USER_COLLECTION, SCORE_COLLECTION):
+            self.assertEqual(concurrent_db.dump(collection),
+                             sequential_db.dump(collection))
+        self.assertEqual(read_round_totals(concurrent_db, range(400, 408)),
+                         read_round_totals(sequential_db, range(400, 408)))
+
+    def test_skips_duplicates_across_batches(self):
+        score_docs = make_tweets(users=10, rounds=3)
+        db = FakeClient()
+
+        summary = ingest_concurrently(
+            db, score_docs + score_docs, concurrency=3, batch_size=4)
+
+        self.assertEqual(summary['scores_written'], 30)
+        self.assertEqual(summary['duplicates_skipped'], 30)
+        self.assertEqual(len(db.dump(SCORE_COLLECTION)), 30)
+
+    def test_keeps_each_users_order(self):
+        calls = []
+        lock = threading.Lock()
+
+        def record(db, score_docs):
+            with lock:
+                calls.extend(score_docs)
+            return {'scores_written': len(score_docs)}
+
+        score_docs = make_tweets(users=30, rounds=10)
+        ingest_concurrently(FakeClient(), score_docs, concurrency=5,
+                            batch_size=3, ingest=record)
+
+        self.assertEqual(len(calls), len(score_docs))
+        for user in range(30):
+            userid = f'user{user}'
+            self.assertEqual(
+                [doc['roundid'] for doc in calls if doc['userid'] == userid],
+                [doc['roundid'] for doc in score_docs
+                 if doc['userid'] == userid])
+
+    def test_runs_users_in_parallel(self):
+        # each call waits until another worker is ingesting at the same time
+        both_running = threading.Barrier(2, timeout=5)
+
+        def ingest(db, score_docs):
+            both_running.wait()
+            return {'scores_written': len(score_docs)}
+
+        pipeline = ShardedIngest(FakeClient(), concurrency=2, ingest=ingest)
+        userids = ['a', 'b', 'c', 'd']
+        first = next(u for u in userids if pipeline.shard(u) == 0)
+        second = next(u for u in userids if pipeline.shard(u) == 1)
+        pipeline.submit({'userid': first})
+        pipeline.submit({'userid': second})
+
+        self.assertEqual(pipeline.close()['scores_written'], 2)
+
+    def test_submit_blocks_when_queue_is_full(self):
+        release = threading.Event()
+
+        def ingest(db, score_docs):
+            release.wait(timeout=5)
+            return {'scores_written': len(score_docs)}
+
+        pipeline = ShardedIngest(FakeClient(), concurrency=1, queue_size=2,
+                                 batch_size=1, ingest=ingest)
+        submitted = []
+
+        def produce():
+            for i in range(5):
+                pipeline.submit({'userid': 'user'})
+                submitted.append(i)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(timeout=0.5)
+
+        # one score being ingested and two queued
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(len(submitted), 3)
+
+        release.set()
+        producer.join(timeout=5)
+        self.assertEqual(pipeline.close()['scores_written'], 5)
+
+    def test_flush_waits_for_submitted_scores(self):
+        db = FakeClient()
+        pipeline = ShardedIngest(db, concurrency=3, batch_size=4)
+        for score_doc in make_tweets(users=10, rounds=3):
+            pipeline.submit(score_doc)
+
+        self.assertEqual(pipeline.flush()['scores_written'], 30)
+        self.assertEqual(len(db.dump(SCORE_COLLECTION)), 30)
+        # the workers keep taking scores after a flush
+        for score_doc in make_tweets(users=10, rounds=4):
+            pipeline.submit(score_doc)
+        self.assertEqual(pipeline.close()['scores_written'], 40)
+
+    def test_raises_worker_errors(self):
+        def fail(db, score_docs):
+            raise ValueError('commit failed')
+
+        pipeline = ShardedIngest(FakeClient(), concurrency=2, ingest=fail)
+        with self.assertRaises(ValueError):
+            for score_doc in make_tweets(users=10, rounds=100):
+                pipeline.submit(score_doc)
+            pipeline.close()
+
+
+class TestConcurrentMode(unittest.TestCase):
+    def test_save_scores(self):
+        tweets = [{
+            'tweetId': f'{roundid}-{user}',
+            'authorId': f'user{user}',
+            'tweet': f'Wordle {roundid} {user % 6 + 1}/6'
+        } for roundid in range(400, 405) for user in range(40)]
+        tweets.append({'tweetId': 'bad', 'authorId': 'x', 'tweet': 'hello'})
+
+        batched_db = FakeClient()
+        save_scores(batched_db, tweets)
+
+        concurrent_db = FakeClient()
+        with mock.patch('main.INGEST_MODE', 'concurrent'):
+            self.assertEqual(save_scores(concurrent_db, tweets), 200)
+
+        for collection in (USER_COLLECTION, SCORE_COLLECTION,
+                           ROUND_STATS_COLLECTION):
+            self.assertEqual(concurrent_db.dump(collection),
+                             batched_db.dump(collection))
+        self.assertEqual(
+            concurrent_db.dump('metadata')['rounds']['latest_round'], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
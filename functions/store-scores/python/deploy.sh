@@ -19,3 +19,26 @@ gcloud functions deploy store-scores \
 --region=us-west1 \
 --source=. \
 --entry-point="event_receiver"
+
+# With INGEST_MODE=log, the score log is compacted by a second function
+# that Cloud Scheduler calls periodically:
+#
+# gcloud functions deploy store-scores-compact \
+# --gen2 \
+# --trigger-http \
+# --runtime=python310 \
+# --region=us-west1 \
+# --source=. \
+# --entry-point="compact_receiver"
+#
+# gcloud scheduler jobs create http compact-scores \
+# --location=us-west1 \
+# --schedule="*/5 * * * *" \
+# --uri="$(gcloud functions describe store-scores-compact --gen2 \
+#     --region=us-west1 --format='value(serviceConfig.uri)')"
+#
+# With COALESCE_WINDOW_SECONDS set, e.g. --set-env-vars=COALESCE_WINDOW_SECONDS=30,
+# a burst of tweets files is ingested as one batch by the first event's run.
+# Its timeout must cover the window and the burst:
+#
+# --timeout=300
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fan-in of bursts of tweets files into one ingest run.
+
+fetch-tweets writes a `tweets-<timestamp>.json` object per fetch, and a
+catch-up writes dozens at once. Ingesting them one event at a time writes
+every active user's doc once per file. With COALESCE_WINDOW_SECONDS set,
+the event of each object instead tries to claim the bucket's window doc in
+`ingest_windows`:
+
+    {
+        "holder": "3f9c...",        id of the run holding the window
+        "expires_at": 1665000120.0, refreshed for every burst
+        "watermark": "tweets-1665000000000.json"
+    }
+
+The run that claims it waits out the window, lists the objects from the
+watermark on, and ingests the ones no ledger marks done as one batch.
+Events that find the window held return at once; their objects are
+picked up by the holder, which lists again after releasing the window.
+
+Object names sort by the fetch timestamp, and every object before the
+watermark is done, so a listing only returns the recent objects.
+"""
+
+import time
+import uuid
+from urllib.parse import quote
+
+from ingest import MAX_GET_ALL, chunked
+from instrumentation import count, span
+from ledger import LEASE_SECONDS, LEDGER_COLLECTION, ledger_docid
+
+WINDOW_COLLECTION = u'ingest_windows'
+
+TWEETS_PREFIX = u'tweets-'
+
+
+class IngestWindow:
+    """
+    Window of a bucket's objects under `prefix`, claimed by one run at a
+    time.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        bucket_name (str): Name of the bucket
+        prefix (str): Prefix of the objects
+        clock (callable): Returns the current time in seconds
+    """
+
+    def __init__(self, db, bucket_name, prefix=TWEETS_PREFIX,
+                 clock=time.time):
+        self._db = db
+        self._ref = db.collection(WINDOW_COLLECTION).document(
+            f"{bucket_name}:{quote(prefix, safe='')}")
+        self._clock = clock
+        self.holder = uuid.uuid4().hex
+        self.watermark = u''
+
+    def claim(self):
+        """
+        Claims the window for this run, in a transaction, unless another
+        run holds it and has renewed it within LEASE_SECONDS.
+
+        Returns:
+            Whether this run holds the window
+        """
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def claim(transaction):
+            stored = self._ref.get(transaction=transaction).to_dict() or {}
+            if stored.get(u'holder') not in (None, self.holder) \
+                    and stored.get(u'expires_at', 0) > self._clock():
+                return None
+            transaction.set(self._ref, {
+                u'holder': self.holder,
+                u'expires_at': self._clock() + LEASE_SECONDS
+            }, merge=True)
+            return stored.get(u'watermark', u'')
+
+        with span('firestore.transaction'):
+            watermark = claim(self._db.transaction())
+        if watermark is None:
+            return False
+        self.watermark = watermark
+        return True
+
+    def renew(self):
+        """
+        Extends this run's hold on the window by LEASE_SECONDS.
+        """
+        with span('firestore.set'):
+            self._ref.set({
+                u'expires_at': self._clock() + LEASE_SECONDS
+            }, merge=True)
+
+    def release(self, watermark=None):
+        """
+        Releases the window, moving its watermark to `watermark` when given.
+        """
+        from google.cloud import firestore
+
+        doc = {u'holder': None, u'expires_at': 0}
+        if watermark is not None:
+            doc[u'watermark'] = watermark
+
+        @firestore.transactional
+        def release(transaction):
+            stored = self._ref.get(transaction=transaction).to_dict() or {}
+            # a run that overran its lease no longer holds the window
+            if stored.get(u'holder') == self.holder:
+                transaction.set(self._ref, doc, merge=True)
+
+        with span('firestore.transaction'):
+            release(self._db.transaction())
+        if watermark is not None:
+            self.watermark = watermark
+
+
+def pending_objects(db, bucket, prefix, watermark):
+    """
+    Lists the objects under `prefix` from `watermark` on that no ledger
+    marks done, oldest first.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        bucket (Object): The Cloud Storage bucket
+        prefix (str): Prefix of the objects
+        watermark (str): Name of the first object that may be pending
+
+    Returns:
+        The list of pending blobs
+    """
+    with span('storage.list'):
+        blobs = sorted(bucket.list_blobs(prefix=prefix,
+                                         start_offset=watermark or None),
+                       key=lambda blob: blob.name)
+
+    ledger_coll_ref = db.collection(LEDGER_COLLECTION)
+    done = set()
+    for chunk in chunked(blobs, MAX_GET_ALL):
+        refs = [ledger_coll_ref.document(
+            ledger_docid(bucket.name, blob.name, blob.generation))
+            for blob in chunk]
+        with span('firestore.get_all'):
+            for doc in db.get_all(refs):
+                if doc.exists and doc.get(u'status') == u'done':
+                    done.add(doc.id)
+        count('docs_read', len(refs))
+    return [blob for blob in blobs
+            if ledger_docid(bucket.name, blob.name, blob.generation)
+            not in done]
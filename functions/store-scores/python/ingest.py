@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched ingest of a file's worth of scores.
+
+Instead of a create, a get and a set per tweet, the score docs and user
+docs of the whole file are read with `get_all`, the stats are folded in
+memory and everything is committed through write batches of at most 500
+writes. Score docs are created under their deterministic id, so a batch
+that races with another delivery of the same file fails its precondition
+and its scores are ingested again against fresh reads. User docs are
+created, or updated on the condition that they were not written since
+they were read, so a batch that races with another file scoring the same
+user is ingested again the same way instead of losing its rounds. The
+round counter and rank index increments of the scores in a batch are
+committed in that same batch, the counters to one shard per batch.
+"""
+
+from instrumentation import count, span
+from rank_index import rank_increments
+from round_counters import counter_increments, random_shard, shard_ref
+from round_stats import increment_payload
+from schema import ROUND_COUNTER_COLLECTION, SCORE_COLLECTION, \
+    USER_COLLECTION, score_docid
+from user_stats import apply_score
+
+# Firestore limits
+MAX_BATCH_WRITES = 500
+MAX_GET_ALL = 500
+
+MAX_CONFLICT_RETRIES = 3
+
+# new scores of a user ingested per pass, so that the user's group fits in
+# one batch: a create and a round counter per score, and the global
+# counter, two rank index increments and the user doc
+MAX_USER_SCORES = (MAX_BATCH_WRITES - 4) // 2
+
+
+def ingest_scores(db, score_docs):
+    """
+    Writes new scores and the resulting user stats in bulk.
+    A score for a (roundid, userid) pair that is already stored, or that
+    appears earlier in the same file, is ignored. A user's scores are
+    ingested MAX_USER_SCORES at a time, so their stats are never split
+    from their scores across batches.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        score_docs (list): Dictionaries of score, roundid, userid, tweetid
+
+    Returns:
+        Dictionary with the number of scores written, duplicates skipped
+        and users updated
+    """
+    unique_docs = {}
+    for score_doc in score_docs:
+        unique_docs.setdefault(
+            score_docid(score_doc['roundid'], score_doc['userid']), score_doc)
+
+    pending = list(unique_docs.values())
+    scores_written = 0
+    users_updated = set()
+    conflicted_passes = 0
+    while pending:
+        current, later = split_per_user(pending, MAX_USER_SCORES)
+        groups = build_write_groups(db, current)
+        conflicts = commit_in_batches(db, groups)
+
+        conflicted = {id(group) for group in conflicts}
+        retried = []
+        for group in groups:
+            # the score docs, the user doc being the last write
+            creates = [data for operation, _, data in group[:-1]
+                       if operation == 'create']
+            if id(group) in conflicted:
+                retried.extend(creates)
+            else:
+                scores_written += len(creates)
+                users_updated.add(group[-1][1].id)
+
+        if retried:
+            conflicted_passes += 1
+            if conflicted_passes == MAX_CONFLICT_RETRIES:
+                from google.api_core import exceptions
+                raise exceptions.Conflict(
+                    f'{len(retried)} scores kept conflicting with another '
+                    f'ingest')
+        # a user's retried scores come before the ones left for later
+        pending = retried + later
+
+    return {
+        u'scores_written': scores_written,
+        u'duplicates_skipped': len(score_docs) - scores_written,
+        u'users_updated': len(users_updated)
+    }
+
+
+def split_per_user(score_docs, limit):
+    """
+    Splits score docs into the first `limit` of each user and the rest,
+    both in their original order.
+    """
+    taken = {}
+    current, later = [], []
+    for score_doc in score_docs:
+        userid = score_doc['userid']
+        if taken.get(userid, 0) < limit:
+            taken[userid] = taken.get(userid, 0) + 1
+            current.append(score_doc)
+        else:
+            later.append(score_doc)
+    return current, later
+
+
+def build_write_groups(db, score_docs):
+    """
+    Reads the score and user docs touched by `score_docs` and returns the
+    writes needed for the scores that are not stored yet, grouped by user:
+    the score doc creates, the round counter and rank index increments
+    and, last, the user doc: a create for a new user, else an update
+    preconditioned on the time the doc was read at.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        score_docs (list): Score dictionaries, unique per (roundid, userid)
+    """
+    existing = fetch_existing_score_ids(db, [
+        score_docid(doc['roundid'], doc['userid']) for doc in score_docs])
+    new_docs = [doc for doc in score_docs
+                if score_docid(doc['roundid'], doc['userid']) not in existing]
+
+    update_times = {}
+    user_docs = fetch_user_docs(db, {doc['userid'] for doc in new_docs},
+                                update_times)
+    stored_docs = dict(user_docs)
+
+    # group each user's writes so a user's scores and stats always land
+    # in the same atomic batch
+    score_coll_ref = db.collection(SCORE_COLLECTION)
+    user_writes = {}
+    for score_doc in new_docs:
+        userid = score_doc['userid']
+        user_docs[userid] = apply_score(user_docs.get(userid), score_doc)
+        score_ref = score_coll_ref.document(
+            score_docid(score_doc['roundid'], userid))
+        user_writes.setdefault(userid, []).append(
+            ('create', score_ref, score_doc))
+        user_writes[userid].extend(
+            ('count', counter, increments)
+            for counter, increments in counter_increments(score_doc))
+
+    user_coll_ref = db.collection(USER_COLLECTION)
+    groups = []
+    for userid, writes in user_writes.items():
+        writes.extend(('increment', index_ref, increments)
+                      for index_ref, increments in rank_increments(
+                          db, stored_docs.get(userid), user_docs[userid]))
+        user_ref = user_coll_ref.document(userid)
+        if userid in stored_docs:
+            writes.append(('update', user_ref, (
+                user_docs[userid],
+                db.write_option(last_update_time=update_times[userid]))))
+        else:
+            writes.append(('create', user_ref, user_docs[userid]))
+        groups.append(writes)
+    return groups
+
+
+def fetch_existing_score_ids(db, docids):
+    """
+    Returns the ids, out of `docids`, of the score docs already stored.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        docids (list): Deterministic score doc ids to look up
+    """
+    score_coll_ref = db.collection(SCORE_COLLECTION)
+    existing = set()
+    for chunk in chunked(docids, MAX_GET_ALL):
+        refs = [score_coll_ref.document(docid) for docid in chunk]
+        with span('firestore.get_all'):
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    existing.add(doc.id)
+        count('docs_read', len(refs))
+    return existing
+
+
+def fetch_user_docs(db, userids, update_times=None):
+    """
+    Returns the stored user docs for the given users, keyed by userid.
+    Users without a doc are left out.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        userids (set): Users whose docs should be read
+        update_times (dict): Filled with the time each doc was last
+            written, keyed by userid, when given
+    """
+    user_coll_ref = db.collection(USER_COLLECTION)
+    user_docs = {}
+    for chunk in chunked(sorted(userids), MAX_GET_ALL):
+        refs = [user_coll_ref.document(userid) for userid in chunk]
+        with span('firestore.get_all'):
+            for doc in db.get_all(refs):
+                if doc.exists:
+                    user_docs[doc.id] = doc.to_dict()
+                    if update_times is not None:
+                        update_times[doc.id] = doc.update_time
+        count('docs_read', len(refs))
+    return user_docs
+
+
+def commit_in_batches(db, groups):
+    """
+    Commits groups of writes through write batches of at most 500 writes.
+    A group is never split across batches unless it alone exceeds the cap.
+    Increments to the same document within a batch are summed into a single
+    write, and each batch adds its counts to one randomly picked shard of
+    each round counter.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        groups (list): Lists of (operation, document reference, data)
+            where operation is one of create, set, update, increment or
+            count. The data of an increment or a count maps field paths to
+            amounts, a count naming its round counter in place of a
+            reference, and the data of an update is the fields and a write
+            option holding its precondition.
+
+    Returns:
+        The groups of every batch that failed because a document to create
+        already exists or a document to update changed since it was read
+    """
+    batches = [[]]
+    pending = 0
+    incremented = set()
+    for group in groups:
+        cost = group_cost(group, incremented)
+        if pending and pending + cost > MAX_BATCH_WRITES:
+            batches.append([])
+            pending = 0
+            incremented = set()
+            cost = group_cost(group, incremented)
+        batches[-1].append(group)
+        pending += cost
+        incremented.update(incremented_paths(group))
+
+    from google.api_core import exceptions
+
+    conflicts = []
+    for batch_groups in batches:
+        shard = random_shard()
+        writes = merge_writes(
+            batch_groups, lambda counter: shard_ref(db, counter, shard))
+        for chunk in chunked(writes, MAX_BATCH_WRITES):
+            batch = db.batch()
+            for operation, doc_ref, data in chunk:
+                if operation == 'create':
+                    batch.create(doc_ref, data)
+                elif operation == 'set':
+                    batch.set(doc_ref, data, merge=True)
+                elif operation == 'increment':
+                    batch.set(doc_ref, increment_payload(data), merge=True)
+                else:
+                    fields, option = data
+                    batch.update(doc_ref, fields, option=option)
+            try:
+                with span('firestore.commit'):
+                    batch.commit()
+            except (exceptions.Conflict, exceptions.FailedPrecondition):
+                count('batch_conflicts')
+                conflicts.extend(batch_groups)
+                break
+            count('docs_written', len(chunk))
+    return conflicts
+
+
+def incremented_paths(group):
+    """
+    Returns the paths of the documents a group increments, a count
+    standing for the batch's shard of its counter.
+    """
+    return {doc_ref.path if operation == 'increment'
+            else f'{ROUND_COUNTER_COLLECTION}/{doc_ref}'
+            for operation, doc_ref, _ in group
+            if operation in ('increment', 'count')}
+
+
+def group_cost(group, incremented):
+    """
+    Returns the number of writes a group adds to a batch that already
+    increments the document paths in `incremented`.
+    """
+    others = sum(1 for operation, _, _ in group
+                 if operation not in ('increment', 'count'))
+    return others + len(incremented_paths(group) - incremented)
+
+
+def merge_writes(groups, counter_ref):
+    """
+    Flattens groups into a list of writes, summing the increments made to
+    the same document, and the counts made to the same counter, into one
+    write placed after every other write. `counter_ref` returns the shard
+    doc a counter's counts go to.
+    """
+    writes = []
+    increments = {}
+    for group in groups:
+        for operation, doc_ref, data in group:
+            if operation == 'count':
+                doc_ref = counter_ref(doc_ref)
+            elif operation != 'increment':
+                writes.append((operation, doc_ref, data))
+                continue
+            _, summed = increments.setdefault(doc_ref.path, (doc_ref, {}))
+            for field_path, value in data.items():
+                summed[field_path] = summed.get(field_path, 0) + value
+
+    writes.extend(('increment', doc_ref, summed)
+                  for doc_ref, summed in increments.values())
+    return writes
+
+
+def chunked(items, size):
+    """
+    Splits a list into consecutive chunks of at most `size` items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient, FakeWriteBatch
+from ingest import MAX_USER_SCORES, build_write_groups, ingest_scores
+from main import write_and_update_score
+from migrate_score_ids import migrate_score_ids
+from backfill_rank_index import backfill_rank_index
+from backfill_round_stats import backfill_round_stats
+from rank_index import rebuild_rank_index
+from round_counters import NUM_SHARDS, advance_latest_round, \
+    empty_totals, read_round_totals
+from round_series import SERIES_CHUNK_ROUNDS, refresh_round_series
+from schema import METADATA_COLLECTION, RANK_INDEX_COLLECTION, \
+    ROUND_COUNTER_COLLECTION, ROUND_DOCID, ROUND_SERIES_COLLECTION, \
+    ROUND_STATS_COLLECTION, SCORE_COLLECTION, USER_COLLECTION, score_docid
+from tweet_parser import parse_tweet
+
+
+def make_tweets(users, rounds, first_round=400):
+    tweets = []
+    for roundid in range(first_round, first_round + rounds):
+        for user in range(users):
+            attempts = (user + roundid) % 7 or 'X'
+            tweets.append({
+                'tweetId': f'{roundid}-{user}',
+                'authorId': f'user{user}',
+                'tweet': f'Wordle {roundid} {attempts}/6'
+            })
+    return [parse_tweet(tweet) for tweet in tweets]
+
+
+def bucket_counts(index_docs):
+    # buckets emptied by decrements are left at 0
+    return {(docid, tenths, bucket): users
+            for docid, index_doc in index_docs.items()
+            for tenths, buckets in index_doc['counts'].items()
+            for bucket, users in buckets.items() if users}
+
+
+class TestIngestScores(unittest.TestCase):
+    def test_matches_sequential_path(self):
+        score_docs = make_tweets(users=20, rounds=5)
+
+        sequential_db = FakeClient()
+        for score_doc in score_docs:
+            write_and_update_score(sequential_db, score_doc)
+
+        batched_db = FakeClient()
+        ingest_scores(batched_db, score_docs)
+
+        self.assertEqual(batched_db.dump(USER_COLLECTION),
+                         sequential_db.dump(USER_COLLECTION))
+        self.assertEqual(batched_db.dump(SCORE_COLLECTION),
+                         sequential_db.dump(SCORE_COLLECTION))
+        self.assertEqual(read_round_totals(batched_db, range(400, 405)),
+                         read_round_totals(sequential_db, range(400, 405)))
+        self.assertEqual(
+            bucket_counts(batched_db.dump(RANK_INDEX_COLLECTION)),
+            bucket_counts(sequential_db.dump(RANK_INDEX_COLLECTION)))
+
+    def test_round_trips(self):
+        # 1200 users x 4 rounds = 4800 score writes + 1200 user writes
+        score_docs = make_tweets(users=1200, rounds=4)
+        db = FakeClient()
+        summary = ingest_scores(db, score_docs)
+
+        self.assertEqual(summary['scores_written'], 4800)
+        self.assertEqual(db.rpc_counts['query'], 0)
+        # 10 chunks of score ids and 3 chunks of user ids
+        self.assertEqual(db.rpc_counts['batch_get'], 13)
+        # 97 users, the global and 4 round counter shards and 4 rank
+        # index increments per batch
+        self.assertEqual(db.rpc_counts['commit'], 13)
+        self.assertEqual(db.rpc_counts['get'], 0)
+        self.assertEqual(db.doc_writes, 6000 + 13 * (1 + 4 + 4))
+
+    def test_skips_duplicates(self):
+        score_docs = make_tweets(users=3, rounds=2)
+        db = FakeClient()
+        ingest_scores(db, score_docs[:3])
+        users_before = db.dump(USER_COLLECTION)
+
+        summary = ingest_scores(db, score_docs + score_docs[:1])
+
+        self.assertEqual(summary['scores_written'], 3)
+        self.assertEqual(summary['duplicates_skipped'], 4)
+        self.assertEqual(len(db.dump(SCORE_COLLECTION)), 6)
+        for userid, user_doc in db.dump(USER_COLLECTION).items():
+            self.assertEqual(user_doc['rounds_played'],
+                             users_before[userid]['rounds_played'] + 1)
+
+    def test_keeps_user_profile_fields(self):
+        db = FakeClient()
+        db.collection(USER_COLLECTION).document('user0').set({
+            'userid': 'user0',
+            'username': 'abc'
+        })
+        ingest_scores(db, make_tweets(users=1, rounds=1))
+
+        user_doc = db.dump(USER_COLLECTION)['user0']
+        self.assertEqual(user_doc['username'], 'abc')
+        self.assertEqual(user_doc['rounds_played'], 1)
+
+    def test_retries_batch_that_lost_a_race(self):
+        score_docs = make_tweets(users=2, rounds=1)
+        db = FakeClient()
+
+        # another delivery stores user0's score between our reads and commit
+        def racing_build_write_groups(db, pending):
+            groups = build_write_groups(db, pending)
+            if not db.dump(SCORE_COLLECTION):
+                write_and_update_score(db, score_docs[0])
+            return groups
+
+        with mock.patch('ingest.build_write_groups',
+                        racing_build_write_groups):
+            summary = ingest_scores(db, score_docs)
+
+        self.assertEqual(summary['scores_written'], 1)
+        users = db.dump(USER_COLLECTION)
+        self.assertEqual(users['user0']['rounds_played'], 1)
+        self.assertEqual(users['user1']['rounds_played'], 1)
+
+    def test_retries_user_written_by_another_file(self):
+        first_file = make_tweets(users=2, rounds=1, first_round=400)
+        second_file = make_tweets(users=2, rounds=1, first_round=401)
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=2, rounds=1, first_round=399))
+
+        # another file's ingest updates both users between our reads and
+        # commit
+        raced = []
+
+        def racing_build_write_groups(db, pending):
+            groups = build_write_groups(db, pending)
+            if not raced:
+                raced.append(True)
+                ingest_scores(db, second_file)
+            return groups
+
+        with mock.patch('ingest.build_write_groups',
+                        racing_build_write_groups):
+            summary = ingest_scores(db, first_file)
+
+        self.assertEqual(summary['scores_written'], 2)
+        for user_doc in db.dump(USER_COLLECTION).values():
+            self.assertEqual(user_doc['rounds_played'], 3)
+        self.assertEqual(bucket_counts(db.dump(RANK_INDEX_COLLECTION)),
+                         bucket_counts(rebuild_rank_index(
+                             db.dump(USER_COLLECTION).values())))
+
+    def test_keeps_a_users_stats_with_their_scores(self):
+        # more new scores of one user than fit in one batch
+        score_docs = make_tweets(users=1, rounds=600)
+        db = FakeClient()
+        commit = FakeWriteBatch.commit
+
+        def fail_second_commit(batch):
+            if commits.call_count == 2:
+                raise RuntimeError('commit failed')
+            return commit(batch)
+
+        with mock.patch.object(FakeWriteBatch, 'commit', autospec=True,
+                               side_effect=fail_second_commit) as commits:
+            with self.assertRaises(RuntimeError):
+                ingest_scores(db, score_docs)
+
+        self.assertEqual(len(db.dump(SCORE_COLLECTION)), MAX_USER_SCORES)
+        self.assertEqual(db.dump(USER_COLLECTION)['user0']['rounds_played'],
+                         MAX_USER_SCORES)
+
+        summary = ingest_scores(db, score_docs)
+        self.assertEqual(summary['scores_written'], 600 - MAX_USER_SCORES)
+        self.assertEqual(db.dump(USER_COLLECTION)['user0']['rounds_played'],
+                         600)
+
+    def test_empty_file(self):
+        db = FakeClient()
+        summary = ingest_scores(db, [])
+        self.assertEqual(summary['scores_written'], 0)
+        self.assertEqual(db.rpc_counts['commit'], 0)
+
+
+class TestRoundStats(unittest.TestCase):
+    def test_histogram(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=14, rounds=1, first_round=450))
+        ingest_scores(db, make_tweets(users=7, rounds=1, first_round=450))
+        self.assertEqual(db.dump(ROUND_STATS_COLLECTION), {})
+        refresh_round_series(db, [450])
+
+        # users 0-13 each score (user + 450) % 7, so two of every bucket
+        self.assertEqual(db.dump(ROUND_STATS_COLLECTION), {
+            '450': {
+                'players': 14,
+                'attempts': {'1': 2, '2': 2, '3': 2, '4': 2, '5': 2, '6': 2,
+                             'X': 2}
+            }
+        })
+
+    def test_refresh_keeps_higher_counts(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=14, rounds=1, first_round=450))
+        refresh_round_series(db, [450])
+        stored = db.dump(ROUND_STATS_COLLECTION)
+
+        # a refresh that read the counters before the last ingest
+        with mock.patch('round_series.read_round_totals',
+                        return_value=empty_totals()):
+            refresh_round_series(db, [450])
+
+        self.assertEqual(db.dump(ROUND_STATS_COLLECTION), stored)
+        self.assertEqual(
+            db.dump(ROUND_SERIES_COLLECTION)['4']['players'][50], 14)
+
+    def test_backfill_matches_incremental(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=30, rounds=3))
+        refresh_round_series(db, [400, 401, 402])
+        incremental = db.dump(ROUND_STATS_COLLECTION)
+
+        db.collection(ROUND_STATS_COLLECTION).document('401').delete()
+        histograms = backfill_round_stats(db)
+
+        self.assertEqual(sorted(histograms), [400, 401, 402])
+        self.assertEqual(db.dump(ROUND_STATS_COLLECTION), incremental)
+
+
+class TestRoundSeries(unittest.TestCase):
+    def test_packs_round_stats_into_chunks(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=14, rounds=3, first_round=398))
+        db.reset_counts()
+
+        self.assertEqual(refresh_round_series(db, [398, 399, 400]), 2)
+
+        # two chunk docs, each read and written in one transaction
+        self.assertEqual(db.rpc_counts['commit'], 2)
+        series = db.dump(ROUND_SERIES_COLLECTION)
+        self.assertEqual(sorted(series), ['3', '4'])
+        self.assertEqual(series['4']['first_round'], 400)
+        self.assertEqual(series['4']['players'][:2], [14, 0])
+        self.assertEqual(len(series['4']['players']), SERIES_CHUNK_ROUNDS)
+        stats = db.dump(ROUND_STATS_COLLECTION)['399']['attempts']
+        self.assertEqual(series['3']['attempts'][99 * 7:],
+                         [stats[key] for key in
+                          ('1', '2', '3', '4', '5', '6', 'X')])
+
+    def test_keeps_other_rounds_of_the_chunk(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=5, rounds=1, first_round=450))
+        refresh_round_series(db, [450])
+        ingest_scores(db, make_tweets(users=7, rounds=1, first_round=451))
+        refresh_round_series(db, [451])
+
+        players = db.dump(ROUND_SERIES_COLLECTION)['4']['players']
+        self.assertEqual(players[50:53], [5, 7, 0])
+
+    def test_backfill_matches_incremental(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=30, rounds=3))
+        refresh_round_series(db, [400, 401, 402])
+        incremental = db.dump(ROUND_SERIES_COLLECTION)
+
+        db.collection(ROUND_SERIES_COLLECTION).document('4').delete()
+        backfill_round_stats(db)
+
+        self.assertEqual(db.dump(ROUND_SERIES_COLLECTION), incremental)
+
+
+class TestRankIndex(unittest.TestCase):
+    def test_follows_users_across_buckets(self):
+        db = FakeClient()
+        score_docs = make_tweets(users=40, rounds=6)
+        ingest_scores(db, score_docs[:80])
+        ingest_scores(db, score_docs[80:])
+
+        index = bucket_counts(db.dump(RANK_INDEX_COLLECTION))
+        self.assertEqual(sum(index.values()), 40)
+        self.assertEqual(index, bucket_counts(rebuild_rank_index(
+            db.dump(USER_COLLECTION).values())))
+
+    def test_backfill_matches_incremental(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=30, rounds=3))
+        incremental = bucket_counts(db.dump(RANK_INDEX_COLLECTION))
+
+        db.collection(RANK_INDEX_COLLECTION).document('3').delete()
+        backfill_rank_index(db)
+
+        self.assertEqual(bucket_counts(db.dump(RANK_INDEX_COLLECTION)),
+                         incremental)
+
+
+class TestRoundCounters(unittest.TestCase):
+    def test_totals_summed_over_shards(self):
+        db = FakeClient()
+        score_docs = make_tweets(users=30, rounds=2, first_round=450)
+        ingest_scores(db, score_docs)
+
+        totals = read_round_totals(db, [450, 451])
+        # one batch, counted in the same shard of each counter
+        shards = sorted(db.dump(ROUND_COUNTER_COLLECTION))
+        self.assertEqual([docid.rsplit('_', 1)[0] for docid in shards],
+                         ['450', '451', 'all'])
+        self.assertEqual(len({docid.rsplit('_', 1)[1] for docid in shards}),
+                         1)
+        self.assertEqual(db.rpc_counts['batch_get'], 2 + 1)
+        self.assertEqual(totals['players'], 60)
+        self.assertEqual(totals['failures'], sum(
+            1 for doc in score_docs if doc['attempts'] <= 0))
+        self.assertEqual(totals['total_score'], sum(
+            doc['score'] for doc in score_docs))
+        self.assertEqual(totals['rounds']['450']['players'], 30)
+        self.assertEqual(sum(totals['rounds']['450']['attempts'].values()),
+                         30)
+        self.assertEqual(totals['rounds']['451']['total_score'], sum(
+            doc['score'] for doc in score_docs if doc['roundid'] == 451))
+
+    def test_backfill_matches_incremental(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=30, rounds=3))
+        incremental = read_round_totals(db, [400, 401, 402])
+
+        db.collection(ROUND_COUNTER_COLLECTION).document('401_3').set(
+            {'players': 99})
+        backfill_round_stats(db)
+
+        self.assertEqual(read_round_totals(db, [400, 401, 402]), incremental)
+
+    def test_reads_only_the_given_rounds(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=10, rounds=60))
+        db.reset_counts()
+
+        totals = read_round_totals(db, [420])
+
+        self.assertEqual(sorted(totals['rounds']), ['420'])
+        self.assertEqual(totals['players'], 600)
+        # the global and the round's shards
+        self.assertEqual(db.doc_reads, 2 * NUM_SHARDS)
+
+    def test_latest_round_only_moves_forward(self):
+        db = FakeClient()
+        round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+        round_ref.set({'version': 3})
+
+        self.assertTrue(advance_latest_round(db, 451))
+        self.assertFalse(advance_latest_round(db, 450))
+        self.assertFalse(advance_latest_round(db, 451))
+        self.assertEqual(db.dump(METADATA_COLLECTION)[ROUND_DOCID],
+                         {'version': 3, 'latest_round': 451})
+
+
+class TestMigrateScoreIds(unittest.TestCase):
+    def test_rekeys_auto_id_docs(self):
+        db = FakeClient()
+        score_coll_ref = db.collection(SCORE_COLLECTION)
+        score_docs = make_tweets(users=3, rounds=2)
+        for score_doc in score_docs:
+            score_coll_ref.add(score_doc)
+        # a duplicate left behind by two overlapping deliveries
+        score_coll_ref.add(score_docs[0])
+        # a doc that already has its deterministic id
+        score_coll_ref.document(score_docid(500, 'user9')).set(
+            dict(score_docs[0], roundid=500, userid='user9'))
+
+        stats = migrate_score_ids(db)
+
+        self.assertEqual(stats, {'rekeyed': 6, 'duplicates_removed': 1})
+        self.assertEqual(
+            sorted(db.dump(SCORE_COLLECTION)),
+            sorted([score_docid(d['roundid'], d['userid'])
+                    for d in score_docs] + ['500_user9']))
+
+    def test_dry_run_writes_nothing(self):
+        db = FakeClient()
+        db.collection(SCORE_COLLECTION).add(make_tweets(users=1, rounds=1)[0])
+        before = db.dump(SCORE_COLLECTION)
+
+        stats = migrate_score_ids(db, dry_run=True)
+
+        self.assertEqual(stats['rekeyed'], 1)
+        self.assertEqual(db.dump(SCORE_COLLECTION), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
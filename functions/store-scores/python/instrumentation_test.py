@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import contextvars
+import io
+import json
+import threading
+import unittest
+from unittest import mock
+
+import instrumentation
+from instrumentation import annotate, count, invocation, sampled, span
+
+
+def summary_of(function):
+    """
+    Runs `function` and returns the summary line it logged.
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function()
+    return json.loads(output.getvalue().strip().splitlines()[-1])
+
+
+class TestInvocation(unittest.TestCase):
+    def test_summary(self):
+        def run():
+            with invocation('store-scores', file='tweets.json'):
+                with span('firestore.commit'):
+                    pass
+                with span('firestore.commit'):
+                    pass
+                count('docs_written', 500)
+                count('docs_written', 20)
+                annotate(latest_round=455)
+
+        summary = summary_of(run)
+        self.assertEqual(summary['invocation'], 'store-scores')
+        self.assertEqual(summary['file'], 'tweets.json')
+        self.assertEqual(summary['latest_round'], 455)
+        self.assertIsNone(summary['error'])
+        self.assertEqual(summary['spans']['firestore.commit']['count'], 2)
+        self.assertEqual(summary['counters'], {'docs_written': 520})
+
+    def test_summary_logged_on_error(self):
+        def run():
+            with self.assertRaises(ValueError):
+                with invocation('store-scores'):
+                    count('docs_read')
+                    raise ValueError('bad file')
+
+        summary = summary_of(run)
+        self.assertEqual(summary['error'], 'ValueError: bad file')
+        self.assertEqual(summary['counters'], {'docs_read': 1})
+
+    def test_threads_record_into_invocation(self):
+        def run():
+            with invocation('store-scores'):
+                threads = [threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(count, 'docs_written', 10)) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        summary = summary_of(run)
+        self.assertEqual(summary['counters'], {'docs_written': 40})
+
+    def test_outside_invocation(self):
+        with span('firestore.get'):
+            count('docs_read')
+            annotate(file='tweets.json')
+
+    def test_disabled(self):
+        output = io.StringIO()
+        with mock.patch.object(instrumentation, 'ENABLED', False), \
+                contextlib.redirect_stdout(output):
+            with invocation('store-scores') as current:
+                count('docs_read')
+        self.assertIsNone(current)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_sampling(self):
+        with mock.patch.object(instrumentation, 'LOG_SAMPLE_RATE', 0):
+            self.assertFalse(any(sampled() for _ in range(100)))
+        with mock.patch.object(instrumentation, 'LOG_SAMPLE_RATE', 1):
+            self.assertTrue(all(sampled() for _ in range(100)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental reading of large JSON files from Cloud Storage.
+
+The tweets file is a JSON array of entries and the users file a JSON
+object of userid to user data. Both are read through `blob.open('rb')`,
+which downloads the object in ranged chunks, and decoded one top level
+entry at a time, so memory stays bounded by the download chunk plus one
+entry however large the file is.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the ingest functions.
+"""
+
+import codecs
+import contextvars
+import json
+import queue
+import threading
+
+from instrumentation import span
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 256 * 1024
+
+# an entry is a tweet or a user profile, anything bigger is malformed
+MAX_ENTRY_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]}'
+
+
+class _Reader:
+    """
+    Buffers decoded text from a binary stream and decodes JSON values from
+    it, reading more whenever a value is cut off by the end of the buffer.
+    """
+
+    def __init__(self, stream, read_size):
+        self._stream = stream
+        self._read_size = read_size
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        with span('download'):
+            data = self._stream.read(self._read_size)
+        if not data:
+            self._eof = True
+            self._buffer += self._decoder.decode(b'', final=True)
+            return False
+        # drop what was consumed before appending
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(data)
+        self._pos = 0
+        return True
+
+    def next_char(self):
+        """
+        Skips whitespace and returns the next character, without consuming
+        it, or '' at the end of the stream.
+        """
+        while True:
+            while self._pos < len(self._buffer) \
+                    and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.next_char()
+        if char == '' or char not in chars:
+            found = repr(char) if char else 'end of file'
+            raise ValueError(f"Expected one of {chars!r} but found {found}")
+        self._pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes and consumes the JSON value at the current position.
+        """
+        self.next_char()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if len(self._buffer) - self._pos > MAX_ENTRY_SIZE:
+                    raise
+                if self._fill():
+                    continue
+                raise
+            # a number may continue in the next chunk, e.g. "1" of "1.5"
+            if isinstance(value, (int, float)) \
+                    and (end == len(self._buffer)
+                         or self._buffer[end] not in _DELIMITERS) \
+                    and len(self._buffer) - self._pos <= MAX_ENTRY_SIZE \
+                    and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+def iter_array(stream, read_size=READ_SIZE):
+    """
+    Yields the entries of a top level JSON array one at a time.
+
+    Parameters:
+        stream (Object): Binary file-like object, e.g. `blob.open('rb')`
+        read_size (int): Bytes read from the stream at a time
+
+    Exception:
+        ValueError: when the document is not a well formed JSON array
+    """
+    reader = _Reader(stream, read_size)
+    reader.expect('[')
+    if reader.next_char() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_object(stream, read_size=READ_SIZE):
+    """
+    Yields the (key, value) pairs of a top level JSON object one at a time.
+
+    Parameters:
+        stream (Object): Binary file-like object, e.g. `blob.open('rb')`
+        read_size (int): Bytes read from the stream at a time
+
+    Exception:
+        ValueError: when the document is not a well formed JSON object
+    """
+    reader = _Reader(stream, read_size)
+    reader.expect('{')
+    if reader.next_char() == '}':
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError(f'Expected an object key but found {key!r}')
+        reader.expect(':')
+        yield key, reader.value()
+        if reader.expect(',}') == '}':
+            return
+
+
+def open_blob(blob):
+    """
+    Opens a blob for reading in ranged chunks.
+    """
+    return blob.open('rb', chunk_size=DOWNLOAD_CHUNK_SIZE)
+
+
+def prefetch(iterable, depth=64, batch_size=256):
+    """
+    Runs `iterable` in a background thread, so downloading and decoding the
+    next entries overlaps with the caller writing the previous ones. Entries
+    are handed over in batches of `batch_size`, at most `depth` batches are
+    buffered.
+    """
+    batches = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        batch = []
+        try:
+            for item in iterable:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+        except BaseException as e:
+            errors.append(e)
+        # hand over what was read before the end or the error
+        if batch:
+            put(batch)
+        put(done)
+
+    # the thread records its spans into the caller's invocation
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(produce,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            with span('prefetch_wait'):
+                batch = batches.get()
+            if batch is done:
+                break
+            yield from batch
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
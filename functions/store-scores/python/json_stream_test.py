@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import unittest
+
+from json_stream import iter_array, iter_object, prefetch
+
+TWEETS = [{
+    'tweetId': str(i),
+    'authorId': f'user{i}',
+    'tweet': f'Wordle {400 + i} {i % 6 + 1}/6\n\n🟩🟨⬛🟩🟩',
+} for i in range(200)]
+
+
+class TestIterArray(unittest.TestCase):
+    def test_entries_across_chunk_boundaries(self):
+        raw = json.dumps(TWEETS, ensure_ascii=False, indent=2).encode()
+        # small reads split entries, escapes and multi-byte characters
+        for read_size in [1, 3, 17, 4096]:
+            entries = list(iter_array(io.BytesIO(raw), read_size))
+            self.assertEqual(entries, TWEETS)
+
+    def test_numbers_split_by_a_read(self):
+        raw = b'[123456789, 1.5e10, -42]'
+        self.assertEqual(list(iter_array(io.BytesIO(raw), 2)),
+                         [123456789, 1.5e10, -42])
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_array(io.BytesIO(b' [ ] '))), [])
+
+    def test_truncated_file(self):
+        raw = json.dumps(TWEETS).encode()[:-10]
+        with self.assertRaises(ValueError):
+            list(iter_array(io.BytesIO(raw), 64))
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_array(io.BytesIO(b'{"a": 1}')))
+
+
+class TestIterObject(unittest.TestCase):
+    def test_pairs(self):
+        users = {f'{i}': {'username': f'user{i}'} for i in range(100)}
+        raw = json.dumps(users).encode()
+        self.assertEqual(dict(iter_object(io.BytesIO(raw), 5)), users)
+
+    def test_missing_colon(self):
+        with self.assertRaises(ValueError):
+            list(iter_object(io.BytesIO(b'{"a" 1}')))
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_yields_in_order(self):
+        self.assertEqual(list(prefetch(iter(range(100)), depth=3)),
+                         list(range(100)))
+
+    def test_reraises_producer_error(self):
+        def entries():
+            yield 1
+            raise ValueError('bad entry')
+
+        consumed = []
+        with self.assertRaises(ValueError):
+            for entry in prefetch(entries()):
+                consumed.append(entry)
+        self.assertEqual(consumed, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Materialized leaderboard served by api-average-scores.
+
+After each ingest the top users are queried once and written, already in
+the shape of the API response, to `leaderboards/average`:
+
+    {
+        "data": [{"username": ..., "average_score": ..., ...}, ...],
+        "count": 10,
+        "keys": [{"average_score": ..., "total_score": ...,
+                  "max_streak": ..., "userid": ...}, ...],
+        "version": 42,
+        "updated_at": <timestamp>
+    }
+
+`keys` holds the sort key of every entry, from which the API builds the
+cursor of the page that follows it.
+
+The profile fields come from the users' `profiles` docs, written by
+store-usernames, or from the user docs of users who have none yet.
+"""
+
+from instrumentation import count, span
+from schema import AVERAGE_LEADERBOARD_DOCID, LEADERBOARD_COLLECTION, \
+    PROFILE_COLLECTION, USER_COLLECTION
+
+LEADERBOARD_SIZE = 10
+
+PROFILE_FIELDS = [u'username', u'name', u'profile_image_url']
+
+
+def build_leaderboard(db, limit=LEADERBOARD_SIZE):
+    """
+    Returns the top average scores, shaped as the api-average-scores
+    response, with the sort key of every entry in `keys`.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        limit (int): Number of users on the leaderboard
+    """
+    from google.cloud import firestore
+
+    query = db.collection(USER_COLLECTION) \
+        .order_by('average_score', direction=firestore.Query.DESCENDING) \
+        .order_by('total_score', direction=firestore.Query.DESCENDING) \
+        .order_by('max_streak', direction=firestore.Query.DESCENDING) \
+        .order_by('__name__', direction=firestore.Query.DESCENDING) \
+        .limit(limit)
+    with span('firestore.query'):
+        user_docs = list(query.stream())
+    profiles = fetch_profiles(db, [user_doc.id for user_doc in user_docs])
+
+    data = []
+    keys = []
+    for user_doc in user_docs:
+        doc = user_doc.to_dict()
+        doc.update(profiles.get(user_doc.id) or {})
+        data.append({
+            u'username': doc.get('username'),
+            u'name': doc.get('name', ''),
+            u'profile_image_url': doc.get('profile_image_url', ''),
+            u'average_score': doc.get('average_score'),
+            u'max_streak': doc.get('max_streak'),
+            u'total_score': doc.get('total_score')
+        })
+        keys.append({
+            u'average_score': doc.get('average_score'),
+            u'total_score': doc.get('total_score'),
+            u'max_streak': doc.get('max_streak'),
+            u'userid': user_doc.id
+        })
+
+    return {
+        u'data': data,
+        u'count': len(data),
+        u'keys': keys
+    }
+
+
+def fetch_profiles(db, userids):
+    """
+    Returns the profile docs of `userids` that exist, keyed by userid.
+    """
+    if not userids:
+        return {}
+    coll_ref = db.collection(PROFILE_COLLECTION)
+    with span('firestore.get_all'):
+        profile_docs = list(db.get_all(
+            [coll_ref.document(userid) for userid in userids]))
+    count('docs_read', len(userids))
+    return {doc.id: {field: value for field, value in doc.to_dict().items()
+                     if field in PROFILE_FIELDS}
+            for doc in profile_docs if doc.exists}
+
+
+def refresh_leaderboard(db):
+    """
+    Recomputes the leaderboard and writes the snapshot, bumping its version.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+
+    Returns:
+        The leaderboard that was written
+    """
+    from google.cloud import firestore
+
+    leaderboard = build_leaderboard(db)
+    with span('firestore.set'):
+        db.collection(LEADERBOARD_COLLECTION) \
+            .document(AVERAGE_LEADERBOARD_DOCID) \
+            .set(dict(leaderboard, **{
+                u'version': firestore.Increment(1),
+                u'updated_at': firestore.SERVER_TIMESTAMP
+            }), merge=True)
+    print(f"Leaderboard refreshed with {leaderboard['count']} users")
+    return leaderboard
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Ledger of the Cloud Storage objects an ingest function has processed.
+
+Storage triggers deliver events at least once. Each object generation gets
+a doc in `ingest_ledger`, which records how far its ingest got:
+
+    {
+        "bucket": "...", "name": "tweets-1.json", "generation": "17...",
+        "status": "running" | "done",
+        "entries": 15000,           entries of the file fully written
+        "chunks": 3,                chunks committed
+        "state": {...},             what the function needs to resume
+        "updated_at": 1665000000.0  refreshed at every checkpoint
+    }
+
+A delivery for a generation that is done returns at once. A run renews
+its lease at every checkpoint, and a run that fails releases it, so the
+retry of its event resumes after the last checkpoint right away. A run
+that crashed without releasing it is resumed once its lease has lapsed,
+taken over in a transaction so only one delivery resumes it. A delivery
+that arrives while another run still holds the lease raises LeaseHeld, so
+the event is retried instead of being acked. The writes of both functions
+are idempotent, so a chunk that is replayed after a crash changes
+nothing.
+
+Every function deploys its own directory, so this module is kept identical
+in each of the ingest functions.
+"""
+
+import itertools
+import time
+from urllib.parse import quote
+
+from instrumentation import annotate, span
+
+LEDGER_COLLECTION = u'ingest_ledger'
+
+# a run that has not checkpointed for this long is presumed dead
+LEASE_SECONDS = 120
+
+
+class LeaseHeld(Exception):
+    """
+    Raised when another run holds the lease of an object, so that the
+    event is delivered again rather than acknowledged.
+    """
+
+
+def ledger_docid(bucket_name, filename, generation):
+    """
+    Returns the ledger doc id of an object generation; object names may
+    contain slashes, which document ids may not.
+    """
+    return f"{bucket_name}:{quote(filename, safe='')}:{generation}"
+
+
+class Ledger:
+    """
+    Ledger entry of one object generation.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        bucket_name (str): Name of the bucket of the object
+        filename (str): Name of the object
+        generation (str): Generation of the object
+        clock (callable): Returns the current time in seconds
+    """
+
+    def __init__(self, db, bucket_name, filename, generation,
+                 clock=time.time):
+        self._db = db
+        self._ref = db.collection(LEDGER_COLLECTION).document(
+            ledger_docid(bucket_name, filename, generation))
+        self._clock = clock
+        self._identity = {
+            u'bucket': bucket_name,
+            u'name': filename,
+            u'generation': str(generation)
+        }
+        self.entries = 0
+        self.chunks = 0
+        self.state = {}
+
+    def begin(self):
+        """
+        Claims the object for this run, loading the checkpoint of a run
+        that crashed.
+
+        Returns:
+            False when the object was already processed
+
+        Exception:
+            LeaseHeld: when another run is processing the object
+        """
+        from google.api_core import exceptions
+        from google.cloud import firestore
+
+        doc = {
+            u'status': u'running',
+            u'entries': 0,
+            u'chunks': 0,
+            u'state': {},
+            u'updated_at': self._clock()
+        }
+        try:
+            with span('firestore.create'):
+                self._ref.create(dict(self._identity, **doc))
+            return True
+        except exceptions.Conflict:
+            pass
+
+        with span('firestore.get'):
+            stored = self._ref.get().to_dict() or {}
+        if stored.get(u'status') == u'done':
+            print(f"Already processed {self._ref.id}")
+            annotate(ledger=u'done')
+            return False
+
+        # deliveries that all see the lease lapsed race to take it over,
+        # and only the first one wins
+        @firestore.transactional
+        def take_over(transaction):
+            stored = self._ref.get(transaction=transaction).to_dict() or {}
+            if stored.get(u'status') == u'done' or \
+                    self._clock() - stored.get(u'updated_at', 0) \
+                    < LEASE_SECONDS:
+                return None
+            transaction.set(self._ref, {u'updated_at': self._clock()},
+                            merge=True)
+            return stored
+
+        if self._clock() - stored.get(u'updated_at', 0) >= LEASE_SECONDS:
+            with span('firestore.transaction'):
+                stored = take_over(self._db.transaction())
+        else:
+            stored = None
+        if stored is None:
+            annotate(ledger=u'running')
+            raise LeaseHeld(f"Another run is processing {self._ref.id}")
+
+        self.entries = stored.get(u'entries', 0)
+        self.chunks = stored.get(u'chunks', 0)
+        self.state = stored.get(u'state', {})
+        print(f"Resuming {self._ref.id} after {self.entries} entries")
+        annotate(ledger=u'resumed', resumed_after=self.entries)
+        return True
+
+    def checkpoint(self, entries, **state):
+        """
+        Records that the first `entries` entries of the file are written.
+
+        Parameters:
+            entries (int): Entries read and written so far
+            state: Values the function needs to resume after them
+        """
+        self.entries = entries
+        self.chunks += 1
+        self.state = state
+        with span('firestore.set'):
+            self._ref.set({
+                u'entries': entries,
+                u'chunks': self.chunks,
+                u'state': state,
+                u'updated_at': self._clock()
+            }, merge=True)
+
+    def renew(self):
+        """
+        Extends this run's lease without moving the checkpoint, for a run
+        that cannot resume part-way.
+        """
+        with span('firestore.set'):
+            self._ref.set({u'updated_at': self._clock()}, merge=True)
+
+    def finish(self, **state):
+        """
+        Marks the object as processed.
+        """
+        with span('firestore.set'):
+            self._ref.set({
+                u'status': u'done',
+                u'state': state,
+                u'updated_at': self._clock()
+            }, merge=True)
+
+    def release(self):
+        """
+        Gives up the lease after a failed run, so the retry of the event
+        resumes from the last checkpoint instead of waiting for the lease
+        to lapse.
+        """
+        with span('firestore.set'):
+            self._ref.set({u'updated_at': 0}, merge=True)
+
+    def skip(self, entries):
+        """
+        Returns an iterator over the entries after the last checkpoint.
+        """
+        return itertools.islice(entries, self.entries, None)
@@ -16,14 +16,52 @@
 
 import functions_framework
 import json
-
-from google.cloud import storage
-from google.cloud import firestore
-
-METADATA_COLLECTION = u'metadata'
-SCORE_COLLECTION = u'scores'
-USER_COLLECTION = u'users'
-ROUND_DOCID = u'rounds'
+import os
+import time
+
+from clients import firestore_client, storage_client
+from concurrent_ingest import DEFAULT_CONCURRENCY, ShardedIngest
+from fan_in import TWEETS_PREFIX, IngestWindow, pending_objects
+from ingest import ingest_scores
+from instrumentation import add_time, annotate, count, invocation, \
+    sampled, span
+from json_stream import iter_array, open_blob, prefetch
+from ledger import LEASE_SECONDS, Ledger, LeaseHeld
+from rank_index import rank_increments
+from leaderboard import refresh_leaderboard
+from round_counters import advance_latest_round, bump_data_version, \
+    counter_increments, random_shard, shard_ref
+from round_series import refresh_round_series
+from round_stats import increment_payload
+from score_log import append_scores, compact_score_log
+from schema import SCORE_COLLECTION, USER_COLLECTION, score_docid
+from tweet_parser import ParseReport
+from user_stats import apply_score
+
+# 'batched' commits a whole file through write batches,
+# 'concurrent' does the same from parallel workers sharded by user,
+# 'sequential' writes and updates one tweet at a time,
+# 'log' appends the scores to the score log, for compact_receiver to save
+INGEST_MODE = os.environ.get('INGEST_MODE', 'batched')
+
+# workers of the concurrent mode
+INGEST_CONCURRENCY = int(os.environ.get(
+    'INGEST_CONCURRENCY', DEFAULT_CONCURRENCY))
+
+# tweets parsed before a chunk is written, bounds memory for large files
+INGEST_CHUNK_SIZE = 5000
+
+# seconds a burst of tweets files is collected before it is ingested as
+# one batch, 0 ingests every file on its own event; the window's lease
+# must outlast the wait, or another run takes the window over during it
+COALESCE_WINDOW_SECONDS = float(os.environ.get(
+    'COALESCE_WINDOW_SECONDS', '0'))
+if COALESCE_WINDOW_SECONDS >= LEASE_SECONDS:
+    raise ValueError(f'COALESCE_WINDOW_SECONDS must be less than the '
+                     f'{LEASE_SECONDS}s lease of the ingest window')
+
+# files ingested per burst, bounds memory since a burst is not chunked
+COALESCE_MAX_FILES = 50
 
 @functions_framework.cloud_event
 def event_receiver(cloud_event):
@@ -37,89 +75,436 @@ def event_receiver(cloud_event):
     data = cloud_event.data
     filename = data["name"]
     bucket_name = data["bucket"]
-    store_scores(bucket_name, filename)
+    if COALESCE_WINDOW_SECONDS > 0 and filename.startswith(TWEETS_PREFIX):
+        coalesce_scores(bucket_name)
+    else:
+        store_scores(bucket_name, filename, data.get("generation"))
+
+
+@functions_framework.http
+def compact_receiver(request):
+    """
+    HTTP Trigger, called periodically by Cloud Scheduler, that saves the
+    scores appended to the score log by the 'log' ingest mode
+
+    Parameters:
+        request (flask.Request): The request object
+    Returns:
+        The summary of the compaction, as JSON
+    """
+    with invocation('store-scores-compact'):
+        summary = compact_scores(firestore_client())
+    return (json.dumps(summary), 200, {'Content-Type': 'application/json'})
+
+
+def compact_scores(db):
+    """
+    Folds the oldest chunks of the score log into the scores and stats,
+    then refreshes the round metadata and the leaderboard snapshot.
 
+    Parameters:
+        db (Object): An instance of the Firestore client
 
-def store_scores(bucket_name, filename):
+    Returns:
+        The compaction summary
+    """
+    summary = compact_score_log(db)
+    for key in (u'scores_written', u'duplicates_skipped', u'users_updated'):
+        count(key, summary[key])
+    annotate(chunks=summary['chunks'], rows=summary['rows'])
+    if summary['chunks']:
+        update_round_metadata(db, summary['latest_round'])
+    if summary['scores_written']:
+        refresh_round_series(db, summary['rounds'])
+        refresh_leaderboard(db)
+        bump_data_version(db)
+    return summary
+
+
+def store_scores(bucket_name, filename, generation=None):
     """
     Calculate scores from tweets in json object and save to Firestore.
+    A generation of the file that was already processed is skipped.
 
     Parameters:
         bucket_name (str): Name of the bucket in which the object is created
         filename (str): Name of the file object
+        generation (str): Generation of the file object, read from the
+            object when None
     """
-    print("Initializing clients to save scores")
+    with invocation('store-scores', bucket=bucket_name, file=filename):
+        # reuse the instance's cloud storage client, bucket() makes no
+        # request
+        bucket = storage_client().bucket(bucket_name)
+        blob = bucket.blob(filename)
+
+        # reuse the instance's firestore client
+        db = firestore_client()
+
+        if generation is None:
+            with span('storage.reload'):
+                blob.reload()
+            generation = blob.generation
+        annotate(generation=str(generation))
+        ledger = Ledger(db, bucket_name, filename, generation)
+        if not ledger.begin():
+            return
+
+        # the file is downloaded and decoded in the background while the
+        # scores parsed so far are written
+        try:
+            with open_blob(blob) as stream:
+                save_scores(db, prefetch(iter_array(stream)), ledger)
+        except Exception:
+            ledger.release()
+            raise
 
-    # initialize cloud storage client
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(filename)
-    tweets = json.loads(blob.download_as_bytes())
 
-    # initialize firestore client
-    db = firestore.Client()    
+def coalesce_scores(bucket_name):
+    """
+    Ingests the pending tweets files of the bucket in bursts, unless
+    another run holds the bucket's window and will pick them up.
 
-    latest_round = 0
-    print("Calculating and saving scores")
-    
-    # each entry will have a tweetId, authorId, and tweet
-    for entry in tweets:
-        tweetid = entry['tweetId']
-        userid = entry['authorId']
-        tweet = entry['tweet']
+    Parameters:
+        bucket_name (str): Name of the bucket in which the object is created
+    """
+    with invocation('store-scores', bucket=bucket_name, mode='coalesce'):
+        bucket = storage_client().bucket(bucket_name)
+        db = firestore_client()
+        window = IngestWindow(db, bucket_name)
+        while window.claim():
+            watermark = None
+            try:
+                # let the rest of the burst land before listing it
+                with span('window'):
+                    time.sleep(COALESCE_WINDOW_SECONDS)
+                window.renew()
+                watermark, last_listed = save_burst(db, bucket, window)
+            finally:
+                window.release(watermark)
+
+            # the events of files that landed while the window was held
+            # were dropped, so they are claimed again here
+            pending = pending_objects(db, bucket, TWEETS_PREFIX,
+                                      window.watermark)
+            if not any(blob.name > last_listed for blob in pending):
+                return
+
+
+def save_burst(db, bucket, window):
+    """
+    Ingests the pending tweets files from the window's watermark on as one
+    batch, so each user is written once per burst rather than once per
+    file. The scores are written every INGEST_CHUNK_SIZE, renewing the
+    window and the files' leases after each chunk.
 
-        tweet = tweet.lower()
-        terms = tweet.split(' ')
+    Parameters:
+        db (Object): An instance of the Firestore client
+        bucket (Object): The Cloud Storage bucket of the files
+        window (IngestWindow): The bucket's window, held by this run
 
+    Returns:
+        Tuple of the new watermark and the name of the last file listed
+    """
+    watermark = window.watermark
+    blobs = pending_objects(db, bucket, TWEETS_PREFIX, watermark)
+    blobs = blobs[:COALESCE_MAX_FILES]
+    if not blobs:
+        return watermark, watermark
+
+    claimed = []
+    for blob in blobs:
+        ledger = Ledger(db, bucket.name, blob.name, blob.generation)
         try:
-            roundid = int(terms[1])
-            attempts = terms[2].split('/')[0]
-            score = calculate_score(attempts)
-            score_doc = {
-                u'roundid': roundid,
-                u'userid': userid,
-                u'score': score,
-                u'attempts': int(attempts) if attempts.isdigit() else 0,
-                u'tweetid': tweetid
-            }
+            if ledger.begin():
+                claimed.append((blob, ledger))
+        except LeaseHeld:
+            pass
+    count('files', len(claimed))
+    # files another run is processing stay pending after the watermark
+    held = {blob.name for blob in blobs} - \
+        {blob.name for blob, _ in claimed}
+    watermark = min(held, default=blobs[-1].name)
+    if not claimed:
+        return watermark, blobs[-1].name
+
+    # on failure, the claimed files are released for the event's retry
+    try:
+        report = ParseReport()
+        latest_round = 0
+        score_docs = []
+        # parsing includes waiting for the downloads
+        start = time.perf_counter()
+        for blob, _ in claimed:
+            # a file a crashed run left part-way is read again in full, its
+            # replayed scores are skipped as duplicates
+            with open_blob(blob) as stream:
+                for entry in prefetch(iter_array(stream)):
+                    score_doc = report.parse(entry)
+                    if score_doc is not None:
+                        latest_round = max(latest_round, score_doc['roundid'])
+                        score_docs.append(score_doc)
+        add_time('parse', time.perf_counter() - start)
+
+        scores_written = 0
+        for start in range(0, len(score_docs), INGEST_CHUNK_SIZE):
+            scores_written += write_scores(
+                db, score_docs[start:start + INGEST_CHUNK_SIZE])
+            window.renew()
+            for _, ledger in claimed:
+                ledger.renew()
+        publish(db, report, latest_round, scores_written)
+        for _, ledger in claimed:
+            ledger.finish(latest_round=latest_round,
+                          scores_written=scores_written,
+                          coalesced_files=len(claimed))
+    except Exception:
+        for _, ledger in claimed:
+            ledger.release()
+        raise
+    return watermark, blobs[-1].name
+
+
+def save_scores(db, tweets, ledger=None):
+    """
+    Calculate scores from the tweet entries and save them to Firestore,
+    then refresh the round metadata and the leaderboard snapshot.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        tweets (iterable): Tweet entries with a tweetId, authorId, and tweet
+        ledger (Ledger): Ledger entry of the file, to resume from its last
+            checkpoint and to checkpoint every chunk written
+
+    Returns:
+        The number of new scores saved
+    """
+    report = ParseReport()
+    if INGEST_MODE == 'concurrent':
+        latest_round, scores_written = save_scores_concurrently(
+            db, tweets, report, ledger)
+    else:
+        latest_round, scores_written = save_scores_in_chunks(
+            db, tweets, report, ledger)
+
+    publish(db, report, latest_round, scores_written)
+    if ledger is not None:
+        ledger.finish(latest_round=latest_round,
+                      scores_written=scores_written)
+    return scores_written
+
+
+def publish(db, report, latest_round, scores_written):
+    """
+    Counts the parse report, then refreshes the round metadata, and the
+    leaderboard snapshot and data version when new scores were saved.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        report (ParseReport): Report of the tweets parsed
+        latest_round (int): Latest round among the scores
+        scores_written (int): Number of new scores saved
+    """
+    summary = report.summary()
+    count('entries_parsed', summary['parsed'])
+    count('entries_rejected', summary['rejected'])
+    if summary['rejected']:
+        annotate(rejected=summary['reasons'], samples=summary['samples'])
+
+    # logged scores are only visible once compacted, which refreshes the
+    # round metadata and the leaderboard then
+    if INGEST_MODE != 'log':
+        update_round_metadata(db, latest_round)
+
+    # stats only change when new scores were saved
+    if scores_written:
+        refresh_leaderboard(db)
+        bump_data_version(db)
 
+
+def save_scores_in_chunks(db, tweets, report, ledger=None):
+    """
+    Parses the tweets and writes their scores every INGEST_CHUNK_SIZE
+    tweets, checkpointing the ledger after each chunk.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        tweets (iterable): Tweet entries with a tweetId, authorId, and tweet
+        report (ParseReport): Parses the tweets and counts the rejected ones
+        ledger (Ledger): Ledger entry of the file, or None
+
+    Returns:
+        Tuple of the latest round and the number of new scores saved
+    """
+    latest_round, scores_written, entries, tweets = resume(ledger, tweets)
+    score_docs = []
+
+    # parsing is timed per chunk, not per entry, and includes waiting for
+    # the download
+    start = time.perf_counter()
+    # each entry will have a tweetId, authorId, and tweet
+    for entry in tweets:
+        entries += 1
+        score_doc = report.parse(entry)
+        if score_doc is not None:
             # keep track of the latest round
-            if roundid > latest_round:
-                latest_round = roundid
+            if score_doc['roundid'] > latest_round:
+                latest_round = score_doc['roundid']
+            score_docs.append(score_doc)
+
+        if len(score_docs) == INGEST_CHUNK_SIZE:
+            add_time('parse', time.perf_counter() - start)
+            scores_written += write_scores(db, score_docs)
+            score_docs = []
+            if ledger is not None:
+                ledger.checkpoint(entries, latest_round=latest_round,
+                                  scores_written=scores_written)
+            start = time.perf_counter()
+
+    add_time('parse', time.perf_counter() - start)
+    scores_written += write_scores(db, score_docs)
+    return latest_round, scores_written
+
+
+def resume(ledger, tweets):
+    """
+    Skips the tweets written before the ledger's last checkpoint.
+
+    Returns:
+        Tuple of the latest round and the number of scores saved up to the
+        checkpoint, the number of tweets skipped and the remaining tweets
+    """
+    if ledger is None:
+        return 0, 0, 0, tweets
+    return (ledger.state.get('latest_round', 0),
+            ledger.state.get('scores_written', 0),
+            ledger.entries,
+            ledger.skip(tweets))
+
+
+def save_scores_concurrently(db, tweets, report, ledger=None):
+    """
+    Parses the tweets and hands their scores to INGEST_CONCURRENCY workers
+    sharded by user, so each user's scores are still applied in order.
+    With a ledger, the workers are drained and the ledger checkpointed
+    every INGEST_CHUNK_SIZE scores.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        tweets (iterable): Tweet entries with a tweetId, authorId, and tweet
+        report (ParseReport): Parses the tweets and counts the rejected ones
+        ledger (Ledger): Ledger entry of the file, or None
 
-            write_and_update_score(db, score_doc)
+    Returns:
+        Tuple of the latest round and the number of new scores saved
+    """
+    latest_round, scores_written, entries, tweets = resume(ledger, tweets)
+    roundids = set()
+    submitted = 0
+    # scores the workers had written when the round series were refreshed
+    refreshed = 0
+    with ShardedIngest(db, INGEST_CONCURRENCY) as pipeline:
+        # includes waiting for the download and for full worker queues
+        start = time.perf_counter()
+        for entry in tweets:
+            entries += 1
+            score_doc = report.parse(entry)
+            if score_doc is None:
+                continue
+            if score_doc['roundid'] > latest_round:
+                latest_round = score_doc['roundid']
+            roundids.add(score_doc['roundid'])
+            pipeline.submit(score_doc)
+            submitted += 1
+
+            if ledger is not None and submitted % INGEST_CHUNK_SIZE == 0:
+                add_time('parse', time.perf_counter() - start)
+                with span('drain'):
+                    written = pipeline.flush()['scores_written']
+                # the workers are idle, so they do not contend on the chunks
+                if written > refreshed:
+                    refresh_round_series(db, roundids)
+                refreshed = written
+                roundids = set()
+                ledger.checkpoint(entries, latest_round=latest_round,
+                                  scores_written=scores_written + written)
+                start = time.perf_counter()
+
+        add_time('parse', time.perf_counter() - start)
+        with span('drain'):
+            summary = pipeline.close()
+
+    count_ingest(summary)
+    # once all workers are done, so they do not contend on the chunks
+    if summary['scores_written'] > refreshed:
+        refresh_round_series(db, roundids)
+    return latest_round, scores_written + summary['scores_written']
+
+
+def write_scores(db, score_docs):
+    """
+    Saves a chunk of parsed scores with the configured ingest mode.
 
-        except ValueError as e:
-            print(e)
-        except Exception as e:
-            print(f"Encountered error {e}")
+    Parameters:
+        db (Object): An instance of the Firestore client
+        score_docs (list): Dictionaries of score, roundid, userid, tweetid
 
-    print("Saved scores to Firestore")
-    update_round_metadata(db, latest_round)
+    Returns:
+        The number of new scores saved
+    """
+    if INGEST_MODE == 'sequential':
+        scores_written = 0
+        for score_doc in score_docs:
+            try:
+                if write_and_update_score(db, score_doc):
+                    scores_written += 1
+            except Exception as e:
+                print(f"Encountered error {e}")
+                count('errors')
+        count('scores_written', scores_written)
+        count('duplicates_skipped', len(score_docs) - scores_written)
+        if scores_written:
+            refresh_round_series(
+                db, {score_doc['roundid'] for score_doc in score_docs})
+        return scores_written
+
+    if not score_docs:
+        return 0
+    if INGEST_MODE == 'log':
+        with span('write'):
+            append_scores(db, score_docs)
+        # saved when the log is compacted
+        return 0
+    with span('write'):
+        summary = ingest_scores(db, score_docs)
+    count_ingest(summary)
+    if summary['scores_written']:
+        refresh_round_series(
+            db, {score_doc['roundid'] for score_doc in score_docs})
+    return summary['scores_written']
+
+
+def count_ingest(summary):
+    """
+    Adds an ingest summary to the invocation's counters.
+    """
+    for key, value in summary.items():
+        count(key, value)
 
 
-def update_round_metadata(db, latest_round): 
+def update_round_metadata(db, latest_round):
     """
-    Updates the metadata with latest round scored
+    Updates the metadata with latest round scored, unless another ingest
+    already moved it past that round.
 
     Parameters:
         db (Object): An instance of the Firestore client
         latest_round (int): Value of the latest round fetched
     """
-    round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
-    round_doc = round_ref.get()
-    if round_doc.exists:
-        current_latest = round_doc.get(u'latest_round')
-        if latest_round > current_latest:
-            round_ref.set({
-                u'latest_round': latest_round
-            }, merge=True)
-            print(f'latest round updated to {latest_round}')
-    else:
-        round_ref.set({
-            u'latest_round': latest_round
-        })
-        print(f'latest round updated to {latest_round}')
+    with span('firestore.transaction'):
+        advanced = advance_latest_round(db, latest_round)
+    if advanced:
+        annotate(latest_round=latest_round)
 
 
 def write_and_update_score(db, score_doc):
@@ -134,18 +519,27 @@ def write_and_update_score(db, score_doc):
     Return:
         Boolean indicating success or failure 
     """
-    score_coll_ref = db.collection(SCORE_COLLECTION)
-    score_docs = score_coll_ref \
-        .where(u'roundid', u'==', score_doc['roundid']) \
-        .where(u'userid', u'==', score_doc['userid']) \
-        .get()
-
-    if len(score_docs) == 0:
-        score_coll_ref.add(score_doc)
-        print(f"Updated score for author = {score_doc['userid']}, " + 
-                "round {score_doc['roundid']}")
-
-        update_user_stats(db, score_doc)
+    from google.api_core import exceptions
+
+    score_ref = db.collection(SCORE_COLLECTION).document(
+        score_docid(score_doc['roundid'], score_doc['userid']))
+    try:
+        with span('firestore.create'):
+            score_ref.create(score_doc)
+    except exceptions.Conflict:
+        return False
+
+    if sampled():
+        print(f"Updated score for author = {score_doc['userid']}, "
+              f"round {score_doc['roundid']}")
+
+    update_user_stats(db, score_doc)
+    shard = random_shard()
+    for counter, increments in counter_increments(score_doc):
+        with span('firestore.set'):
+            shard_ref(db, counter, shard).set(
+                increment_payload(increments), merge=True)
+    return True
     
 
 def update_user_stats(db, score_doc): 
@@ -157,77 +551,24 @@ def update_user_stats(db, score_doc):
         score_doc (Object): A dictionary of score details
     """
     doc_ref = db.collection(USER_COLLECTION).document(score_doc['userid'])
-    doc = doc_ref.get()
+    with span('firestore.get'):
+        doc = doc_ref.get()
+    stored_doc = doc.to_dict() if doc.exists else None
     if doc.exists:
-        user_doc = doc.to_dict()
-        current_score = score_doc['score']
-        
-        rounds_played = user_doc.get('rounds_played', 0)
-        user_doc[u'rounds_played'] = rounds_played + 1
-
-        average_score = user_doc.get('average_score', 0)
-        average_score = (average_score * rounds_played + current_score) \
-            / (rounds_played + 1)
-        user_doc[u'average_score'] = round(average_score, 1)
-
-        total_score = user_doc.get('total_score', 0)
-        user_doc[u'total_score'] = total_score + current_score
-        
-        last_round = user_doc.get('last_round', 0)
-        user_doc[u'last_round'] = score_doc['roundid']
-
-        # streak if contiguous games played and score is > 0
-        # if current game was not successful then streak is lost
-        current_streak = user_doc.get('current_streak', 0)
-        if last_round == score_doc['roundid'] - 1 and current_score > 0:
-            current_streak = current_streak + 1
-        else:
-            current_streak = 1 if current_score > 0 else 0
-        user_doc[u'current_streak'] = current_streak
-
-        max_streak = user_doc.get('max_streak', 0)
-        user_doc[u'max_streak'] = max(max_streak, current_streak)
-
-        doc_ref.set(user_doc, merge=True)
-        print(f"Updated user {score_doc['userid']}")
+        user_doc = apply_score(stored_doc, score_doc)
+        with span('firestore.set'):
+            doc_ref.set(user_doc, merge=True)
+        if sampled():
+            print(f"Updated user {score_doc['userid']}")
 
     else:
-        user_doc = {
-            u'userid': score_doc['userid'],
-            u'rounds_played': 1,
-            u'last_round': score_doc['roundid'],
-            u'average_score': score_doc['score'],
-            u'total_score': score_doc['score'],
-            u'max_streak': 1,
-            u'current_streak': 1
-        }
-        doc_ref.set(user_doc)
-        print(f"Created user {score_doc['userid']}")
-
-
-def calculate_score(attempts):
-    """
-    Calculate score based on # of attempts.
-    If failed to complete (attempt = X), then score = 0
-    If completed in 1 attempt, then score = 6
-
-    Parameters:
-        attempts (string): Number of attempts
-
-    Returns: 
-        The score based on the number of attempts
-
-    Exception:
-        ValueError: when the attempts is out of bounds
-    """
-    score = 0
-    if not attempts.isdigit():
-        return score
-
-    attempts = int(attempts)
-    if attempts > 0 and attempts <= 6:
-        score = 6 - attempts + 1
-    else:
-        raise ValueError(f'Score of {attempts} is invalid')
-
-    return score
+        user_doc = apply_score(None, score_doc)
+        with span('firestore.set'):
+            doc_ref.set(user_doc)
+        count('users_created')
+        if sampled():
+            print(f"Created user {score_doc['userid']}")
+
+    for index_ref, increments in rank_increments(db, stored_doc, user_doc):
+        with span('firestore.set'):
+            index_ref.set(increment_payload(increments), merge=True)
@@ -14,9 +14,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import importlib
+import json
+import os
+import sys
 import unittest
+from unittest import mock
 
-from main import calculate_score
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from cloudevents.http import CloudEvent
+from fake_firestore import FakeClient
+from fake_storage import FakeStorageClient
+from main import compact_scores, save_scores, store_scores
+from ledger import Ledger, LeaseHeld
+import clients
+import fan_in
+import main
+import score_log
+from round_counters import read_round_totals
+from scoring import calculate_score
+from schema import AVERAGE_LEADERBOARD_DOCID, LEADERBOARD_COLLECTION, \
+    METADATA_COLLECTION, PROFILE_COLLECTION, ROUND_COUNTER_COLLECTION, \
+    ROUND_DOCID, ROUND_SERIES_COLLECTION, ROUND_STATS_COLLECTION, \
+    SCORE_COLLECTION, SCORE_LOG_COLLECTION, USER_COLLECTION
 
 class TestCalculateScore(unittest.TestCase):
     def test_failed(self):
@@ -39,5 +61,450 @@ class TestCalculateScore(unittest.TestCase):
         self.assertEqual(calculate_score('Y'), 0)
 
 
+class TestSaveScores(unittest.TestCase):
+    def tweets(self, roundid, attempts_by_user):
+        return [{
+            'tweetId': f'{roundid}-{userid}',
+            'authorId': userid,
+            'tweet': f'Wordle {roundid} {attempts}/6'
+        } for userid, attempts in attempts_by_user.items()]
+
+    def leaderboard(self, db):
+        return db.dump(LEADERBOARD_COLLECTION)[AVERAGE_LEADERBOARD_DOCID]
+
+    def test_refreshes_leaderboard(self):
+        db = FakeClient()
+        db.collection(USER_COLLECTION).document('u2').set({
+            'userid': 'u2', 'username': 'two', 'name': 'Two'})
+
+        save_scores(db, self.tweets(450, {'u1': 4, 'u2': 2, 'u3': 'X'}))
+
+        leaderboard = self.leaderboard(db)
+        self.assertEqual(leaderboard['version'], 1)
+        self.assertEqual(leaderboard['count'], 3)
+        self.assertEqual(leaderboard['data'][0], {
+            'username': 'two',
+            'name': 'Two',
+            'profile_image_url': '',
+            'average_score': 5,
+            'max_streak': 1,
+            'total_score': 5
+        })
+        self.assertEqual(leaderboard['keys'][0], {
+            'average_score': 5,
+            'total_score': 5,
+            'max_streak': 1,
+            'userid': 'u2'
+        })
+
+        save_scores(db, self.tweets(451, {'u3': 1}))
+        leaderboard = self.leaderboard(db)
+        self.assertEqual(leaderboard['version'], 2)
+        self.assertEqual(
+            [user['total_score'] for user in leaderboard['data']], [5, 6, 3])
+
+    def test_leaderboard_joins_profiles(self):
+        db = FakeClient()
+        db.collection(USER_COLLECTION).document('u1').set({
+            'userid': 'u1', 'username': 'old'})
+        db.collection(PROFILE_COLLECTION).document('u1').set({
+            'username': 'one', 'name': 'One',
+            'profile_image_url': 'https://example.com/1.png'})
+
+        save_scores(db, self.tweets(450, {'u1': 4, 'u2': 2}))
+
+        data = self.leaderboard(db)['data']
+        self.assertEqual(data[0]['username'], None)
+        self.assertEqual(
+            {key: data[1][key] for key in ('username', 'name',
+                                           'profile_image_url')},
+            {'username': 'one', 'name': 'One',
+             'profile_image_url': 'https://example.com/1.png'})
+
+    def test_skips_refresh_without_new_scores(self):
+        db = FakeClient()
+        tweets = self.tweets(450, {'u1': 4})
+        save_scores(db, tweets)
+        save_scores(db, tweets)
+
+        self.assertEqual(self.leaderboard(db)['version'], 1)
+        self.assertEqual(db.dump(METADATA_COLLECTION)[ROUND_DOCID], {
+            'latest_round': 450,
+            'version': 1
+        })
+
+
+class TestStoreScores(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        self.gcs = FakeStorageClient()
+        clients.reset()
+        for name, client in [('_new_firestore_client', self.db),
+                             ('_new_storage_client', self.gcs)]:
+            patcher = mock.patch.object(clients, name, return_value=client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+
+    def test_streams_file_in_chunks(self):
+        tweets = [{
+            'tweetId': str(i),
+            'authorId': f'user{i}',
+            'tweet': f'Wordle 450 {i % 6 + 1}/6'
+        } for i in range(25)]
+        tweets.insert(3, {'tweetId': 'x', 'authorId': 'y', 'tweet': 'hi'})
+        self.gcs.put('bucket', 'tweets-1.json', json.dumps(tweets))
+
+        with mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch('json_stream.DOWNLOAD_CHUNK_SIZE', 64):
+            store_scores('bucket', 'tweets-1.json')
+
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 25)
+        # 3 chunks of scores and their round series, latest round,
+        # leaderboard and data version, and the ledger's claim, 2
+        # checkpoints and completion
+        self.assertEqual(self.db.rpc_counts['commit'], 3 + 3 + 3 + 4)
+        self.assertGreater(self.gcs.rpc_counts['download'], 10)
+
+    def test_skips_redelivered_file(self):
+        self.gcs.put('bucket', 'tweets-1.json', json.dumps([{
+            'tweetId': '1', 'authorId': 'user1', 'tweet': 'Wordle 450 3/6'
+        }]))
+        store_scores('bucket', 'tweets-1.json')
+        self.db.reset_counts()
+        self.gcs.rpc_counts.clear()
+
+        store_scores('bucket', 'tweets-1.json')
+
+        # the object's generation and the ledger doc, nothing else
+        self.assertEqual(self.gcs.rpc_counts, {'get': 1})
+        self.assertEqual(self.db.rpc_counts, {'commit': 1, 'get': 1})
+
+    def test_resumes_after_last_checkpoint(self):
+        tweets = [{
+            'tweetId': str(i),
+            'authorId': f'user{i % 7}',
+            'tweet': f'Wordle {450 + i // 7} {i % 6 + 1}/6'
+        } for i in range(35)]
+        self.gcs.put('bucket', 'tweets-1.json', json.dumps(tweets))
+        write_scores = main.write_scores
+
+        def crash_on_third_chunk(db, score_docs):
+            if len(self.db.dump(SCORE_COLLECTION)) == 20:
+                raise RuntimeError('instance stopped')
+            return write_scores(db, score_docs)
+
+        with mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch.object(main, 'write_scores', crash_on_third_chunk):
+            with self.assertRaises(RuntimeError):
+                store_scores('bucket', 'tweets-1.json', '1')
+
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 20)
+
+        # the failed run released its lease, so the first retry resumes
+        with mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch.object(main, 'write_scores',
+                                  wraps=write_scores) as resumed:
+            store_scores('bucket', 'tweets-1.json', '1')
+
+        # only the third and fourth chunks are written again
+        self.assertEqual([len(call.args[1]) for call in resumed.mock_calls],
+                         [10, 5])
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 35)
+        self.assertEqual(
+            self.db.dump(METADATA_COLLECTION)[ROUND_DOCID]['latest_round'],
+            454)
+        ledger_doc, = self.db.dump('ingest_ledger').values()
+        self.assertEqual(ledger_doc['status'], 'done')
+        self.assertEqual(ledger_doc['state'],
+                         {'latest_round': 454, 'scores_written': 35})
+
+    def test_concurrent_mode_checkpoints_and_resumes(self):
+        tweets = [{
+            'tweetId': str(i),
+            'authorId': f'user{i % 7}',
+            'tweet': f'Wordle {450 + i // 7} {i % 6 + 1}/6'
+        } for i in range(35)]
+        self.gcs.put('bucket', 'tweets-1.json', json.dumps(tweets))
+        refresh = main.refresh_round_series
+
+        def crash_on_third_chunk(db, roundids):
+            if refreshed.call_count == 3:
+                raise RuntimeError('instance stopped')
+            return refresh(db, roundids)
+
+        with mock.patch.object(main, 'INGEST_MODE', 'concurrent'), \
+                mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch.object(main, 'refresh_round_series',
+                                  side_effect=crash_on_third_chunk) \
+                as refreshed:
+            with self.assertRaises(RuntimeError):
+                store_scores('bucket', 'tweets-1.json', '1')
+
+        ledger_doc, = self.db.dump('ingest_ledger').values()
+        self.assertEqual((ledger_doc['entries'], ledger_doc['chunks']),
+                         (20, 2))
+
+        with mock.patch.object(main, 'INGEST_MODE', 'concurrent'), \
+                mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch.object(main.ShardedIngest, 'submit',
+                                  autospec=True,
+                                  side_effect=main.ShardedIngest.submit) \
+                as submitted:
+            store_scores('bucket', 'tweets-1.json', '1')
+
+        # only the scores after the second checkpoint are read again
+        self.assertEqual(submitted.call_count, 15)
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 35)
+        ledger_doc, = self.db.dump('ingest_ledger').values()
+        self.assertEqual(ledger_doc['status'], 'done')
+        self.assertEqual(ledger_doc['state']['latest_round'], 454)
+
+    def test_retried_while_another_run_holds_the_lease(self):
+        self.gcs.put('bucket', 'tweets-1.json', json.dumps([{
+            'tweetId': '1', 'authorId': 'user1', 'tweet': 'Wordle 450 3/6'
+        }]))
+        self.assertTrue(Ledger(self.db, 'bucket', 'tweets-1.json',
+                               '1').begin())
+
+        with self.assertRaises(LeaseHeld):
+            store_scores('bucket', 'tweets-1.json', '1')
+        self.assertEqual(self.db.dump(SCORE_COLLECTION), {})
+
+        with mock.patch('ledger.LEASE_SECONDS', 0):
+            store_scores('bucket', 'tweets-1.json', '1')
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 1)
+
+    def test_one_retry_takes_over_a_lapsed_lease(self):
+        # a run that crashed without releasing its lease
+        self.assertTrue(Ledger(self.db, 'bucket', 'tweets-1.json', '1',
+                               clock=lambda: 0).begin())
+        first = Ledger(self.db, 'bucket', 'tweets-1.json', '1')
+        second = Ledger(self.db, 'bucket', 'tweets-1.json', '1')
+        get = first._ref.get
+
+        def race(**kwargs):
+            # the second retry takes over after the first saw it lapsed
+            if 'transaction' in kwargs and not raced:
+                raced.append(True)
+                self.assertTrue(second.begin())
+            return get(**kwargs)
+
+        raced = []
+
+        with mock.patch.object(first._ref, 'get', side_effect=race):
+            with self.assertRaises(LeaseHeld):
+                first.begin()
+
+
+class TestCoalesceScores(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        self.gcs = FakeStorageClient()
+        clients.reset()
+        for name, client in [('_new_firestore_client', self.db),
+                             ('_new_storage_client', self.gcs)]:
+            patcher = mock.patch.object(clients, name, return_value=client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        patcher = mock.patch.object(main, 'COALESCE_WINDOW_SECONDS', 0.001)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put_file(self, name, roundid, users):
+        self.gcs.put('bucket', name, json.dumps([{
+            'tweetId': f'{roundid}-{user}',
+            'authorId': f'user{user}',
+            'tweet': f'Wordle {roundid} {user % 6 + 1}/6'
+        } for user in users]))
+
+    def event(self, name):
+        return CloudEvent({
+            'type': 'google.cloud.storage.object.v1.finalized',
+            'source': '//storage.googleapis.com/projects/_/buckets/bucket'
+        }, {'name': name, 'bucket': 'bucket'})
+
+    def test_writes_each_user_once_per_burst(self):
+        # the same 20 users in three files, the last one repeating a file
+        self.put_file('tweets-1.json', 450, range(20))
+        self.put_file('tweets-2.json', 451, range(20))
+        self.put_file('tweets-3.json', 451, range(20))
+
+        with mock.patch.object(main, 'ingest_scores',
+                               wraps=main.ingest_scores) as ingest:
+            main.event_receiver(self.event('tweets-2.json'))
+
+        self.assertEqual(ingest.call_count, 1)
+        users = self.db.dump(USER_COLLECTION)
+        self.assertEqual(len(users), 20)
+        self.assertEqual(users['user0']['rounds_played'], 2)
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 40)
+        self.assertEqual(
+            self.db.dump(METADATA_COLLECTION)[ROUND_DOCID]['latest_round'],
+            451)
+        ledger_docs = self.db.dump('ingest_ledger').values()
+        self.assertEqual([doc['status'] for doc in ledger_docs],
+                         ['done'] * 3)
+        window, = self.db.dump('ingest_windows').values()
+        self.assertEqual(window['watermark'], 'tweets-3.json')
+        self.assertIsNone(window['holder'])
+
+    def test_renews_the_files_leases_after_each_chunk(self):
+        self.put_file('tweets-1.json', 450, range(15))
+        self.put_file('tweets-2.json', 451, range(15))
+
+        with mock.patch.object(main, 'INGEST_CHUNK_SIZE', 10), \
+                mock.patch.object(Ledger, 'renew', autospec=True,
+                                  side_effect=Ledger.renew) as renew, \
+                mock.patch.object(fan_in.IngestWindow, 'renew',
+                                  autospec=True,
+                                  side_effect=fan_in.IngestWindow.renew) \
+                as renew_window:
+            main.event_receiver(self.event('tweets-1.json'))
+
+        # three chunks of the 30 scores, for each of the two files
+        self.assertEqual(renew.call_count, 6)
+        # once the window is waited out, and after each chunk
+        self.assertEqual(renew_window.call_count, 1 + 3)
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 30)
+
+    def test_window_must_be_shorter_than_its_lease(self):
+        with mock.patch.dict(os.environ, {'COALESCE_WINDOW_SECONDS': str(
+                main.LEASE_SECONDS)}):
+            with self.assertRaises(ValueError):
+                importlib.reload(main)
+        importlib.reload(main)
+
+    def test_events_of_a_processed_burst_do_no_work(self):
+        self.put_file('tweets-1.json', 450, range(5))
+        self.put_file('tweets-2.json', 451, range(5))
+        main.event_receiver(self.event('tweets-1.json'))
+        self.db.reset_counts()
+        self.gcs.rpc_counts.clear()
+
+        main.event_receiver(self.event('tweets-2.json'))
+
+        self.assertEqual(self.db.dump(SCORE_COLLECTION).keys(),
+                         {f'{roundid}_user{user}' for roundid in (450, 451)
+                          for user in range(5)})
+        # only files from the watermark on are listed, twice
+        self.assertEqual(self.gcs.rpc_counts, {'list': 2})
+        self.assertNotIn('download', self.gcs.rpc_counts)
+
+    def test_returns_while_another_run_holds_the_window(self):
+        self.put_file('tweets-1.json', 450, range(5))
+        holder = fan_in.IngestWindow(self.db, 'bucket')
+        self.assertTrue(holder.claim())
+
+        main.event_receiver(self.event('tweets-1.json'))
+        self.assertEqual(self.db.dump(SCORE_COLLECTION), {})
+
+        holder.release()
+        main.event_receiver(self.event('tweets-1.json'))
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 5)
+
+    def test_claims_files_that_land_during_the_burst(self):
+        self.put_file('tweets-1.json', 450, range(5))
+        save_burst = main.save_burst
+
+        def land_during_burst(db, bucket, window):
+            result = save_burst(db, bucket, window)
+            if burst.call_count == 1:
+                # its event would find the window held and return
+                self.put_file('tweets-2.json', 451, range(5))
+            return result
+
+        with mock.patch.object(main, 'save_burst',
+                               side_effect=land_during_burst) as burst:
+            main.event_receiver(self.event('tweets-1.json'))
+
+        self.assertEqual(burst.call_count, 2)
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 10)
+
+    def test_skips_files_another_run_is_processing(self):
+        self.put_file('tweets-1.json', 450, range(5))
+        self.put_file('tweets-2.json', 451, range(5))
+        generation = self.gcs.bucket('bucket').blob('tweets-1.json') \
+            .generation
+        self.assertTrue(Ledger(self.db, 'bucket', 'tweets-1.json',
+                               generation).begin())
+
+        main.event_receiver(self.event('tweets-2.json'))
+
+        self.assertEqual(len(self.db.dump(SCORE_COLLECTION)), 5)
+        window, = self.db.dump('ingest_windows').values()
+        self.assertEqual(window['watermark'], 'tweets-1.json')
+
+    def test_other_objects_keep_their_own_event(self):
+        self.put_file('scores.json', 450, range(5))
+        with mock.patch.object(main, 'store_scores') as store:
+            main.event_receiver(self.event('scores.json'))
+        store.assert_called_once_with('bucket', 'scores.json', None)
+
+
+class TestScoreLog(unittest.TestCase):
+    def tweets(self, users, rounds, first_round=450):
+        return [{
+            'tweetId': f'{roundid}-{user}',
+            'authorId': f'user{user % 40}',
+            'tweet': f'Wordle {roundid} {(user + roundid) % 7 or "X"}/6'
+        } for roundid in range(first_round, first_round + rounds)
+            for user in range(users)]
+
+    def test_appends_one_write_per_chunk(self):
+        db = FakeClient()
+        with mock.patch.object(main, 'INGEST_MODE', 'log'), \
+                mock.patch.object(score_log, 'LOG_CHUNK_ROWS', 100):
+            save_scores(db, self.tweets(users=250, rounds=1))
+
+        self.assertEqual(db.dump(SCORE_COLLECTION), {})
+        self.assertEqual(db.dump(USER_COLLECTION), {})
+        chunks = db.dump(SCORE_LOG_COLLECTION).values()
+        self.assertEqual(sorted(chunk['rows'] for chunk in chunks),
+                         [50, 100, 100])
+        self.assertEqual(db.doc_writes, 3)
+
+    def test_compaction_matches_batched_ingest(self):
+        tweets = self.tweets(users=60, rounds=3)
+        batched_db = FakeClient()
+        save_scores(batched_db, tweets)
+
+        db = FakeClient()
+        with mock.patch.object(main, 'INGEST_MODE', 'log'), \
+                mock.patch.object(score_log, 'LOG_CHUNK_ROWS', 50):
+            save_scores(db, tweets[:90])
+            save_scores(db, tweets[90:])
+            summary = compact_scores(db)
+
+        self.assertEqual(summary['chunks'], 4)
+        # 40 users, so a third of the rows repeat a user's round
+        self.assertEqual(summary['rows'], 180)
+        self.assertEqual(summary['scores_written'], 120)
+        self.assertEqual(db.dump(SCORE_LOG_COLLECTION), {})
+        for collection in (SCORE_COLLECTION, USER_COLLECTION,
+                           ROUND_STATS_COLLECTION, ROUND_SERIES_COLLECTION,
+                           METADATA_COLLECTION):
+            self.assertEqual(db.dump(collection),
+                             batched_db.dump(collection))
+        # the batches counted in random shards
+        self.assertEqual(read_round_totals(db, [450, 451, 452]),
+                         read_round_totals(batched_db, [450, 451, 452]))
+
+    def test_compacting_twice_adds_no_duplicates(self):
+        db = FakeClient()
+        tweets = self.tweets(users=10, rounds=1)
+        with mock.patch.object(main, 'INGEST_MODE', 'log'):
+            save_scores(db, tweets)
+            save_scores(db, tweets)
+            summary = compact_scores(db)
+
+        self.assertEqual(summary['scores_written'], 10)
+        self.assertEqual(summary['duplicates_skipped'], 10)
+        users = db.dump(USER_COLLECTION)
+        self.assertEqual(users['user0']['rounds_played'], 1)
+        self.assertEqual(compact_scores(db)['chunks'], 0)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+One-off migration that re-keys score docs written with auto ids to the
+deterministic "{roundid}_{userid}" id.
+
+Usage:
+    python migrate_score_ids.py [--project PROJECT] [--dry-run]
+"""
+
+import argparse
+
+from schema import SCORE_COLLECTION, score_docid
+
+# each re-keyed doc costs a create and a delete
+MAX_BATCH_DOCS = 250
+
+
+def migrate_score_ids(db, dry_run=False):
+    """
+    Copies every auto-id score doc to its deterministic id and deletes the
+    original. When the deterministic doc already exists, the auto-id doc is
+    a duplicate of the same (roundid, userid) and is only deleted.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        dry_run (bool): Only count the docs that would change
+
+    Returns:
+        Dictionary with the number of docs re-keyed and duplicates removed
+    """
+    score_coll_ref = db.collection(SCORE_COLLECTION)
+    stats = {u'rekeyed': 0, u'duplicates_removed': 0}
+
+    # the target ids that are taken, either already or by this run
+    docs = list(score_coll_ref.stream())
+    taken = {doc.id for doc in docs}
+
+    batch = db.batch()
+    pending = 0
+    for doc in docs:
+        score_doc = doc.to_dict()
+        docid = score_docid(score_doc['roundid'], score_doc['userid'])
+        if doc.id == docid:
+            continue
+
+        if docid in taken:
+            stats[u'duplicates_removed'] += 1
+            print(f"Removing duplicate score {doc.id} of {docid}")
+        else:
+            stats[u'rekeyed'] += 1
+            taken.add(docid)
+            batch.create(score_coll_ref.document(docid), score_doc)
+        batch.delete(doc.reference)
+        pending += 1
+
+        if pending == MAX_BATCH_DOCS:
+            if not dry_run:
+                batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending and not dry_run:
+        batch.commit()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Re-key auto-id score docs to "{roundid}_{userid}".')
+    parser.add_argument('--project', help='Google Cloud project id')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report the changes without writing them')
+    args = parser.parse_args()
+
+    from google.cloud import firestore
+    db = firestore.Client(project=args.project)
+    stats = migrate_score_ids(db, dry_run=args.dry_run)
+    print(f"Migration {'dry run ' if args.dry_run else ''}done: {stats}")
+
+
+if __name__ == "__main__":
+    main()
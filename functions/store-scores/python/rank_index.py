@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Histogram of the users' leaderboard keys, from which api-average-scores
+tells a user their rank without counting the users ahead of them.
+
+Users are counted per bucket of (average_score, total_score): the average
+at its stored precision of a tenth, and the total in ranges of
+RANK_TOTAL_BUCKET points. The buckets of each whole average point are kept
+in one doc, `rank_index/{point}`, so the index is RANK_INDEX_DOCS docs:
+
+    {
+        "counts": {
+            "42": {"15": 12, "16": 3},      average 4.2, totals 150-169
+            "43": {"8": 1}
+        }
+    }
+
+Whenever an ingest changes a user's average or total, the user's old
+bucket is decremented and the new one incremented, in the same batch as
+the user doc.
+"""
+
+from schema import RANK_INDEX_COLLECTION
+
+# total score points per bucket
+RANK_TOTAL_BUCKET = 10
+
+# docs of the index, one per whole average point from 0 to 6
+RANK_INDEX_DOCS = 7
+
+
+def rank_bucket(user_doc):
+    """
+    Returns the doc and the field path of a user's bucket, or None for a
+    user doc without stats.
+    """
+    if user_doc is None or user_doc.get(u'average_score') is None:
+        return None
+    tenths = round(user_doc[u'average_score'] * 10)
+    bucket = user_doc.get(u'total_score', 0) // RANK_TOTAL_BUCKET
+    return str(tenths // 10), f'counts.{tenths}.{bucket}'
+
+
+def rank_index_ref(db, docid):
+    """
+    Returns the reference of an index doc.
+    """
+    return db.collection(RANK_INDEX_COLLECTION).document(docid)
+
+
+def rank_increments(db, old_doc, new_doc):
+    """
+    Returns the index updates of a user doc changing from `old_doc` to
+    `new_doc`.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        old_doc (dict): The stored user doc, or None for a new user
+        new_doc (dict): The user doc being written
+
+    Returns:
+        List of (document reference, increments keyed by field path)
+    """
+    old_bucket = rank_bucket(old_doc)
+    new_bucket = rank_bucket(new_doc)
+    if old_bucket == new_bucket:
+        return []
+    increments = []
+    for bucket, value in ((old_bucket, -1), (new_bucket, 1)):
+        if bucket is not None:
+            docid, field_path = bucket
+            increments.append((rank_index_ref(db, docid),
+                               {field_path: value}))
+    return increments
+
+
+def rebuild_rank_index(user_docs):
+    """
+    Builds the index docs from scratch.
+
+    Parameters:
+        user_docs (iterable): User docs with average_score and total_score
+
+    Returns:
+        Dictionary of index docs keyed by doc id
+    """
+    index = {str(point): {u'counts': {}} for point in range(RANK_INDEX_DOCS)}
+    for user_doc in user_docs:
+        bucket = rank_bucket(user_doc)
+        if bucket is None:
+            continue
+        docid, field_path = bucket
+        _, tenths, total_bucket = field_path.split('.')
+        counts = index.setdefault(docid, {u'counts': {}})[u'counts'] \
+            .setdefault(tenths, {})
+        counts[total_bucket] = counts.get(total_bucket, 0) + 1
+    return index
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline recompute of every user's stats and every round's histogram from
+the scores, for when the scoring rules or the stats change.
+
+The scores are read from a local dump, a JSON array or JSON lines of score
+docs, or straight from the `scores` collection. They are loaded into
+columns: a user code, the round, the score, the attempts and the hard mode
+flag per row. Rows
+are sorted once by user and round, after which every user's stats are a
+single pass over a contiguous slice and the histograms a count over
+(round, attempts) pairs. The results, and the rank index, round series
+and round counters rebuilt from them, are written back in batches of 500
+writes, committed from several threads. The leaderboard snapshot is then
+refreshed and the data version bumped, so the APIs serve the new stats.
+
+With `--rescore` the score of every row is recalculated from its attempts
+with the current `calculate_score`, and the score docs that change are
+rewritten too.
+
+The counters and the rank index are overwritten, not incremented, so the
+scores ingested while this runs would be lost from them: pause the
+store-scores trigger first. Nothing is written while an ingest run still
+holds the lease of a file or of a coalescing window.
+
+Against a local emulator, set FIRESTORE_EMULATOR_HOST before running.
+
+Usage:
+    python recompute_stats.py [--input scores.jsonl] [--project PROJECT]
+                              [--rescore] [--dry-run] [--workers N]
+"""
+
+import argparse
+import json
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fan_in import WINDOW_COLLECTION
+from ingest import MAX_BATCH_WRITES, chunked
+from json_stream import iter_array
+from leaderboard import refresh_leaderboard
+from ledger import LEASE_SECONDS, LEDGER_COLLECTION
+from rank_index import rank_index_ref, rebuild_rank_index
+from round_counters import COUNTER_FIELDS, bump_data_version, \
+    empty_totals, totals_writes
+from round_series import rebuild_round_series, series_ref
+from round_stats import empty_histogram, round_stats_ref
+from schema import SCORE_COLLECTION, USER_COLLECTION, score_docid
+from scoring import stored_score
+from user_stats import RoundBits, history_code
+
+DEFAULT_WORKERS = 8
+
+
+class ScoreColumns:
+    """
+    Score rows stored column by column, with users replaced by codes.
+    """
+
+    def __init__(self):
+        self.userids = []
+        self._user_codes = {}
+        self.users = array('l')
+        self.rounds = array('l')
+        self.scores = array('b')
+        self.attempts = array('b')
+        self.hard_mode = array('b')
+
+    def __len__(self):
+        return len(self.rounds)
+
+    def append(self, score_doc):
+        userid = score_doc['userid']
+        code = self._user_codes.get(userid)
+        if code is None:
+            code = self._user_codes[userid] = len(self.userids)
+            self.userids.append(userid)
+        self.users.append(code)
+        self.rounds.append(score_doc['roundid'])
+        self.scores.append(score_doc['score'])
+        self.attempts.append(score_doc.get('attempts', 0))
+        self.hard_mode.append(bool(score_doc.get('hard_mode')))
+
+    def rescore(self):
+        """
+        Recalculates every score from its attempts with the current rules.
+
+        Returns:
+            The indexes of the rows whose score changed
+        """
+        changed = []
+        for i, attempts in enumerate(self.attempts):
+            score = stored_score(attempts)
+            if score != self.scores[i]:
+                self.scores[i] = score
+                changed.append(i)
+        return changed
+
+    def sorted_rows(self):
+        """
+        Returns the row indexes ordered by user, then round, then the order
+        the rows were loaded in.
+        """
+        if not self.rounds:
+            return []
+        first_round = min(self.rounds)
+        span = max(self.rounds) - first_round + 1
+        keys = [user * span + roundid - first_round
+                for user, roundid in zip(self.users, self.rounds)]
+        # sorted() is stable, so the first of two rows for a user's round
+        # stays first
+        return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+def load_scores(path):
+    """
+    Loads score docs from a JSON array or a JSON lines file.
+    """
+    columns = ScoreColumns()
+    with open(path, 'rb') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == b'[':
+            for score_doc in iter_array(f):
+                columns.append(score_doc)
+        else:
+            for line in f:
+                if line.strip():
+                    columns.append(json.loads(line))
+    return columns
+
+
+def read_scores(db):
+    """
+    Loads every score doc of the `scores` collection.
+    """
+    columns = ScoreColumns()
+    score_docs = db.collection(SCORE_COLLECTION) \
+        .select([u'userid', u'roundid', u'score', u'attempts',
+                 u'hard_mode']) \
+        .stream()
+    for doc in score_docs:
+        columns.append(doc.to_dict())
+    return columns
+
+
+def recompute(columns):
+    """
+    Computes the stats of every user, and the histogram and totals of
+    every round. A second row for a user's round is ignored, like at
+    ingest.
+
+    Parameters:
+        columns (ScoreColumns): The score rows
+
+    Returns:
+        Tuple of the user stats keyed by userid, the round stats docs
+        keyed by roundid and the round totals, in the shape
+        `read_round_totals` returns
+    """
+    users, rounds, scores, attempts = \
+        columns.users, columns.rounds, columns.scores, columns.attempts
+
+    user_stats = {}
+    histogram_counts = Counter()
+    round_scores = Counter()
+    rows = columns.sorted_rows()
+    start = 0
+    while start < len(rows):
+        user = users[rows[start]]
+        end = start
+        while end < len(rows) and users[rows[end]] == user:
+            end += 1
+
+        bits = RoundBits(rounds[rows[start]])
+        previous = None
+        rounds_played = total_score = streak = max_streak = 0
+        for i in rows[start:end]:
+            roundid = rounds[i]
+            if roundid == previous:
+                continue
+            score = scores[i]
+            rounds_played += 1
+            total_score += score
+            if score > 0:
+                streak = streak + 1 if streak \
+                    and roundid == previous + 1 else 1
+                max_streak = max(max_streak, streak)
+            else:
+                streak = 0
+            bits.add(roundid, score > 0,
+                     history_code(attempts[i], columns.hard_mode[i]))
+            histogram_counts[roundid, attempts[i]] += 1
+            round_scores[roundid] += score
+            previous = roundid
+
+        stats = {
+            u'rounds_played': rounds_played,
+            u'last_round': previous,
+            u'average_score': round(total_score / rounds_played, 1),
+            u'total_score': total_score,
+            u'max_streak': max_streak,
+            u'current_streak': streak
+        }
+        bits.store(stats)
+        user_stats[columns.userids[user]] = stats
+        start = end
+
+    histograms = {}
+    for (roundid, round_attempts), count in histogram_counts.items():
+        stats = histograms.get(roundid)
+        if stats is None:
+            stats = histograms[roundid] = empty_histogram()
+        stats[u'players'] += count
+        stats[u'attempts'][str(round_attempts) if round_attempts
+                           else u'X'] += count
+
+    totals = empty_totals()
+    for roundid, stats in histograms.items():
+        round_totals = {
+            u'players': stats[u'players'],
+            u'failures': stats[u'attempts'][u'X'],
+            u'total_score': round_scores[roundid],
+            u'attempts': dict(stats[u'attempts'])
+        }
+        totals[u'rounds'][str(roundid)] = round_totals
+        for field in COUNTER_FIELDS:
+            totals[field] += round_totals[field]
+    return user_stats, histograms, totals
+
+
+def running_ingests(db, clock=time.time):
+    """
+    Returns the ids of the ledger and window docs an ingest run still holds
+    the lease of.
+    """
+    now = clock()
+    running = [doc.id for doc in db.collection(LEDGER_COLLECTION)
+               .where(u'status', u'==', u'running').stream()
+               if now - doc.to_dict().get(u'updated_at', 0) < LEASE_SECONDS]
+    running.extend(doc.id for doc in db.collection(WINDOW_COLLECTION)
+                   .stream()
+                   if doc.to_dict().get(u'holder') is not None
+                   and doc.to_dict().get(u'expires_at', 0) > now)
+    return running
+
+
+def write_results(db, user_stats, histograms, totals, score_docs=(),
+                  workers=DEFAULT_WORKERS):
+    """
+    Writes the recomputed stats, the round stats docs, the rank index,
+    round series and round counters rebuilt from them, and the given score
+    docs in batches of at most 500 writes, `workers` commits at a time.
+    User docs are merged so their profile fields are kept. The totals go
+    to the first shard of each counter and the other shards are zeroed.
+
+    Returns:
+        The number of documents written
+    """
+    user_coll_ref = db.collection(USER_COLLECTION)
+    score_coll_ref = db.collection(SCORE_COLLECTION)
+    writes = [(user_coll_ref.document(userid),
+               dict(stats, userid=userid), True)
+              for userid, stats in user_stats.items()]
+    writes.extend((round_stats_ref(db, roundid), histogram, False)
+                  for roundid, histogram in histograms.items())
+    writes.extend((rank_index_ref(db, docid), index_doc, False)
+                  for docid, index_doc in rebuild_rank_index(
+                      user_stats.values()).items())
+    writes.extend((series_ref(db, chunk), series, False)
+                  for chunk, series in rebuild_round_series(
+                      histograms).items())
+    writes.extend((doc_ref, data, False)
+                  for doc_ref, data in totals_writes(db, totals))
+    writes.extend((score_coll_ref.document(
+        score_docid(score_doc['roundid'], score_doc['userid'])),
+        score_doc, True) for score_doc in score_docs)
+
+    def commit(chunk):
+        batch = db.batch()
+        for doc_ref, data, merge in chunk:
+            batch.set(doc_ref, data, merge=merge)
+        batch.commit()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() so a failed commit is raised here
+        list(executor.map(commit, chunked(writes, MAX_BATCH_WRITES)))
+    return len(writes)
+
+
+def publish_results(db):
+    """
+    Rewrites the leaderboard snapshot from the recomputed stats and bumps
+    the data version, so the APIs drop the responses they cached from the
+    old ones. Called once every result is written.
+    """
+    refresh_leaderboard(db)
+    bump_data_version(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompute user stats and round histograms from the '
+                    'scores.')
+    parser.add_argument('--input', help='JSON or JSON lines dump of score '
+                        'docs, read from Firestore when left out')
+    parser.add_argument('--project', help='Google Cloud project id')
+    parser.add_argument('--rescore', action='store_true',
+                        help='recalculate scores from the attempts')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='recompute without writing anything')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='batches committed in parallel')
+    args = parser.parse_args()
+
+    db = None
+    if not (args.input and args.dry_run):
+        from google.cloud import firestore
+        db = firestore.Client(project=args.project)
+
+    start = time.perf_counter()
+    columns = load_scores(args.input) if args.input else read_scores(db)
+    print(f"Loaded {len(columns)} scores of {len(columns.userids)} users "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    rescored = []
+    if args.rescore:
+        rescored = [{
+            u'userid': columns.userids[columns.users[i]],
+            u'roundid': columns.rounds[i],
+            u'score': columns.scores[i]
+        } for i in columns.rescore()]
+        print(f"Rescored {len(rescored)} scores")
+
+    start = time.perf_counter()
+    user_stats, histograms, totals = recompute(columns)
+    print(f"Recomputed {len(user_stats)} users and {len(histograms)} "
+          f"rounds in {time.perf_counter() - start:.1f}s")
+
+    if not args.dry_run:
+        running = running_ingests(db)
+        if running:
+            parser.exit(1, f"Ingest runs hold {', '.join(running)}, pause "
+                           f"the store-scores trigger and run again\n")
+        start = time.perf_counter()
+        written = write_results(db, user_stats, histograms, totals,
+                                rescored, args.workers)
+        publish_results(db)
+        print(f"Wrote {written} documents in "
+              f"{time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from fan_in import IngestWindow
+from ingest import ingest_scores
+from ingest_test import make_tweets
+from ledger import Ledger
+from recompute_stats import ScoreColumns, load_scores, publish_results, \
+    read_scores, recompute, running_ingests, write_results
+from reconcile_user_stats import reconcile_user_stats
+from round_counters import read_round_totals, rebuild_round_totals
+from round_series import rebuild_round_series
+from round_stats import rebuild_round_stats
+from schema import AVERAGE_LEADERBOARD_DOCID, LEADERBOARD_COLLECTION, \
+    METADATA_COLLECTION, ROUND_COUNTER_COLLECTION, ROUND_DOCID, \
+    ROUND_SERIES_COLLECTION, ROUND_STATS_COLLECTION, SCORE_COLLECTION, \
+    USER_COLLECTION
+from user_stats import STAT_FIELDS, recompute_user_stats
+
+
+def random_scores(users, rounds, seed=3):
+    rng = random.Random(seed)
+    score_docs = []
+    for user in range(users):
+        for roundid in rng.sample(range(400, 400 + rounds * 2), rounds):
+            attempts = rng.choice([0, 1, 2, 3, 4, 5, 6])
+            score_docs.append({
+                'userid': f'user{user}',
+                'roundid': roundid,
+                'attempts': attempts,
+                'score': 7 - attempts if attempts else 0
+            })
+    rng.shuffle(score_docs)
+    return score_docs
+
+
+class TestRecompute(unittest.TestCase):
+    def test_matches_per_user_recompute(self):
+        score_docs = random_scores(users=40, rounds=30)
+        # a second row for a user's round is ignored
+        score_docs.append(dict(score_docs[0], score=6, attempts=1))
+        columns = ScoreColumns()
+        for score_doc in score_docs:
+            columns.append(score_doc)
+
+        user_stats, histograms, totals = recompute(columns)
+
+        for user in range(40):
+            userid = f'user{user}'
+            expected = recompute_user_stats(
+                doc for doc in score_docs[:-1] if doc['userid'] == userid)
+            self.assertEqual(user_stats[userid], expected)
+        self.assertEqual(histograms, rebuild_round_stats(score_docs[:-1]))
+        self.assertEqual(totals, rebuild_round_totals(score_docs[:-1]))
+
+    def test_load_json_and_json_lines(self):
+        score_docs = random_scores(users=3, rounds=4)
+        with tempfile.TemporaryDirectory() as directory:
+            array_path = os.path.join(directory, 'scores.json')
+            with open(array_path, 'w') as f:
+                json.dump(score_docs, f)
+            lines_path = os.path.join(directory, 'scores.jsonl')
+            with open(lines_path, 'w') as f:
+                f.write('\n'.join(json.dumps(doc) for doc in score_docs))
+
+            for path in (array_path, lines_path):
+                columns = load_scores(path)
+                self.assertEqual(len(columns), len(score_docs))
+                self.assertEqual(list(columns.rounds),
+                                 [doc['roundid'] for doc in score_docs])
+
+    def test_rescore(self):
+        columns = ScoreColumns()
+        columns.append({'userid': 'a', 'roundid': 400, 'attempts': 2,
+                        'score': 1})
+        columns.append({'userid': 'a', 'roundid': 401, 'attempts': 0,
+                        'score': 0})
+
+        self.assertEqual(columns.rescore(), [0])
+        self.assertEqual(list(columns.scores), [5, 0])
+
+
+class TestWriteResults(unittest.TestCase):
+    def test_rebuilds_stale_stats(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=30, rounds=5))
+        expected_totals = read_round_totals(db, range(400, 405))
+        db.collection(USER_COLLECTION).document('user0').set(
+            {'username': 'zero', 'max_streak': 99}, merge=True)
+        db.collection(ROUND_STATS_COLLECTION).document('401').delete()
+        db.collection(ROUND_COUNTER_COLLECTION).document('401_3').set(
+            {'players': 99})
+        expected_rounds = rebuild_round_stats(
+            doc.to_dict() for doc in db.collection(SCORE_COLLECTION).stream())
+        db.reset_counts()
+
+        user_stats, histograms, totals = recompute(read_scores(db))
+        with mock.patch('recompute_stats.MAX_BATCH_WRITES', 10):
+            written = write_results(db, user_stats, histograms, totals,
+                                    workers=4)
+
+        # 30 users, 5 rounds, the 7 rank index docs, a series chunk and
+        # the 10 shards of the global and each round's counter
+        self.assertEqual(written, 43 + 6 * 10)
+        self.assertEqual(db.rpc_counts['commit'], 11)
+        self.assertEqual(
+            db.dump(ROUND_SERIES_COLLECTION),
+            {str(chunk): series for chunk, series
+             in rebuild_round_series(expected_rounds).items()})
+        self.assertEqual(read_round_totals(db, range(400, 405)),
+                         expected_totals)
+        self.assertEqual(reconcile_user_stats(db)['mismatches'], {})
+        self.assertEqual(db.dump(USER_COLLECTION)['user0']['username'],
+                         'zero')
+        self.assertEqual(
+            db.dump(ROUND_STATS_COLLECTION),
+            {str(roundid): stats
+             for roundid, stats in expected_rounds.items()})
+        self.assertEqual(
+            {userid: {field: doc[field] for field in STAT_FIELDS}
+             for userid, doc in db.dump(USER_COLLECTION).items()},
+            user_stats)
+
+    def test_publishes_results(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=12, rounds=3))
+        user_stats, histograms, totals = recompute(read_scores(db))
+        write_results(db, user_stats, histograms, totals, workers=2)
+
+        publish_results(db)
+
+        leaderboard = db.dump(LEADERBOARD_COLLECTION)[
+            AVERAGE_LEADERBOARD_DOCID]
+        best = max(user_stats.values(),
+                   key=lambda stats: stats['average_score'])
+        self.assertEqual(leaderboard['data'][0]['average_score'],
+                         best['average_score'])
+        self.assertEqual(
+            db.dump(METADATA_COLLECTION)[ROUND_DOCID]['version'], 1)
+
+
+    def test_finds_running_ingests(self):
+        db = FakeClient()
+        # a crashed run whose lease lapsed does not hold its file
+        Ledger(db, 'bucket', 'tweets-0.json', '1', clock=lambda: 0).begin()
+        self.assertEqual(running_ingests(db), [])
+
+        ledger = Ledger(db, 'bucket', 'tweets-1.json', '1')
+        ledger.begin()
+        window = IngestWindow(db, 'bucket')
+        window.claim()
+        self.assertEqual(running_ingests(db), [
+            'bucket:tweets-1.json:1', 'bucket:tweets-'])
+
+        ledger.finish()
+        window.release()
+        self.assertEqual(running_ingests(db), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Verifies the stats stored on every user doc against a full recompute from
+the `scores` collection, and optionally overwrites the ones that differ,
+moving the repaired users to their bucket of the rank index.
+
+Usage:
+    python reconcile_user_stats.py [--project PROJECT] [--repair]
+"""
+
+import argparse
+
+from ingest import commit_in_batches, fetch_user_docs
+from rank_index import rank_increments
+from schema import SCORE_COLLECTION, USER_COLLECTION
+from user_stats import STAT_FIELDS, recompute_user_stats
+
+
+def reconcile_user_stats(db, repair=False):
+    """
+    Recomputes the stats of every user with scores and compares them with
+    the stored user docs.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        repair (bool): Overwrite the stats that differ with the recomputed
+            ones
+
+    Returns:
+        Dictionary with the number of users checked and repaired, and the
+        mismatched fields keyed by userid
+    """
+    user_scores = {}
+    score_docs = db.collection(SCORE_COLLECTION) \
+        .select([u'userid', u'roundid', u'score', u'attempts',
+                 u'hard_mode']) \
+        .stream()
+    for doc in score_docs:
+        score_doc = doc.to_dict()
+        user_scores.setdefault(score_doc['userid'], []).append(score_doc)
+
+    stored = fetch_user_docs(db, set(user_scores))
+    mismatches = {}
+    repairs = {}
+    for userid, scores in sorted(user_scores.items()):
+        expected = recompute_user_stats(scores)
+        user_doc = stored.get(userid, {})
+        fields = [field for field in STAT_FIELDS
+                  if user_doc.get(field) != expected[field]]
+        if fields:
+            mismatches[userid] = fields
+            repairs[userid] = expected
+
+    if repair:
+        user_coll_ref = db.collection(USER_COLLECTION)
+        groups = []
+        for userid in sorted(repairs):
+            repaired = dict(stored.get(userid, {}), **repairs[userid])
+            group = [('increment', index_ref, increments)
+                     for index_ref, increments in rank_increments(
+                         db, stored.get(userid), repaired)]
+            group.append(('set', user_coll_ref.document(userid),
+                          dict(repairs[userid], userid=userid)))
+            groups.append(group)
+        commit_in_batches(db, groups)
+
+    return {
+        u'users_checked': len(user_scores),
+        u'users_repaired': len(repairs) if repair else 0,
+        u'mismatches': mismatches
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Verify the stored user stats against the scores.')
+    parser.add_argument('--project', help='Google Cloud project id')
+    parser.add_argument('--repair', action='store_true',
+                        help='overwrite the stats that differ')
+    args = parser.parse_args()
+
+    from google.cloud import firestore
+    db = firestore.Client(project=args.project)
+    result = reconcile_user_stats(db, repair=args.repair)
+    for userid, fields in result['mismatches'].items():
+        print(f"user {userid} differs in {', '.join(fields)}")
+    print(f"Checked {result['users_checked']} users, "
+          f"{len(result['mismatches'])} differ, "
+          f"repaired {result['users_repaired']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Global and per-round totals, kept as sharded counters. The global totals
+are in `round_counters/all_{shard}` and each round's in
+`round_counters/{roundid}_{shard}`:
+
+    {
+        "players": 120,
+        "failures": 4,
+        "total_score": 340,
+        "attempts": {"1": 0, "2": 4, ..., "X": 4}     per round only
+    }
+
+so no counter doc grows with the number of rounds.
+
+Firestore sustains about one write per second on a document, and every
+ingest batch increments these totals. Each batch sums the increments of
+all its scores into one write per counter, all to the same shard, picked
+at random, so up to NUM_SHARDS batches can increment them at once. The
+totals of a set of rounds are the sum of their shards and the global
+shards, read with one `get_all` per MAX_GET_ALL docs.
+
+Ingest batches do not write the `round_stats/{roundid}` docs, which would
+make the current round's doc the hotspot. Once a file's scores are
+written, `refresh_round_series` copies the round histograms summed here
+into them, one write per round per file.
+
+The latest round in `metadata/rounds` is only ever moved forward, in a
+transaction, so concurrent ingests cannot move it back. Its `version` is
+bumped after every write that changes what the APIs serve.
+"""
+
+import random
+
+from instrumentation import count, span
+from round_stats import ATTEMPT_KEYS, attempt_key
+from schema import METADATA_COLLECTION, ROUND_COUNTER_COLLECTION, \
+    ROUND_DOCID
+
+# shards may be added but never removed, readers sum all of them
+NUM_SHARDS = 10
+
+# the counter of the totals over all rounds
+GLOBAL_COUNTER = u'all'
+
+COUNTER_FIELDS = [u'players', u'failures', u'total_score']
+
+# Firestore limit
+MAX_GET_ALL = 500
+
+
+def random_shard():
+    """
+    Returns the shard a write batch counts its scores in.
+    """
+    return random.randrange(NUM_SHARDS)
+
+
+def shard_ref(db, counter, shard):
+    """
+    Returns the reference of a shard doc of `counter`, a roundid or
+    GLOBAL_COUNTER.
+    """
+    return db.collection(ROUND_COUNTER_COLLECTION).document(
+        f'{counter}_{shard}')
+
+
+def counter_increments(score_doc):
+    """
+    Returns the counters a new score adds, as a list of the counter, a
+    roundid or GLOBAL_COUNTER, and its increments by field path.
+    """
+    failed = 1 if score_doc['attempts'] <= 0 else 0
+    increments = {
+        u'players': 1,
+        u'failures': failed,
+        u'total_score': score_doc['score']
+    }
+    round_increments = dict(increments)
+    round_increments[f'attempts.{attempt_key(score_doc)}'] = 1
+    return [(GLOBAL_COUNTER, increments),
+            (str(score_doc['roundid']), round_increments)]
+
+
+def empty_totals():
+    """
+    Returns round totals with all counters at zero.
+    """
+    totals = {field: 0 for field in COUNTER_FIELDS}
+    totals[u'rounds'] = {}
+    return totals
+
+
+def empty_round_totals():
+    """
+    Returns the totals of a round with all counters at zero.
+    """
+    round_totals = {field: 0 for field in COUNTER_FIELDS}
+    round_totals[u'attempts'] = {key: 0 for key in ATTEMPT_KEYS}
+    return round_totals
+
+
+def add_counters(target, counters):
+    """
+    Adds the counters of a shard doc to `target`, in place.
+    """
+    for field in COUNTER_FIELDS:
+        target[field] += counters.get(field, 0)
+    if u'attempts' in target:
+        for key, value in counters.get(u'attempts', {}).items():
+            target[u'attempts'][key] += value
+
+
+def round_histogram(round_totals):
+    """
+    Returns the round stats doc of a round's totals.
+    """
+    return {
+        u'players': round_totals[u'players'],
+        u'attempts': dict(round_totals[u'attempts'])
+    }
+
+
+def read_round_totals(db, roundids):
+    """
+    Returns the global totals and those of `roundids`, summed over every
+    shard.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        roundids (iterable): Rounds whose totals are read
+
+    Returns:
+        Dictionary of players, failures and total_score, with the same
+        counters and the attempts histogram of each round that has any
+        under `rounds`, keyed by the round as a string
+    """
+    counters = [GLOBAL_COUNTER] + [str(roundid)
+                                   for roundid in sorted(set(roundids))]
+    refs = [shard_ref(db, counter, shard)
+            for counter in counters for shard in range(NUM_SHARDS)]
+    totals = empty_totals()
+    for start in range(0, len(refs), MAX_GET_ALL):
+        chunk = refs[start:start + MAX_GET_ALL]
+        with span('firestore.get_all'):
+            for doc in db.get_all(chunk):
+                if not doc.exists:
+                    continue
+                counter = doc.id.rsplit('_', 1)[0]
+                if counter == GLOBAL_COUNTER:
+                    add_counters(totals, doc.to_dict())
+                else:
+                    add_counters(totals[u'rounds'].setdefault(
+                        counter, empty_round_totals()), doc.to_dict())
+        count('docs_read', len(chunk))
+    return totals
+
+
+def rebuild_round_totals(score_docs):
+    """
+    Builds the round totals from scratch.
+
+    Parameters:
+        score_docs (iterable): Score dictionaries with roundid, score and
+            attempts
+
+    Returns:
+        The totals, in the shape `read_round_totals` returns
+    """
+    totals = empty_totals()
+    for score_doc in score_docs:
+        for counter, increments in counter_increments(score_doc):
+            target = totals if counter == GLOBAL_COUNTER else \
+                totals[u'rounds'].setdefault(counter, empty_round_totals())
+            for field_path, value in increments.items():
+                parts = field_path.split('.')
+                fields = target
+                for part in parts[:-1]:
+                    fields = fields[part]
+                fields[parts[-1]] += value
+    return totals
+
+
+def totals_writes(db, totals):
+    """
+    Returns the writes that replace the counters with `totals`: the
+    totals in shard 0 of each counter, and every other shard zeroed.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        totals (dict): Totals in the shape `read_round_totals` returns
+
+    Returns:
+        List of (document reference, data)
+    """
+    counters = [(GLOBAL_COUNTER, {field: totals[field]
+                                  for field in COUNTER_FIELDS},
+                 {field: 0 for field in COUNTER_FIELDS})]
+    counters.extend((roundid, round_totals, empty_round_totals())
+                    for roundid, round_totals in sorted(
+                        totals[u'rounds'].items()))
+    return [(shard_ref(db, counter, shard), data if shard == 0 else zeroed)
+            for counter, data, zeroed in counters
+            for shard in range(NUM_SHARDS)]
+
+
+def advance_latest_round(db, latest_round):
+    """
+    Sets the latest round in the rounds metadata to `latest_round` unless
+    it already is at or past it, in a transaction.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        latest_round (int): The latest round of the ingested file
+
+    Returns:
+        Whether the latest round moved forward
+    """
+    from google.cloud import firestore
+
+    round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+
+    @firestore.transactional
+    def advance(transaction):
+        current = round_ref.get(transaction=transaction).to_dict() or {}
+        if current.get(u'latest_round', 0) >= latest_round:
+            return False
+        transaction.set(round_ref, {u'latest_round': latest_round},
+                        merge=True)
+        return True
+
+    return advance(db.transaction())
+
+
+def bump_data_version(db):
+    """
+    Bumps the data version in the rounds metadata, which tells the APIs
+    that their cached responses are out of date. Called last, once all the
+    data the APIs read has been written.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+    """
+    from google.cloud import firestore
+
+    round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+    with span('firestore.set'):
+        round_ref.set({
+            u'version': firestore.Increment(1)
+        }, merge=True)
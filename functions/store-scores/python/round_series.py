@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time series of the round stats, in `round_series/{chunk}` docs that each
+hold SERIES_CHUNK_ROUNDS consecutive rounds as packed arrays:
+
+    {
+        "first_round": 400,
+        "players": [120, 131, ...],        one per round
+        "attempts": [0, 4, 31, 50, 22, 9, 4, 1, 6, ...]
+    }
+
+`attempts` holds the histogram of each round in turn, in ATTEMPT_KEYS
+order, so round `first_round + i` starts at index `i * 7`. A range of
+rounds is read with one `get_all` of a doc per SERIES_CHUNK_ROUNDS rounds,
+rather than a doc per round.
+
+After scores are written, the histograms of the rounds they touched are
+read from the round counters and copied into their `round_stats` docs and
+chunks, in a transaction per chunk so two ingests touching the same chunk
+cannot overwrite each other's rounds. The counters only grow, so a count
+lower than the stored one was read before another ingest's refresh and
+is left alone.
+"""
+
+from instrumentation import count, span
+from round_counters import empty_round_totals, read_round_totals, \
+    round_histogram
+from round_stats import ATTEMPT_KEYS, round_stats_ref
+from schema import ROUND_SERIES_COLLECTION
+
+# rounds per chunk doc, a chunk is about 6KB
+SERIES_CHUNK_ROUNDS = 100
+
+
+def series_chunk(roundid):
+    """
+    Returns the chunk a round is stored in.
+    """
+    return roundid // SERIES_CHUNK_ROUNDS
+
+
+def series_ref(db, chunk):
+    """
+    Returns the reference of a series chunk doc.
+    """
+    return db.collection(ROUND_SERIES_COLLECTION).document(str(chunk))
+
+
+def empty_series(chunk):
+    """
+    Returns a series chunk doc with all counters at zero.
+    """
+    return {
+        u'first_round': chunk * SERIES_CHUNK_ROUNDS,
+        u'players': [0] * SERIES_CHUNK_ROUNDS,
+        u'attempts': [0] * (SERIES_CHUNK_ROUNDS * len(ATTEMPT_KEYS))
+    }
+
+
+def set_round(series, roundid, stats):
+    """
+    Copies the stats doc of a round into its chunk doc, in place.
+    """
+    offset = roundid - series[u'first_round']
+    series[u'players'][offset] = stats.get(u'players', 0)
+    attempts = stats.get(u'attempts', {})
+    start = offset * len(ATTEMPT_KEYS)
+    for index, key in enumerate(ATTEMPT_KEYS):
+        series[u'attempts'][start + index] = attempts.get(key, 0)
+
+
+def latest_stats(stored, counted):
+    """
+    Returns the per counter maximum of two round stats docs.
+    """
+    attempts = stored.get(u'attempts', {})
+    return {
+        u'players': max(stored.get(u'players', 0), counted[u'players']),
+        u'attempts': {key: max(attempts.get(key, 0), value)
+                      for key, value in counted[u'attempts'].items()}
+    }
+
+
+def refresh_round_series(db, roundids):
+    """
+    Copies the counted histograms of `roundids` into their round stats
+    docs and series chunks.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        roundids (iterable): Rounds whose stats changed
+
+    Returns:
+        The number of chunk docs written
+    """
+    from google.cloud import firestore
+
+    roundids = set(roundids)
+    chunks = {}
+    for roundid in roundids:
+        chunks.setdefault(series_chunk(roundid), []).append(roundid)
+    # read outside of the transactions, so ingests keep incrementing
+    totals = read_round_totals(db, roundids)[u'rounds']
+
+    for chunk, chunk_rounds in sorted(chunks.items()):
+        chunk_ref = series_ref(db, chunk)
+        stats_refs = [round_stats_ref(db, roundid)
+                      for roundid in sorted(chunk_rounds)]
+
+        @firestore.transactional
+        def refresh(transaction):
+            series = chunk_ref.get(transaction=transaction).to_dict() \
+                or empty_series(chunk)
+            for doc in transaction.get_all(stats_refs):
+                stats = latest_stats(doc.to_dict() or {}, round_histogram(
+                    totals.get(doc.id) or empty_round_totals()))
+                transaction.set(doc.reference, stats)
+                set_round(series, int(doc.id), stats)
+            transaction.set(chunk_ref, series)
+
+        with span('firestore.transaction'):
+            refresh(db.transaction())
+        count('docs_read', 1 + len(stats_refs))
+        count('docs_written', 1 + len(stats_refs))
+    return len(chunks)
+
+
+def rebuild_round_series(histograms):
+    """
+    Builds the series chunk docs from scratch.
+
+    Parameters:
+        histograms (dict): Round stats docs keyed by roundid
+
+    Returns:
+        Dictionary of series chunk docs keyed by chunk
+    """
+    series = {}
+    for roundid, stats in histograms.items():
+        chunk = series_chunk(roundid)
+        if chunk not in series:
+            series[chunk] = empty_series(chunk)
+        set_round(series[chunk], roundid, stats)
+    return series
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-round attempt histograms kept in `round_stats/{roundid}`:
+
+    {
+        "players": 120,
+        "attempts": {"1": 0, "2": 4, "3": 31, "4": 50, "5": 22, "6": 9,
+                     "X": 4}
+    }
+
+store-scores increments the histogram as scores are ingested, so
+api-round-attempts can serve the last N rounds with a single `get_all`.
+"""
+
+from schema import ROUND_STATS_COLLECTION
+
+ATTEMPT_KEYS = [u'1', u'2', u'3', u'4', u'5', u'6', u'X']
+
+
+def attempt_key(score_doc):
+    """
+    Returns the histogram bucket of a score, 'X' for a failed round.
+    """
+    attempts = score_doc['attempts']
+    return str(attempts) if attempts > 0 else u'X'
+
+
+def round_stats_ref(db, roundid):
+    """
+    Returns the reference of a round's stats doc.
+    """
+    return db.collection(ROUND_STATS_COLLECTION).document(str(roundid))
+
+
+def score_increments(score_doc):
+    """
+    Returns the counters a new score adds to its round, as field paths.
+    """
+    return {
+        u'players': 1,
+        f'attempts.{attempt_key(score_doc)}': 1
+    }
+
+
+def increment_payload(increments):
+    """
+    Turns summed field path counters into a document that applies them
+    with server side increments, for `set(..., merge=True)`.
+    """
+    from google.cloud.firestore import Increment
+
+    payload = {}
+    for field_path, value in increments.items():
+        parts = field_path.split('.')
+        target = payload
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = Increment(value)
+    return payload
+
+
+def empty_histogram():
+    """
+    Returns a round stats doc with all counters at zero.
+    """
+    return {
+        u'players': 0,
+        u'attempts': {key: 0 for key in ATTEMPT_KEYS}
+    }
+
+
+def rebuild_round_stats(score_docs):
+    """
+    Builds the round stats docs from scratch.
+
+    Parameters:
+        score_docs (iterable): Score dictionaries with roundid and attempts
+
+    Returns:
+        Dictionary of round stats docs keyed by roundid
+    """
+    histograms = {}
+    for score_doc in score_docs:
+        stats = histograms.get(score_doc['roundid'])
+        if stats is None:
+            stats = histograms[score_doc['roundid']] = empty_histogram()
+        stats[u'players'] += 1
+        stats[u'attempts'][attempt_key(score_doc)] += 1
+    return histograms
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Firestore collection and document names written by store-scores.
+"""
+
+METADATA_COLLECTION = u'metadata'
+SCORE_COLLECTION = u'scores'
+USER_COLLECTION = u'users'
+PROFILE_COLLECTION = u'profiles'
+ROUND_DOCID = u'rounds'
+ROUND_STATS_COLLECTION = u'round_stats'
+ROUND_COUNTER_COLLECTION = u'round_counters'
+ROUND_SERIES_COLLECTION = u'round_series'
+RANK_INDEX_COLLECTION = u'rank_index'
+SCORE_LOG_COLLECTION = u'score_log'
+LEADERBOARD_COLLECTION = u'leaderboards'
+AVERAGE_LEADERBOARD_DOCID = u'average'
+
+
+def score_docid(roundid, userid):
+    """
+    Returns the deterministic id of a user's score doc for a round, so a
+    duplicate score is detected by a single point write.
+    """
+    return f'{roundid}_{userid}'
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append-only log of parsed scores, written by the 'log' ingest mode.
+
+A file's scores are appended to `score_log` in chunk docs of up to
+LOG_CHUNK_ROWS rows, stored as columns since Firestore has no nested
+arrays:
+
+    {
+        "created_at": 1665990000.0,
+        "rows": 2,
+        "roundid": [455, 455],
+        "userid": ["123", "456"],
+        "score": [3, 0],
+        "attempts": [4, 0],
+        "hard_mode": [false, false],
+        "tweetid": ["1580...", "1580..."]
+    }
+
+so an ingest costs one write per chunk, however many users it scores.
+
+Compaction folds the oldest chunks into the scores, user stats and
+round counters in bulk with `ingest_scores`, which writes each
+user's doc once per run, then deletes them. Score docs keep their
+deterministic ids, so a chunk appended twice, or compacted again after a
+crash before its delete, adds no duplicate.
+"""
+
+import time
+
+from ingest import MAX_BATCH_WRITES, chunked, ingest_scores
+from instrumentation import count, span
+from schema import SCORE_LOG_COLLECTION
+
+# rows per chunk doc, about 100KB, well under Firestore's 1MB doc limit
+LOG_CHUNK_ROWS = 2000
+
+# chunk docs per commit, under Firestore's 10MB request limit
+LOG_CHUNKS_PER_COMMIT = 20
+
+# chunk docs folded per compaction run
+MAX_COMPACT_CHUNKS = 50
+
+LOG_FIELDS = [u'roundid', u'userid', u'score', u'attempts', u'hard_mode',
+              u'tweetid']
+
+
+def to_chunk(score_docs, created_at):
+    """
+    Returns the chunk doc of a list of score docs.
+    """
+    chunk = {field: [score_doc[field] for score_doc in score_docs]
+             for field in LOG_FIELDS}
+    chunk[u'rows'] = len(score_docs)
+    chunk[u'created_at'] = created_at
+    return chunk
+
+
+def from_chunk(chunk):
+    """
+    Returns the score docs of a chunk doc.
+    """
+    columns = [chunk[field] for field in LOG_FIELDS]
+    return [dict(zip(LOG_FIELDS, row)) for row in zip(*columns)]
+
+
+def append_scores(db, score_docs, clock=time.time):
+    """
+    Appends score docs to the log.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        score_docs (list): Dictionaries of score, roundid, userid, tweetid
+        clock (callable): Returns the current time in seconds
+
+    Returns:
+        The number of chunk docs written
+    """
+    log_coll_ref = db.collection(SCORE_LOG_COLLECTION)
+    chunks = chunked(score_docs, LOG_CHUNK_ROWS)
+    created_at = clock()
+    for commit_chunks in chunked(chunks, LOG_CHUNKS_PER_COMMIT):
+        batch = db.batch()
+        for rows in commit_chunks:
+            batch.set(log_coll_ref.document(), to_chunk(rows, created_at))
+        with span('firestore.commit'):
+            batch.commit()
+        count('docs_written', len(commit_chunks))
+    count('rows_logged', len(score_docs))
+    return len(chunks)
+
+
+def compact_score_log(db, max_chunks=MAX_COMPACT_CHUNKS):
+    """
+    Folds the oldest chunks of the log into the scores and stats, then
+    deletes them.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+        max_chunks (int): Most chunk docs folded in this run
+
+    Returns:
+        Dictionary with the number of chunks and rows compacted, the
+        rounds among them, the latest one, and the ingest summary of their
+        scores
+    """
+    query = db.collection(SCORE_LOG_COLLECTION) \
+        .order_by(u'created_at').limit(max_chunks)
+    with span('firestore.query'):
+        chunk_docs = list(query.stream())
+    count('docs_read', len(chunk_docs))
+
+    score_docs = []
+    for chunk_doc in chunk_docs:
+        score_docs.extend(from_chunk(chunk_doc.to_dict()))
+
+    summary = ingest_scores(db, score_docs)
+
+    # the chunks are only deleted once their scores are committed
+    for refs in chunked([doc.reference for doc in chunk_docs],
+                        MAX_BATCH_WRITES):
+        batch = db.batch()
+        for ref in refs:
+            batch.delete(ref)
+        with span('firestore.commit'):
+            batch.commit()
+
+    rounds = sorted({score_doc['roundid'] for score_doc in score_docs})
+    return dict(summary, **{
+        u'chunks': len(chunk_docs),
+        u'rows': len(score_docs),
+        u'rounds': rounds,
+        u'latest_round': rounds[-1] if rounds else 0
+    })
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scoring of Wordle results.
+
+Every function deploys its own directory, so this module is kept identical
+in store-scores, which stores the scores, and api-user-history, which
+derives them from the round history.
+"""
+
+
+def calculate_score(attempts):
+    """
+    Calculate score based on # of attempts.
+    If failed to complete (attempt = X), then score = 0
+    If completed in 1 attempt, then score = 6
+
+    Parameters:
+        attempts (string): Number of attempts
+
+    Returns:
+        The score based on the number of attempts
+
+    Exception:
+        ValueError: when the attempts is out of bounds
+    """
+    score = 0
+    if not attempts.isdigit():
+        return score
+
+    attempts = int(attempts)
+    if attempts > 0 and attempts <= 6:
+        score = 6 - attempts + 1
+    else:
+        raise ValueError(f'Score of {attempts} is invalid')
+
+    return score
+
+
+def stored_score(attempts):
+    """
+    Returns the score of stored attempts, 0 standing for a failed round.
+    """
+    return calculate_score(str(attempts) if attempts else 'X')
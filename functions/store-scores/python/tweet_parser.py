@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parsing of Wordle result tweets into score docs.
+
+The round, the attempts and the hard mode marker are read with a single
+compiled regex, which finds "Wordle <round> <attempts>/6[*]" anywhere in
+the tweet, in any case and with any whitespace between the terms, e.g.
+
+    Wordle 412 4/6*
+    my streak lives! wordle  #1,024 X/6
+
+Entries that cannot be parsed are not logged one by one but counted per
+reason in a `ParseReport`, which keeps a few sample tweet ids per reason.
+"""
+
+import re
+from collections import Counter
+
+from scoring import calculate_score
+
+# only "wordle" is matched case-insensitively, which keeps the scan fast
+TWEET_PATTERN = re.compile(
+    r'(?i:wordle)\s+#?(\d+(?:,\d{3})*)\s+(\d+|[xX])/6(\*?)', re.ASCII)
+
+# score and stored attempts of every valid attempts term
+_RESULTS = {term: (calculate_score(term), 0) for term in ('x', 'X')}
+_RESULTS.update({str(n): (calculate_score(str(n)), n) for n in range(1, 7)})
+
+# rejection reasons
+MISSING_FIELD = 'missing_field'
+NO_MATCH = 'no_match'
+INVALID_ATTEMPTS = 'invalid_attempts'
+
+# sample tweet ids kept per rejection reason
+MAX_SAMPLES = 5
+
+
+class ParseError(ValueError):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def parse_tweet(entry):
+    """
+    Builds the score doc for a single tweet entry.
+
+    Parameters:
+        entry (Object): A dictionary with tweetId, authorId and tweet
+
+    Returns:
+        A dictionary of score, roundid, userid, attempts, hard_mode, tweetid
+
+    Exception:
+        ParseError: a ValueError with the rejection reason, when the entry
+            is not a Wordle result
+    """
+    score_doc, reason = _parse(entry)
+    if score_doc is None:
+        raise ParseError(reason, _MESSAGES[reason].format(entry=entry))
+    return score_doc
+
+
+_MESSAGES = {
+    MISSING_FIELD: 'Entry is not a tweet: {entry!r:.200}',
+    NO_MATCH: 'Tweet {entry[tweetId]} is not a Wordle result',
+    INVALID_ATTEMPTS: 'Tweet {entry[tweetId]} has invalid attempts',
+}
+
+
+def _parse(entry, _search=TWEET_PATTERN.search, _results=_RESULTS):
+    """
+    Returns the score doc of `entry` and None, or None and the reason it is
+    rejected. Parsing a file is dominated by this function, so it avoids
+    raising for rejected entries.
+    """
+    try:
+        tweetid = entry['tweetId']
+        userid = entry['authorId']
+        match = _search(entry['tweet'])
+    except (KeyError, TypeError):
+        return None, MISSING_FIELD
+    if match is None:
+        return None, NO_MATCH
+
+    roundid, attempts, hard_mode = match.groups()
+    result = _results.get(attempts)
+    if result is None:
+        return None, INVALID_ATTEMPTS
+
+    return {
+        u'roundid': int(roundid.replace(',', '')) if ',' in roundid
+        else int(roundid),
+        u'userid': userid,
+        u'score': result[0],
+        u'attempts': result[1],
+        u'hard_mode': hard_mode == '*',
+        u'tweetid': tweetid
+    }, None
+
+
+class ParseReport:
+    """
+    Parses tweet entries and keeps count of the rejected ones per reason.
+    """
+
+    def __init__(self):
+        self.parsed = 0
+        self.rejected = Counter()
+        self.samples = {}
+
+    def parse(self, entry):
+        """
+        Returns the score doc of `entry`, or None when it is rejected.
+        """
+        score_doc, reason = _parse(entry)
+        if score_doc is None:
+            self.reject(reason, entry)
+        else:
+            self.parsed += 1
+        return score_doc
+
+    def reject(self, reason, entry):
+        self.rejected[reason] += 1
+        samples = self.samples.setdefault(reason, [])
+        if len(samples) < MAX_SAMPLES:
+            tweetid = entry.get('tweetId') if isinstance(entry, dict) \
+                else None
+            samples.append(tweetid)
+
+    def summary(self):
+        """
+        Returns the parsed and rejected counts, with sample tweet ids of
+        the rejected entries.
+        """
+        return {
+            u'parsed': self.parsed,
+            u'rejected': sum(self.rejected.values()),
+            u'reasons': dict(self.rejected),
+            u'samples': dict(self.samples)
+        }
+
+
+def parse_tweets(entries):
+    """
+    Parses a whole file's worth of tweet entries.
+
+    Parameters:
+        entries (iterable): Tweet entries with a tweetId, authorId, and tweet
+
+    Returns:
+        Tuple of the list of score docs and the ParseReport
+    """
+    report = ParseReport()
+    score_docs = []
+    append = score_docs.append
+    for entry in entries:
+        score_doc, reason = _parse(entry)
+        if score_doc is None:
+            report.reject(reason, entry)
+        else:
+            append(score_doc)
+    report.parsed += len(score_docs)
+    return score_docs, report
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from tweet_parser import INVALID_ATTEMPTS, MISSING_FIELD, NO_MATCH, \
+    ParseError, parse_tweet, parse_tweets
+
+
+def entry(tweet, tweetid='1', userid='user'):
+    return {'tweetId': tweetid, 'authorId': userid, 'tweet': tweet}
+
+
+class TestParseTweet(unittest.TestCase):
+    def test_plain_result(self):
+        self.assertEqual(parse_tweet(entry('Wordle 412 4/6\n\n🟩🟩🟩🟩🟩')), {
+            'roundid': 412,
+            'userid': 'user',
+            'score': 3,
+            'attempts': 4,
+            'hard_mode': False,
+            'tweetid': '1'
+        })
+
+    def test_hard_mode(self):
+        score_doc = parse_tweet(entry('Wordle 412 2/6*'))
+        self.assertTrue(score_doc['hard_mode'])
+        self.assertEqual(score_doc['score'], 5)
+
+    def test_failed_round(self):
+        score_doc = parse_tweet(entry('wordle 412 x/6'))
+        self.assertEqual((score_doc['score'], score_doc['attempts']), (0, 0))
+
+    def test_text_before_and_extra_whitespace(self):
+        score_doc = parse_tweet(entry('phew!!  WORDLE   #1,024\t3/6 🎉'))
+        self.assertEqual((score_doc['roundid'], score_doc['attempts']),
+                         (1024, 3))
+
+    def test_rejections(self):
+        cases = [
+            ({'tweetId': '1', 'tweet': 'Wordle 412 4/6'}, MISSING_FIELD),
+            (entry(None), MISSING_FIELD),
+            (entry('I love wordle'), NO_MATCH),
+            (entry('Wordle 412 4/5'), NO_MATCH),
+            (entry('Wordle 412 7/6'), INVALID_ATTEMPTS),
+            (entry('Wordle 412 0/6'), INVALID_ATTEMPTS),
+        ]
+        for tweet_entry, reason in cases:
+            with self.assertRaises(ParseError) as context:
+                parse_tweet(tweet_entry)
+            self.assertEqual(context.exception.reason, reason)
+            self.assertIsInstance(context.exception, ValueError)
+
+
+class TestParseTweets(unittest.TestCase):
+    def test_batch_and_summary(self):
+        entries = [entry(f'Wordle {400 + i} {i % 6 + 1}/6', tweetid=str(i))
+                   for i in range(10)]
+        entries += [entry('gm', tweetid=f'gm{i}') for i in range(7)]
+        entries.append(entry('Wordle 400 9/6', tweetid='nine'))
+        entries.append('not an entry')
+
+        score_docs, report = parse_tweets(entries)
+
+        self.assertEqual([doc['roundid'] for doc in score_docs],
+                         list(range(400, 410)))
+        self.assertEqual(report.summary(), {
+            'parsed': 10,
+            'rejected': 9,
+            'reasons': {NO_MATCH: 7, INVALID_ATTEMPTS: 1, MISSING_FIELD: 1},
+            'samples': {
+                NO_MATCH: ['gm0', 'gm1', 'gm2', 'gm3', 'gm4'],
+                INVALID_ATTEMPTS: ['nine'],
+                MISSING_FIELD: [None]
+            }
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+User game stats, folded in one score at a time.
+
+Besides the stats, the user doc keeps two bitmaps of the rounds the user
+played and the rounds they scored in, and their round history, all offset
+by `rounds_base`:
+
+    rounds_base     first round of the bitmaps
+    played_bits     bit n set when round rounds_base + n was played
+    scored_bits     bit n set when it was played with a score above 0
+    round_history   byte n the attempts at round rounds_base + n, 7 when
+                    failed, with HARD_MODE_BIT set in hard mode, and 0
+                    when not played
+
+A streak is a run of consecutive scored rounds, so the streak through a
+round that arrives late, or the current streak ending at the last round,
+is read from the bitmaps without looking at any score doc. An in order
+round only sets a bit; a round before `rounds_base` shifts the bitmaps by
+the gap.
+
+A user's whole history is a few hundred bytes, served by api-user-history
+with a single read of the user doc.
+
+User docs written before the bitmaps existed are seeded with the rounds
+their current streak implies, and rounds played before the history existed
+are 0 in it; `reconcile_user_stats.py` rebuilds the exact bitmaps and
+history from the scores.
+"""
+
+# stats derived from a user's scores
+STAT_FIELDS = [
+    u'rounds_played',
+    u'last_round',
+    u'average_score',
+    u'total_score',
+    u'max_streak',
+    u'current_streak',
+    u'rounds_base',
+    u'played_bits',
+    u'scored_bits',
+    u'round_history',
+]
+
+# round history byte of a failed round, and the flag of a hard mode round
+FAILED_CODE = 7
+HARD_MODE_BIT = 0x80
+
+
+def history_code(attempts, hard_mode=False):
+    """
+    Returns the round history byte of a score's attempts, FAILED_CODE for
+    a failed round, with HARD_MODE_BIT set in hard mode.
+    """
+    code = attempts if attempts > 0 else FAILED_CODE
+    return code | HARD_MODE_BIT if hard_mode else code
+
+
+class RoundBits:
+    """
+    The played and scored bitmaps of a user, as integers, and their round
+    history.
+    """
+
+    def __init__(self, base, played=0, scored=0, history=b''):
+        self.base = base
+        self.played = played
+        self.scored = scored
+        self.history = bytearray(history or b'')
+
+    @classmethod
+    def from_user_doc(cls, user_doc, roundid):
+        """
+        Reads the bitmaps of a user doc, or starts them at `roundid` for a
+        user doc without any.
+        """
+        if u'rounds_base' in user_doc:
+            return cls(user_doc[u'rounds_base'],
+                       _to_int(user_doc.get(u'played_bits')),
+                       _to_int(user_doc.get(u'scored_bits')),
+                       user_doc.get(u'round_history'))
+
+        last_round = user_doc.get(u'last_round')
+        if last_round is None:
+            return cls(roundid)
+
+        # the rounds of the current streak are known to be scored
+        streak = user_doc.get(u'current_streak', 0)
+        bits = cls(last_round - max(streak, 1) + 1)
+        bits.scored = (1 << streak) - 1
+        bits.played = bits.scored | 1 << (last_round - bits.base)
+        return bits
+
+    def store(self, user_doc):
+        user_doc[u'rounds_base'] = self.base
+        user_doc[u'played_bits'] = _to_bytes(self.played)
+        user_doc[u'scored_bits'] = _to_bytes(self.scored)
+        user_doc[u'round_history'] = bytes(self.history)
+
+    @property
+    def last_round(self):
+        return self.base + self.played.bit_length() - 1
+
+    def has_played(self, roundid):
+        return roundid >= self.base \
+            and bool(self.played >> (roundid - self.base) & 1)
+
+    def add(self, roundid, scored, code=0):
+        if roundid < self.base:
+            gap = self.base - roundid
+            self.played <<= gap
+            self.scored <<= gap
+            self.history[0:0] = bytes(gap)
+            self.base = roundid
+        position = roundid - self.base
+        bit = 1 << position
+        self.played |= bit
+        if scored:
+            self.scored |= bit
+        if code:
+            if len(self.history) <= position:
+                self.history.extend(bytes(position + 1 - len(self.history)))
+            self.history[position] = code
+
+    def run_ending(self, roundid):
+        """
+        Length of the run of scored rounds ending at `roundid`.
+        """
+        position = roundid - self.base
+        if position < 0:
+            return 0
+        mask = (1 << (position + 1)) - 1
+        gaps = ~self.scored & mask
+        if not gaps:
+            return position + 1
+        return position - gaps.bit_length() + 1
+
+    def run_starting(self, roundid):
+        """
+        Length of the run of scored rounds starting at `roundid`.
+        """
+        above = self.scored >> (roundid - self.base)
+        return (~above & (above + 1)).bit_length() - 1
+
+    def run_through(self, roundid):
+        """
+        Length of the run of scored rounds that includes `roundid`.
+        """
+        if not self.scored >> (roundid - self.base) & 1:
+            return 0
+        return self.run_ending(roundid) + self.run_starting(roundid) - 1
+
+    def max_run(self):
+        """
+        Length of the longest run of scored rounds, in one pass over the
+        bitmap; only used for a full recompute.
+        """
+        longest = 0
+        scored = self.scored
+        while scored:
+            run = (~scored & (scored + 1)).bit_length() - 1
+            longest = max(longest, run)
+            scored >>= run
+            # skip the unscored rounds up to the next run
+            scored >>= (scored & -scored).bit_length() - 1 if scored else 0
+        return longest
+
+
+def _to_int(bits):
+    return int.from_bytes(bits, 'little') if bits else 0
+
+
+def _to_bytes(value):
+    return value.to_bytes((value.bit_length() + 7) // 8, 'little')
+
+
+def apply_score(user_doc, score_doc):
+    """
+    Folds a new score into the user's game stats, in memory. Rounds may
+    arrive in any order; a round the user already played is ignored.
+
+    Parameters:
+        user_doc (Object): The current user doc, or None for a new user
+        score_doc (Object): A dictionary of score details
+
+    Returns:
+        The updated user doc
+    """
+    roundid = score_doc['roundid']
+    current_score = score_doc['score']
+
+    if user_doc is None:
+        user_doc = {u'userid': score_doc['userid']}
+    else:
+        user_doc = dict(user_doc)
+
+    bits = RoundBits.from_user_doc(user_doc, roundid)
+    if bits.has_played(roundid):
+        return user_doc
+    bits.add(roundid, current_score > 0,
+             history_code(score_doc['attempts'], score_doc.get('hard_mode')))
+    bits.store(user_doc)
+
+    rounds_played = user_doc.get('rounds_played', 0) + 1
+    total_score = user_doc.get('total_score', 0) + current_score
+    user_doc[u'rounds_played'] = rounds_played
+    user_doc[u'total_score'] = total_score
+    user_doc[u'average_score'] = round(total_score / rounds_played, 1)
+    user_doc[u'last_round'] = bits.last_round
+
+    # streak if contiguous games played and score is > 0
+    # if current game was not successful then streak is lost
+    user_doc[u'current_streak'] = bits.run_ending(bits.last_round)
+    user_doc[u'max_streak'] = max(user_doc.get('max_streak', 0),
+                                  bits.run_through(roundid))
+
+    return user_doc
+
+
+def recompute_user_stats(score_docs):
+    """
+    Computes a user's stats from all of their scores at once.
+
+    Parameters:
+        score_docs (iterable): The user's score dictionaries, with roundid,
+            score, attempts and hard_mode, in any order
+
+    Returns:
+        Dictionary of the STAT_FIELDS, or None when there are no scores
+    """
+    bits = None
+    total_score = 0
+    for score_doc in score_docs:
+        if bits is None:
+            bits = RoundBits(score_doc['roundid'])
+        if bits.has_played(score_doc['roundid']):
+            continue
+        bits.add(score_doc['roundid'], score_doc['score'] > 0,
+                 history_code(score_doc['attempts'],
+                              score_doc.get('hard_mode')))
+        total_score += score_doc['score']
+    if bits is None:
+        return None
+
+    rounds_played = bin(bits.played).count('1')
+    stats = {
+        u'rounds_played': rounds_played,
+        u'last_round': bits.last_round,
+        u'average_score': round(total_score / rounds_played, 1),
+        u'total_score': total_score,
+        u'max_streak': bits.max_run(),
+        u'current_streak': bits.run_ending(bits.last_round)
+    }
+    bits.store(stats)
+    return stats
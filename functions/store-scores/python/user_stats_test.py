@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from ingest import ingest_scores
+from ingest_test import make_tweets
+from reconcile_user_stats import reconcile_user_stats
+from schema import USER_COLLECTION
+from user_stats import STAT_FIELDS, apply_score, recompute_user_stats
+
+
+def score(roundid, points, userid='user', hard_mode=False):
+    return {'roundid': roundid, 'userid': userid, 'score': points,
+            'attempts': 7 - points if points else 0, 'hard_mode': hard_mode}
+
+
+def fold(score_docs, user_doc=None):
+    for score_doc in score_docs:
+        user_doc = apply_score(user_doc, score_doc)
+    return user_doc
+
+
+def stats(user_doc, *fields):
+    return tuple(user_doc[field] for field in fields)
+
+
+class TestApplyScore(unittest.TestCase):
+    def test_in_order(self):
+        user_doc = fold([score(400, 3), score(401, 5), score(402, 0),
+                         score(403, 4), score(404, 6)])
+
+        self.assertEqual(
+            stats(user_doc, 'rounds_played', 'total_score', 'average_score',
+                  'last_round', 'current_streak', 'max_streak'),
+            (5, 18, 3.6, 404, 2, 2))
+
+    def test_failed_first_round_is_no_streak(self):
+        user_doc = fold([score(400, 0)])
+        self.assertEqual(stats(user_doc, 'current_streak', 'max_streak'),
+                         (0, 0))
+
+    def test_late_round_joins_streaks(self):
+        user_doc = fold([score(400, 3), score(401, 5), score(403, 4),
+                         score(404, 6), score(405, 1)])
+        self.assertEqual(stats(user_doc, 'current_streak', 'max_streak'),
+                         (3, 3))
+
+        user_doc = apply_score(user_doc, score(402, 2))
+
+        self.assertEqual(
+            stats(user_doc, 'last_round', 'current_streak', 'max_streak'),
+            (405, 6, 6))
+
+    def test_round_before_first_round(self):
+        user_doc = fold([score(450, 2), score(451, 2), score(445, 2)])
+
+        self.assertEqual(user_doc['rounds_base'], 445)
+        self.assertEqual(
+            stats(user_doc, 'rounds_played', 'last_round', 'current_streak',
+                  'max_streak'),
+            (3, 451, 2, 2))
+
+    def test_ignores_round_already_played(self):
+        user_doc = fold([score(400, 3), score(401, 5)])
+        self.assertEqual(apply_score(user_doc, score(400, 6)), user_doc)
+
+    def test_any_order_matches_recompute(self):
+        rng = random.Random(7)
+        for _ in range(50):
+            score_docs = [score(roundid, rng.choice([0, 0, 1, 3, 5]))
+                          for roundid in rng.sample(range(400, 460), 40)]
+            expected = recompute_user_stats(score_docs)
+
+            for _ in range(3):
+                rng.shuffle(score_docs)
+                user_doc = fold(score_docs)
+                self.assertEqual({field: user_doc[field]
+                                  for field in STAT_FIELDS}, expected)
+
+    def test_seeds_bitmaps_of_older_user_docs(self):
+        # a doc written before the bitmaps, with a 3 round streak
+        user_doc = {
+            'userid': 'user',
+            'rounds_played': 10,
+            'last_round': 420,
+            'average_score': 4.0,
+            'total_score': 40,
+            'max_streak': 5,
+            'current_streak': 3
+        }
+
+        user_doc = apply_score(user_doc, score(421, 2))
+        self.assertEqual(stats(user_doc, 'rounds_played', 'current_streak',
+                               'max_streak'), (11, 4, 5))
+
+        user_doc = apply_score(user_doc, score(417, 6))
+        self.assertEqual(stats(user_doc, 'current_streak', 'max_streak'),
+                         (5, 5))
+        # the rounds before the history are not in it
+        self.assertEqual(user_doc['round_history'],
+                         bytes([1, 0, 0, 0, 5]))
+
+    def test_round_history(self):
+        user_doc = fold([score(450, 4), score(452, 0),
+                         score(453, 6, hard_mode=True)])
+        self.assertEqual(user_doc['round_history'],
+                         bytes([3, 0, 7, 0x81]))
+
+        user_doc = apply_score(user_doc, score(447, 1))
+
+        self.assertEqual(user_doc['rounds_base'], 447)
+        self.assertEqual(user_doc['round_history'],
+                         bytes([6, 0, 0, 3, 0, 7, 0x81]))
+
+
+class TestReconcileUserStats(unittest.TestCase):
+    def test_reports_and_repairs_stale_stats(self):
+        db = FakeClient()
+        ingest_scores(db, make_tweets(users=5, rounds=6))
+        self.assertEqual(reconcile_user_stats(db)['mismatches'], {})
+
+        db.collection(USER_COLLECTION).document('user2').update({
+            'max_streak': 9,
+            'total_score': 1
+        })
+        result = reconcile_user_stats(db)
+        self.assertEqual(result, {
+            'users_checked': 5,
+            'users_repaired': 0,
+            'mismatches': {'user2': ['total_score', 'max_streak']}
+        })
+
+        result = reconcile_user_stats(db, repair=True)
+        self.assertEqual(result['users_repaired'], 1)
+        self.assertEqual(reconcile_user_stats(db)['mismatches'], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,14 +14,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from heapq import merge
 import functions_framework
-import json
+import os
 
-from google.cloud import storage
-from google.cloud import firestore
+from clients import firestore_client, storage_client
+from instrumentation import annotate, count, invocation, sampled, span
+from json_stream import iter_object, open_blob, prefetch
+from ledger import Ledger
 
 USER_COLLECTION = u'users'
+PROFILE_COLLECTION = u'profiles'
+METADATA_COLLECTION = u'metadata'
+ROUND_DOCID = u'rounds'
+
+# fields of the profile doc, owned by this function; the stats on the
+# user doc are owned by store-scores
+PROFILE_FIELDS = [u'username', u'name', u'profile_image_url']
+
+# 'batched' reads users in bulk and writes only the changed ones,
+# 'sequential' reads and writes one user at a time
+INGEST_MODE = os.environ.get('INGEST_MODE', 'batched')
+
+# Firestore limit on writes per batch, also used for get_all chunks
+MAX_BATCH_WRITES = 500
 
 
 @functions_framework.cloud_event
@@ -37,32 +52,71 @@ def event_receiver(cloud_event):
     data = cloud_event.data
     filename = data["name"]
     bucket_name = data["bucket"]
-    store_usernames(bucket_name, filename)
+    store_usernames(bucket_name, filename, data.get("generation"))
 
 
-def store_usernames(bucket_name, filename):
+def store_usernames(bucket_name, filename, generation=None):
     """
-    Store usernames from json file in a Storage bucket, into Firestore
+    Store usernames from json file in a Storage bucket, into Firestore.
+    A generation of the file that was already processed is skipped.
 
     Parameters:
         bucket_name (str): Name of the bucket in which the object is created
         filename (str): Name of the file object
+        generation (str): Generation of the file object, read from the
+            object when None
     """
+    with invocation('store-usernames', bucket=bucket_name, file=filename):
+        # reuse the instance's cloud storage client, bucket() makes no
+        # request
+        bucket = storage_client().bucket(bucket_name)
+        blob = bucket.blob(filename)
+
+        # reuse the instance's firestore client
+        db = firestore_client()
+
+        if generation is None:
+            with span('storage.reload'):
+                blob.reload()
+            generation = blob.generation
+        annotate(generation=str(generation))
+        ledger = Ledger(db, bucket_name, filename, generation)
+        if not ledger.begin():
+            return
+
+        # the file is downloaded and decoded in the background while the
+        # users read so far are written
+        try:
+            with open_blob(blob) as stream:
+                save_usernames(db, prefetch(iter_object(stream)), ledger)
+        except Exception:
+            ledger.release()
+            raise
+
+
+def save_usernames(db, usernames, ledger=None):
+    """
+    Store the user entries into Firestore, as profile docs. When any
+    profile changed, the APIs are told to drop their cached ones.
 
-    # initialize cloud storage client
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(filename)
-    usernames = json.loads(blob.download_as_bytes())
-
-    # initialize firestore client
-    db = firestore.Client()
-    collection_ref = db.collection(USER_COLLECTION)
-
-    print("Updating user entries in firestore")
-
-    # usernames will be a map of id: username
-    for userid, userdata in usernames.items():
+    Parameters:
+        db (Object): An instance of the Firestore client
+        usernames (iterable): Pairs of userid and user data
+        ledger (Ledger): Ledger entry of the file, to resume from its last
+            checkpoint and to checkpoint every 500 users written
+    """
+    collection_ref = db.collection(PROFILE_COLLECTION)
+    metrics = {u'reads': 0, u'writes': 0, u'skips': 0}
+    user_docs = {}
+    entries = 0
+    if ledger is not None:
+        metrics.update(ledger.state)
+        entries = ledger.entries
+        usernames = ledger.skip(usernames)
+
+    # usernames will be pairs of id: username
+    for userid, userdata in usernames:
+        entries += 1
         user_doc = {
             u'userid': str(userid),
             u'username': str(userdata['username']),
@@ -70,9 +124,109 @@ def store_usernames(bucket_name, filename):
             u'profile_image_url': str(userdata.get('profile_image_url',''))
         }
 
-        check_and_update_userdata(collection_ref, user_doc)           
+        if INGEST_MODE == 'sequential':
+            check_and_update_userdata(collection_ref, user_doc)
+            metrics[u'reads'] += 1
+            metrics[u'writes'] += 1
+            chunk_written = entries % MAX_BATCH_WRITES == 0
+        else:
+            user_docs[user_doc['userid']] = user_doc
+            chunk_written = len(user_docs) == MAX_BATCH_WRITES
+            if chunk_written:
+                upsert_users(db, collection_ref, list(user_docs.values()),
+                             metrics)
+                user_docs = {}
+
+        if chunk_written and ledger is not None:
+            ledger.checkpoint(entries, **metrics)
+
+    if user_docs:
+        upsert_users(db, collection_ref, list(user_docs.values()), metrics)
+
+    # the metrics include the writes of a crashed run this one resumed
+    if metrics[u'writes']:
+        bump_profiles_version(db)
+
+    if ledger is not None:
+        ledger.finish(**metrics)
+    return metrics
+
+
+def upsert_users(db, coll_ref, user_docs, metrics):
+    """
+    Reads the stored profiles of up to 500 users at once and writes, in a
+    single batch, only the users that are new or whose profile changed.
 
-    print("User data updated")
+    Parameters:
+        db (Object): An instance of the Firestore client
+        coll_ref (Object): Reference to profiles collection
+        user_docs (list): The user data, unique per userid
+        metrics (dict): Counts of reads, writes and skips, updated in place
+    """
+    refs = [coll_ref.document(user_doc['userid']) for user_doc in user_docs]
+    with span('firestore.get_all'):
+        stored = {doc.id: doc for doc in db.get_all(refs)}
+    metrics[u'reads'] += len(refs)
+    count('docs_read', len(refs))
+
+    batch = db.batch()
+    writes = 0
+    created = 0
+    for ref, user_doc in zip(refs, user_docs):
+        doc = stored.get(ref.id)
+        if doc is not None and doc.exists \
+                and not profile_changed(doc.to_dict(), user_doc):
+            metrics[u'skips'] += 1
+            continue
+
+        batch.set(ref, profile_doc(user_doc))
+        writes += 1
+        if doc is None or not doc.exists:
+            created += 1
+            if sampled():
+                print(f"user {user_doc['userid']} created")
+
+    if writes:
+        with span('firestore.commit'):
+            batch.commit()
+    metrics[u'writes'] += writes
+    count('docs_written', writes)
+    count('users_created', created)
+    count('users_skipped', len(user_docs) - writes)
+
+
+def profile_doc(user_doc):
+    """
+    Returns the profile doc of a user, keyed by userid in its collection.
+    """
+    return {field: user_doc[field] for field in PROFILE_FIELDS}
+
+
+def bump_profiles_version(db):
+    """
+    Bumps the profiles version, which tells the APIs to drop their cached
+    profiles, and the data version, so their cached responses are rebuilt
+    with the new profiles.
+
+    Parameters:
+        db (Object): An instance of the Firestore client
+    """
+    from google.cloud import firestore
+
+    round_ref = db.collection(METADATA_COLLECTION).document(ROUND_DOCID)
+    with span('firestore.set'):
+        round_ref.set({
+            u'profiles_version': firestore.Increment(1),
+            u'version': firestore.Increment(1)
+        }, merge=True)
+
+
+def profile_changed(stored_doc, user_doc):
+    """
+    Returns whether any profile field differs from the stored profile.
+    """
+    return any(stored_doc.get(field) != user_doc[field]
+               for field in PROFILE_FIELDS)
 
 
 def check_and_update_userdata(coll_ref, user_doc):
@@ -80,13 +234,20 @@ def check_and_update_userdata(coll_ref, user_doc):
     Checks whether the user data need to be updated or created.
 
     Parameters:
-        coll_ref (Object): Reference to users collection
+        coll_ref (Object): Reference to profiles collection
         user_doc (Object): The user data that needs to be updated
     """
 
-    doc = coll_ref.document(user_doc['userid']).get()
+    with span('firestore.get'):
+        doc = coll_ref.document(user_doc['userid']).get()
+    count('docs_read')
+    count('docs_written')
     if not doc.exists:
-        coll_ref.document(user_doc['userid']).set(user_doc)
-        print(f"user {user_doc['userid']} created")
+        with span('firestore.set'):
+            coll_ref.document(user_doc['userid']).set(profile_doc(user_doc))
+        count('users_created')
+        if sampled():
+            print(f"user {user_doc['userid']} created")
     else:
-        coll_ref.document(user_doc['userid']).set(user_doc, merge=True)
+        with span('firestore.set'):
+            coll_ref.document(user_doc['userid']).set(profile_doc(user_doc))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'testing'))
+
+from fake_firestore import FakeClient
+from fake_storage import FakeStorageClient
+from main import METADATA_COLLECTION, PROFILE_COLLECTION, ROUND_DOCID, \
+    USER_COLLECTION, save_usernames, store_usernames
+import clients
+import main
+
+
+def usernames(count, suffix=''):
+    return [(str(i), {
+        'username': f'user{i}',
+        'name': f'User {i}{suffix}',
+        'profile_image_url': f'https://example.com/{i}.png'
+    }) for i in range(count)]
+
+
+class TestSaveUsernames(unittest.TestCase):
+    def test_creates_users_in_bulk(self):
+        db = FakeClient()
+
+        metrics = save_usernames(db, usernames(1200))
+
+        self.assertEqual(metrics, {'reads': 1200, 'writes': 1200, 'skips': 0})
+        # 3 batches of profiles and the profiles version
+        self.assertEqual(db.rpc_counts, {'batch_get': 3, 'commit': 4})
+        self.assertEqual(db.dump(PROFILE_COLLECTION)['7'], {
+            'username': 'user7',
+            'name': 'User 7',
+            'profile_image_url': 'https://example.com/7.png'
+        })
+        self.assertEqual(db.dump(METADATA_COLLECTION)[ROUND_DOCID],
+                         {'profiles_version': 1, 'version': 1})
+
+    def test_skips_unchanged_users(self):
+        db = FakeClient()
+        save_usernames(db, usernames(600))
+        db.reset_counts()
+
+        changed = usernames(600)
+        changed[5][1]['name'] = 'Renamed'
+        metrics = save_usernames(db, changed)
+
+        self.assertEqual(metrics, {'reads': 600, 'writes': 1, 'skips': 599})
+        self.assertEqual(db.rpc_counts, {'batch_get': 2, 'commit': 2})
+        self.assertEqual(db.dump(PROFILE_COLLECTION)['5']['name'], 'Renamed')
+        self.assertEqual(
+            db.dump(METADATA_COLLECTION)[ROUND_DOCID]['profiles_version'], 2)
+
+    def test_unchanged_file_keeps_profiles_version(self):
+        db = FakeClient()
+        save_usernames(db, usernames(10))
+        save_usernames(db, usernames(10))
+
+        self.assertEqual(
+            db.dump(METADATA_COLLECTION)[ROUND_DOCID]['profiles_version'], 1)
+
+    def test_leaves_user_stats_alone(self):
+        db = FakeClient()
+        db.collection(USER_COLLECTION).document('0').set({
+            'userid': '0',
+            'average_score': 4.5
+        })
+
+        save_usernames(db, usernames(1))
+
+        self.assertEqual(db.dump(USER_COLLECTION)['0'],
+                         {'userid': '0', 'average_score': 4.5})
+        self.assertEqual(db.dump(PROFILE_COLLECTION)['0']['username'],
+                         'user0')
+
+
+class TestStoreUsernames(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeClient()
+        self.gcs = FakeStorageClient()
+        clients.reset()
+        for name, client in [('_new_firestore_client', self.db),
+                             ('_new_storage_client', self.gcs)]:
+            patcher = mock.patch.object(clients, name, return_value=client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(clients.reset)
+        self.gcs.put('bucket', 'users-1.json',
+                     json.dumps(dict(usernames(1200))))
+
+    def test_skips_redelivered_file(self):
+        store_usernames('bucket', 'users-1.json', '1')
+        self.db.reset_counts()
+
+        store_usernames('bucket', 'users-1.json', '1')
+
+        self.assertEqual(self.gcs.rpc_counts['download'], 1)
+        self.assertEqual(self.db.rpc_counts, {'commit': 1, 'get': 1})
+
+    def test_resumes_after_last_checkpoint(self):
+        upsert_users = main.upsert_users
+
+        def crash_on_third_chunk(db, coll_ref, user_docs, metrics):
+            if metrics['writes'] == 1000:
+                raise RuntimeError('instance stopped')
+            upsert_users(db, coll_ref, user_docs, metrics)
+
+        with mock.patch.object(main, 'upsert_users', crash_on_third_chunk):
+            with self.assertRaises(RuntimeError):
+                store_usernames('bucket', 'users-1.json', '1')
+        self.assertEqual(len(self.db.dump(PROFILE_COLLECTION)), 1000)
+
+        # the failed run released its lease, so the first retry resumes
+        with mock.patch.object(main, 'upsert_users',
+                               wraps=upsert_users) as resumed:
+            store_usernames('bucket', 'users-1.json', '1')
+
+        self.assertEqual([len(call.args[2]) for call in resumed.mock_calls],
+                         [200])
+        self.assertEqual(len(self.db.dump(PROFILE_COLLECTION)), 1200)
+        ledger_doc, = self.db.dump('ingest_ledger').values()
+        self.assertEqual(ledger_doc['status'], 'done')
+        self.assertEqual(ledger_doc['state'],
+                         {'reads': 1200, 'writes': 1200, 'skips': 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
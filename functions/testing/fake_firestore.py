@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-memory stand-in for the subset of `google.cloud.firestore.Client` used by
+the functions in this repo.
+
+Every call that would be a network round trip against real Firestore is
+counted in `FakeClient.rpc_counts`, keyed by RPC type:
+
+    get         single document read (DocumentReference.get)
+    batch_get   Client.get_all, one call regardless of the number of refs
+    query       one run of a query (Query.get / Query.stream)
+    commit      one write RPC (DocumentReference.set/create/update/delete,
+                CollectionReference.add, WriteBatch.commit, transactions)
+
+`FakeClient.doc_reads` and `FakeClient.doc_writes` count billed documents.
+
+Every document keeps the time of its last write in `update_time`, and
+updates take the `last_update_time` or `exists` preconditions of
+`FakeClient.write_option`, raising FailedPrecondition when they fail.
+
+Reads take the `timeout` of the real client: a read whose injected latency
+is longer than its timeout raises DeadlineExceeded once the timeout has
+passed, as a call the server did not answer in time.
+
+The client may be shared between threads; every RPC is applied under one
+lock, while the injected latency is slept outside of it.
+"""
+
+import copy
+import itertools
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from google.api_core import exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1 import transforms
+
+MAX_BATCH_WRITES = 500
+
+_auto_ids = itertools.count(1)
+
+
+def _auto_id():
+    return f'auto{next(_auto_ids):016d}'
+
+
+def _get_path(data, field_path):
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def _set_path(data, field_path, value):
+    parts = field_path.split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    if value is firestore.DELETE_FIELD:
+        data.pop(parts[-1], None)
+    elif value is firestore.SERVER_TIMESTAMP:
+        data[parts[-1]] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        data[parts[-1]] = data.get(parts[-1], 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(data.get(parts[-1], []))
+        current.extend(v for v in value.values if v not in current)
+        data[parts[-1]] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        data[parts[-1]] = [
+            v for v in data.get(parts[-1], []) if v not in value.values]
+    else:
+        data[parts[-1]] = copy.deepcopy(value)
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = _resolve(value)
+        else:
+            _set_path(target, key, value)
+
+
+def _resolve(data):
+    resolved = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            value = _resolve(value)
+        _set_path(resolved, key, value)
+    return resolved
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time if data is not None else None
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            raise KeyError(field_path)
+        return copy.deepcopy(_get_path(self._data, field_path))
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection_id, document_id):
+        self._client = client
+        self._collection_id = collection_id
+        self.id = document_id
+
+    @property
+    def path(self):
+        return f'{self._collection_id}/{self.id}'
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) \
+            and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def _snapshot(self):
+        with self._client._lock:
+            data = self._client._store.get(
+                self._collection_id, {}).get(self.id)
+            return FakeDocumentSnapshot(
+                self, copy.deepcopy(data), self._client._update_times.get(
+                    (self._collection_id, self.id)))
+
+    def get(self, field_paths=None, transaction=None, timeout=None,
+            retry=None):
+        self._client._rpc('get', docs=1, timeout=timeout)
+        return self._snapshot()
+
+    def set(self, document_data, merge=False):
+        self._client._commit([('set', self, document_data, merge, None)])
+
+    def create(self, document_data):
+        self._client._commit([('create', self, document_data, False, None)])
+
+    def update(self, field_updates, option=None):
+        self._client._commit([('update', self, field_updates, False, option)])
+
+    def delete(self):
+        self._client._commit([('delete', self, None, False, None)])
+
+
+class FakeQuery:
+    def __init__(self, client, collection_id, filters=(), orders=(),
+                 limit=None, start_after=None, projection=None):
+        self._client = client
+        self._collection_id = collection_id
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **overrides):
+        params = dict(
+            filters=self._filters, orders=self._orders, limit=self._limit,
+            start_after=self._start_after, projection=self._projection)
+        params.update(overrides)
+        return FakeQuery(self._client, self._collection_id, **params)
+
+    def where(self, field_path=None, op_string=None, value=None,
+              filter=None):
+        if filter is not None:
+            field_path, op_string, value = \
+                filter.field_path, filter.op_string, filter.value
+        return self._copy(
+            filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start_after=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=tuple(field_paths))
+
+    @staticmethod
+    def _matches(data, field_path, op_string, value):
+        try:
+            field = _get_path(data, field_path)
+        except KeyError:
+            return False
+        if op_string == '==':
+            return field == value
+        if op_string == '!=':
+            return field != value
+        if op_string == 'in':
+            return field in value
+        if op_string == 'not-in':
+            return field not in value
+        if op_string == 'array_contains':
+            return value in field
+        try:
+            if op_string == '<':
+                return field < value
+            if op_string == '<=':
+                return field <= value
+            if op_string == '>':
+                return field > value
+            if op_string == '>=':
+                return field >= value
+        except TypeError:
+            return False
+        raise ValueError(f'Unsupported operator {op_string}')
+
+    def _sort_key(self, item):
+        doc_id, data = item
+        key = []
+        for field_path, direction in self._orders:
+            try:
+                value = doc_id if field_path == '__name__' \
+                    else _get_path(data, field_path)
+            except KeyError:
+                value = None
+            if direction == firestore.Query.DESCENDING:
+                key.append(_Reversed(value))
+            else:
+                key.append(_Ordered(value))
+        key.append(_Ordered(doc_id))
+        return key
+
+    def _run(self, timeout=None):
+        self._client._rpc('query', timeout=timeout)
+        with self._client._lock:
+            return self._run_locked()
+
+    def _run_locked(self):
+        docs = self._client._store.get(self._collection_id, {})
+        items = []
+        for doc_id, data in docs.items():
+            if all(self._matches(data, *f) for f in self._filters) and all(
+                    f == '__name__' or _has_path(data, f)
+                    for f, _ in self._orders):
+                items.append((self._sort_key((doc_id, data)), doc_id, data))
+        items.sort(key=lambda item: item[0])
+        if self._start_after is not None:
+            cursor = self._start_after
+            if isinstance(cursor, FakeDocumentSnapshot):
+                cursor_item = (cursor.id, cursor._data or {})
+            else:
+                cursor_item = (cursor.get('__name__', ''), cursor)
+            cursor_key = self._sort_key(cursor_item)
+            if not isinstance(cursor, FakeDocumentSnapshot) \
+                    and '__name__' not in cursor:
+                cursor_key = cursor_key[:-1]
+                items = [i for i in items if i[0][:-1] > cursor_key]
+            else:
+                items = [i for i in items if i[0] > cursor_key]
+        if self._limit is not None:
+            items = items[:self._limit]
+        items = [(doc_id, data) for _, doc_id, data in items]
+
+        # an empty result set is still billed as one read
+        self._client.doc_reads += max(len(items), 1)
+        results = []
+        for doc_id, data in items:
+            data = copy.deepcopy(data)
+            if self._projection is not None:
+                data = {k: v for k, v in data.items()
+                        if k in self._projection}
+            ref = FakeDocumentReference(
+                self._client, self._collection_id, doc_id)
+            results.append(FakeDocumentSnapshot(
+                ref, data, self._client._update_times.get(
+                    (self._collection_id, doc_id))))
+        return results
+
+    def get(self, transaction=None, timeout=None, retry=None):
+        return self._run(timeout)
+
+    def stream(self, transaction=None, timeout=None, retry=None):
+        return iter(self._run(timeout))
+
+
+def _has_path(data, field_path):
+    try:
+        _get_path(data, field_path)
+        return True
+    except KeyError:
+        return False
+
+
+class _Ordered:
+    """Orders mixed values the way Firestore does: None, numbers, strings."""
+
+    def __init__(self, value):
+        self.value = value
+        # ranked once, since sorting compares every key many times
+        if value is None:
+            self._rank = (0, 0)
+        elif isinstance(value, bool):
+            self._rank = (1, value)
+        elif isinstance(value, (int, float)):
+            self._rank = (2, value)
+        else:
+            self._rank = (3, str(value))
+
+    def __lt__(self, other):
+        return self._rank < other._rank
+
+    def __gt__(self, other):
+        return self._rank > other._rank
+
+    def __eq__(self, other):
+        return self._rank == other._rank
+
+
+class _Reversed(_Ordered):
+    def __lt__(self, other):
+        return self._rank > other._rank
+
+    def __gt__(self, other):
+        return self._rank < other._rank
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, collection_id):
+        super().__init__(client, collection_id)
+        self.id = collection_id
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(
+            self._client, self._collection_id, document_id or _auto_id())
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return None, ref
+
+    def list_documents(self):
+        with self._client._lock:
+            doc_ids = sorted(self._client._store.get(self._collection_id, {}))
+        return [self.document(doc_id) for doc_id in doc_ids]
+
+
+class FakeWriteOption:
+    """
+    Precondition of a write, from `FakeClient.write_option`.
+    """
+
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+    def check(self, ref, current, update_time):
+        if self.last_update_time is not None and (
+                current is None or update_time != self.last_update_time):
+            raise exceptions.FailedPrecondition(
+                f'Document was updated since it was read: {ref.path}')
+        if self.exists is not None and self.exists != (current is not None):
+            raise exceptions.FailedPrecondition(
+                f'Document existence precondition failed: {ref.path}')
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(
+            ('create', reference, document_data, False, None))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(
+            ('update', reference, field_updates, False, option))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False, None))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._client._commit(writes)
+        return writes
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Implements the protocol `firestore.transactional` drives, so production
+    code can keep using the decorator against the fake.
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _begin(self, retry_id=None):
+        self._id = _auto_id()
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        writes = self._writes
+        self._clean_up()
+        self._client._commit(writes)
+        return writes
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+    def get_all(self, references):
+        return self._client.get_all(references)
+
+
+class FakeClient:
+    """
+    In-memory Firestore client. `latency` seconds are slept per RPC to
+    approximate a network round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self._store = {}
+        self._lock = threading.RLock()
+        self.latency = latency
+        self._update_times = {}
+        self._last_update_time = datetime.fromtimestamp(0, timezone.utc)
+        self.rpc_counts = Counter()
+        self.doc_reads = 0
+        self.doc_writes = 0
+
+    @property
+    def rpcs(self):
+        return sum(self.rpc_counts.values())
+
+    def reset_counts(self):
+        self.rpc_counts.clear()
+        self.doc_reads = 0
+        self.doc_writes = 0
+
+    def _rpc(self, kind, docs=0, timeout=None):
+        with self._lock:
+            self.rpc_counts[kind] += 1
+            self.doc_reads += docs
+        if self.latency:
+            if timeout is not None and self.latency > timeout:
+                time.sleep(timeout)
+                raise exceptions.DeadlineExceeded('Deadline Exceeded')
+            time.sleep(self.latency)
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self, collection_id)
+
+    def document(self, document_path):
+        collection_id, document_id = document_path.split('/', 1)
+        return self.collection(collection_id).document(document_id)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, last_update_time=None, exists=None):
+        return FakeWriteOption(last_update_time, exists)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return FakeTransaction(self, max_attempts, read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None,
+                timeout=None, retry=None):
+        references = list(references)
+        self._rpc('batch_get', docs=len(references), timeout=timeout)
+        for ref in references:
+            yield ref._snapshot()
+
+    def _commit(self, writes):
+        if len(writes) > MAX_BATCH_WRITES:
+            raise exceptions.InvalidArgument(
+                f'maximum {MAX_BATCH_WRITES} writes allowed per request')
+
+        self._rpc('commit')
+        with self._lock:
+            self._apply(writes)
+
+    def _apply(self, writes):
+        # stage every write before applying anything so a failed precondition
+        # leaves the store untouched, like a real atomic commit
+        staged = {}
+        for op, ref, data, merge, option in writes:
+            key = (ref._collection_id, ref.id)
+            if key in staged:
+                current = staged[key]
+            else:
+                current = copy.deepcopy(
+                    self._store.get(ref._collection_id, {}).get(ref.id))
+            if option is not None:
+                option.check(ref, current, self._update_times.get(key))
+            if op == 'create':
+                if current is not None:
+                    raise exceptions.Conflict(f'Document already exists: '
+                                              f'{ref.path}')
+                current = _resolve(data)
+            elif op == 'set':
+                if merge and current is not None:
+                    _merge(current, data)
+                else:
+                    current = _resolve(data)
+            elif op == 'update':
+                if current is None:
+                    raise exceptions.NotFound(f'No document to update: '
+                                              f'{ref.path}')
+                for field_path, value in data.items():
+                    _set_path(current, field_path, value)
+            elif op == 'delete':
+                current = None
+            staged[key] = current
+
+        update_time = max(datetime.now(timezone.utc),
+                          self._last_update_time + timedelta(microseconds=1))
+        self._last_update_time = update_time
+        for key, data in staged.items():
+            collection_id, document_id = key
+            docs = self._store.setdefault(collection_id, {})
+            if data is None:
+                docs.pop(document_id, None)
+                self._update_times.pop(key, None)
+            else:
+                docs[document_id] = data
+                self._update_times[key] = update_time
+        self.doc_writes += len(writes)
+
+    def dump(self, collection_id):
+        """Returns a copy of every document in a collection, keyed by id."""
+        with self._lock:
+            return copy.deepcopy(self._store.get(collection_id, {}))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-memory stand-in for the subset of `google.cloud.storage.Client` used by
+the functions in this repo. Requests are counted in
+`FakeStorageClient.rpc_counts`, like `fake_firestore.FakeClient`.
+"""
+
+import io
+import itertools
+import time
+from collections import Counter
+
+from google.api_core import exceptions
+
+_generations = itertools.count(1)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def _object(self):
+        return self.bucket._client._objects.get((self.bucket.name, self.name))
+
+    @property
+    def generation(self):
+        obj = self._object
+        return obj[1] if obj else None
+
+    @property
+    def size(self):
+        obj = self._object
+        return len(obj[0]) if obj else None
+
+    def exists(self):
+        self.bucket._client._rpc('get')
+        return self._object is not None
+
+    def reload(self):
+        self.bucket._client._rpc('get')
+        if self._object is None:
+            raise exceptions.NotFound(f'No such object: {self.name}')
+
+    def download_as_bytes(self):
+        self.bucket._client._rpc('download')
+        if self._object is None:
+            raise exceptions.NotFound(f'No such object: {self.name}')
+        return self._object[0]
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bucket._client._rpc('upload')
+        self.bucket._client.put(self.bucket.name, self.name, data)
+
+    def open(self, mode='rb', chunk_size=None):
+        if mode != 'rb':
+            raise ValueError(f'Unsupported mode {mode}')
+        return _FakeReader(self, chunk_size or 40 * 1024 * 1024)
+
+    def delete(self):
+        self.bucket._client._rpc('delete')
+        self.bucket._client._objects.pop((self.bucket.name, self.name), None)
+
+
+class _FakeReader(io.RawIOBase):
+    """Reads an object in ranged requests of `chunk_size` bytes."""
+
+    def __init__(self, blob, chunk_size):
+        self._blob = blob
+        self._chunk_size = chunk_size
+        self._position = 0
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._buffer:
+            data = self._blob._object[0]
+            if self._position >= len(data):
+                return 0
+            self._blob.bucket._client._rpc('download')
+            self._buffer = data[
+                self._position:self._position + self._chunk_size]
+            self._position += len(self._buffer)
+        count = min(len(buffer), len(self._buffer))
+        buffer[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def blob(self, blob_name):
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        self._client._rpc('get')
+        if (self.name, blob_name) not in self._client._objects:
+            return None
+        return FakeBlob(self, blob_name)
+
+    def list_blobs(self, prefix=None, start_offset=None):
+        return self._client.list_blobs(self, prefix=prefix,
+                                       start_offset=start_offset)
+
+
+class FakeStorageClient:
+    def __init__(self, latency=0.0):
+        self._objects = {}
+        self.latency = latency
+        self.rpc_counts = Counter()
+
+    def _rpc(self, kind):
+        self.rpc_counts[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        self._rpc('get')
+        return FakeBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, start_offset=None):
+        bucket_name = getattr(bucket_or_name, 'name', bucket_or_name)
+        self._rpc('list')
+        bucket = FakeBucket(self, bucket_name)
+        return [FakeBlob(bucket, name)
+                for (b, name) in sorted(self._objects)
+                if b == bucket_name and name.startswith(prefix or '')
+                and name >= (start_offset or '')]
+
+    def put(self, bucket_name, blob_name, data):
+        """Stores an object without counting a request, for test setup."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._objects[(bucket_name, blob_name)] = (data, next(_generations))
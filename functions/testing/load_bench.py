@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline load test of all four functions against the in-memory Firestore and
+Storage fakes, which count requests and add a fixed latency to each.
+
+Scenarios, each run in a fresh interpreter since every function has its
+own `main` module:
+
+    store-scores        `store_scores` on synthetic tweets files
+    store-usernames     `store_usernames` on synthetic users files
+    api-average-scores  `http_receiver`, walking the leaderboard pages
+    api-round-attempts  `http_receiver`, walking the round pages
+    *-cached            the same requests served from the response cache
+
+For every scenario it reports the throughput (items, i.e. file entries or
+requests, per second), p50/p99 latency per operation, and requests and
+documents per operation.
+
+With `--baseline` the results are compared to a JSON file written by
+`--save`. Requests and documents per operation may not grow at all; the
+latencies may grow by `--tolerance` plus `--slack-ms`, which keeps the
+sub-millisecond cached scenarios from failing on noise. Any regression
+exits with status 1, which fails the CI step running it. Latency is
+dominated by the injected per-request latency, so it is comparable across
+machines as long as the baseline was recorded with the same options.
+
+The fake Firestore scans the whole collection for every query where
+Firestore reads an index, so uncached query latency also grows with
+`--users`; compare it against baselines of the same size only.
+
+Usage:
+    python load_bench.py [--files N] [--tweets N] [--users N]
+                         [--requests N] [--latency-ms MS]
+                         [--scenarios NAME ...] [--save FILE]
+                         [--baseline FILE] [--tolerance 0.5]
+                         [--slack-ms 1]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTING_DIR = os.path.join(FUNCTIONS_DIR, 'testing')
+
+SCENARIOS = [
+    'store-scores',
+    'store-usernames',
+    'api-average-scores',
+    'api-average-scores-cached',
+    'api-round-attempts',
+    'api-round-attempts-cached',
+]
+
+BUCKET = 'bench-bucket'
+FIRST_ROUND = 400
+
+# metrics that may not grow at all against the baseline
+COUNT_METRICS = ['rpcs_per_op', 'doc_reads_per_op', 'doc_writes_per_op']
+LATENCY_METRICS = ['p50_ms', 'p99_ms']
+
+
+def tweets_file(index, tweets, users, rng):
+    """
+    Returns one round's tweets file, by `tweets` of the `users` users.
+    """
+    roundid = FIRST_ROUND + index
+    authors = rng.sample(range(users), min(tweets, users))
+    return json.dumps([{
+        'tweetId': f'{roundid}-{author}',
+        'authorId': f'user{author}',
+        'tweet': f'Wordle {roundid} {rng.choice("123456X")}/6\n\n'
+                 '⬛🟨⬛⬛⬛\n🟩🟩🟩🟩🟩'
+    } for author in authors], ensure_ascii=False)
+
+
+def users_file(index, tweets, users, rng):
+    """
+    Returns a users file with `tweets` profiles, a tenth of them changed
+    since the previous file.
+    """
+    return json.dumps({
+        f'user{author}': {
+            'username': f'user{author}',
+            'name': f'User {author}' + (f' ({index})'
+                                        if author % 10 == index % 10
+                                        else ''),
+            'profile_image_url': f'https://example.com/{author}.png'
+        } for author in range(min(tweets, users))
+    })
+
+
+def seed_apis(db, users, rounds, rng):
+    """
+    Writes what store-scores leaves behind for `users` users who played
+    `rounds` rounds.
+    """
+    stats = {}
+    for user in range(users):
+        played = rng.randint(1, rounds)
+        total = sum(rng.randint(0, 6) for _ in range(played))
+        stats[f'user{user}'] = {
+            'username': f'user{user}',
+            'name': f'User {user}',
+            'profile_image_url': f'https://example.com/{user}.png',
+            'rounds_played': played,
+            'average_score': round(total / played, 1),
+            'total_score': total,
+            'max_streak': rng.randint(0, played)
+        }
+    for userid, doc in stats.items():
+        db.collection('users').document(userid).set(doc)
+    for roundid in range(FIRST_ROUND, FIRST_ROUND + rounds):
+        attempts = {str(n): rng.randint(0, users // 6) for n in range(1, 7)}
+        attempts['X'] = rng.randint(0, users // 10)
+        db.collection('round_stats').document(str(roundid)).set({
+            'players': sum(attempts.values()),
+            'attempts': attempts
+        })
+
+    ranked = sorted(stats, reverse=True, key=lambda userid: (
+        stats[userid]['average_score'], stats[userid]['total_score'],
+        stats[userid]['max_streak'], userid))[:10]
+    db.collection('leaderboards').document('average').set({
+        'data': [{field: stats[userid][field] for field in (
+            'username', 'name', 'profile_image_url', 'average_score',
+            'max_streak', 'total_score')} for userid in ranked],
+        'count': len(ranked),
+        'keys': [{'average_score': stats[userid]['average_score'],
+                  'total_score': stats[userid]['total_score'],
+                  'max_streak': stats[userid]['max_streak'],
+                  'userid': userid} for userid in ranked],
+        'version': 1
+    })
+    db.collection('metadata').document('rounds').set({
+        'latest_round': FIRST_ROUND + rounds - 1,
+        'version': 1
+    })
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_child(scenario, args):
+    """
+    Runs one scenario, in this interpreter.
+    """
+    function = scenario.replace('-cached', '')
+    function_dir = os.path.join(FUNCTIONS_DIR, function, 'python')
+    sys.path[:0] = [function_dir, TESTING_DIR]
+    os.chdir(function_dir)
+
+    import clients
+    import main
+    from fake_firestore import FakeClient
+    from fake_storage import FakeStorageClient
+
+    latency = args.latency_ms / 1000
+    db = FakeClient()
+    gcs = FakeStorageClient()
+    clients._new_firestore_client = lambda: db
+    clients._new_storage_client = lambda: gcs
+    rng = random.Random(0)
+
+    if function.startswith('store-'):
+        make_file = tweets_file if function == 'store-scores' else users_file
+        names = []
+        for index in range(args.files):
+            name = f'file-{index}.json'
+            gcs.put(BUCKET, name, make_file(index, args.tweets, args.users,
+                                            rng))
+            names.append(name)
+        operations = [(lambda name=name: main.store_scores(BUCKET, name))
+                      if function == 'store-scores' else
+                      (lambda name=name: main.store_usernames(BUCKET, name))
+                      for name in names]
+        items = args.files * min(args.tweets, args.users)
+    else:
+        import flask
+        seed_apis(db, args.users, args.rounds, rng)
+        app = flask.Flask(function)
+        cached = scenario.endswith('-cached')
+        walk = {'path': '/', 'pages': 1}
+
+        def request():
+            if not cached:
+                main.RESPONSE_CACHE.clear()
+            with app.test_request_context(walk['path']):
+                body, status, _ = main.http_receiver(flask.request)
+            if status != 200:
+                raise RuntimeError(f"{walk['path']} answered {status}")
+            # follow the pages for five requests, then start over
+            cursor = json.loads(body).get('next_cursor')
+            if cursor and walk['pages'] < 5:
+                walk['path'] = f'/?cursor={cursor}'
+                walk['pages'] += 1
+            else:
+                walk['path'] = '/'
+                walk['pages'] = 1
+
+        if cached:
+            # fill the cache with every page of the walk
+            for _ in range(5):
+                request()
+        operations = [request] * args.requests
+        items = args.requests
+
+    db.latency = latency
+    gcs.latency = latency
+    db.reset_counts()
+    gcs.rpc_counts.clear()
+
+    latencies = []
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        start = time.perf_counter()
+        for operation in operations:
+            operation_start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - operation_start)
+        total = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+
+    operations = len(latencies)
+    return {
+        'scenario': scenario,
+        'operations': operations,
+        'items_per_s': items / total,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rpcs_per_op': (db.rpcs + sum(gcs.rpc_counts.values())) / operations,
+        'doc_reads_per_op': db.doc_reads / operations,
+        'doc_writes_per_op': db.doc_writes / operations,
+        'rpc_counts': dict(db.rpc_counts, **{
+            f'storage_{kind}': count
+            for kind, count in gcs.rpc_counts.items()}),
+    }
+
+
+def regressions(results, baseline, tolerance, slack_ms):
+    """
+    Returns a message per metric that is worse than in the baseline.
+    """
+    messages = []
+    for result in results:
+        expected = baseline.get(result['scenario'])
+        if expected is None:
+            continue
+        for metric in COUNT_METRICS + LATENCY_METRICS:
+            if metric in LATENCY_METRICS:
+                allowed = expected[metric] * (1 + tolerance) + slack_ms
+            else:
+                allowed = expected[metric]
+            # counts are averages, leave room for float rounding
+            if result[metric] > allowed + 1e-9:
+                messages.append(
+                    f"{result['scenario']}: {metric} {result[metric]:.2f} "
+                    f"> {allowed:.2f} (baseline {expected[metric]:.2f})")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Throughput, latency and Firestore/Storage requests of '
+                    'every function, against in-memory fakes.')
+    parser.add_argument('--files', type=int, default=5,
+                        help='files ingested by the store scenarios')
+    parser.add_argument('--tweets', type=int, default=2000,
+                        help='entries per ingested file')
+    parser.add_argument('--users', type=int, default=5000,
+                        help='distinct users')
+    parser.add_argument('--rounds', type=int, default=100,
+                        help='rounds seeded for the API scenarios')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests made by the API scenarios')
+    parser.add_argument('--latency-ms', type=float, default=2.0,
+                        help='latency added to every fake request')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='fail on regressions against '
+                        'results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative latency growth')
+    parser.add_argument('--slack-ms', type=float, default=1.0,
+                        help='allowed absolute latency growth')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args)))
+        return
+
+    forwarded = [f'--{name}={getattr(args, name.replace("-", "_"))}'
+                 for name in ('files', 'tweets', 'users', 'rounds',
+                              'requests', 'latency-ms')]
+    results = []
+    print(f"{'scenario':<28}{'items/s':>10}{'p50':>10}{'p99':>10}"
+          f"{'rpcs/op':>10}{'reads/op':>10}{'writes/op':>10}")
+    for scenario in args.scenarios:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__),
+             '--child', scenario] + forwarded,
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{scenario:<28}{result['items_per_s']:>10.0f}"
+              f"{result['p50_ms']:>8.1f}ms{result['p99_ms']:>8.1f}ms"
+              f"{result['rpcs_per_op']:>10.1f}"
+              f"{result['doc_reads_per_op']:>10.1f}"
+              f"{result['doc_writes_per_op']:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({result['scenario']: result for result in results}, f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        messages = regressions(results, baseline, args.tolerance,
+                               args.slack_ms)
+        for message in messages:
+            print(f"REGRESSION {message}")
+        if messages:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the regex tweet parser of store-scores with the split based
+parsing it replaced, on synthetic tweets.
+
+Most tweets are well formed results; some have text before "Wordle",
+doubled spaces, hard mode markers or are not results at all. Besides the
+time, the number of tweets each parser accepts is reported.
+
+Usage:
+    python parser_bench.py [--tweets N] [--repeat N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(FUNCTIONS_DIR, 'store-scores', 'python'))
+
+from tweet_parser import calculate_score, parse_tweets  # noqa: E402
+
+GRID = '\n\n⬛🟨⬛⬛⬛\n🟩⬛🟨⬛⬛\n🟩🟩🟩🟩🟩'
+
+
+def synthetic_tweets(count, seed=1):
+    rng = random.Random(seed)
+    tweets = []
+    for i in range(count):
+        roundid = 400 + i % 300
+        attempts = rng.choice('123456X')
+        kind = rng.random()
+        if kind < 0.85:
+            text = f'Wordle {roundid} {attempts}/6{GRID}'
+        elif kind < 0.90:
+            text = f'Wordle {roundid} {attempts}/6*{GRID}'
+        elif kind < 0.94:
+            text = f'day {i % 50} of my streak! Wordle {roundid} {attempts}/6'
+        elif kind < 0.97:
+            text = f'Wordle  {roundid}  {attempts}/6{GRID}'
+        else:
+            text = 'good morning, no wordle for me today'
+        tweets.append({
+            'tweetId': str(1570000000000000000 + i),
+            'authorId': str(100000 + i % 50000),
+            'tweet': text
+        })
+    return tweets
+
+
+def split_parse(entries):
+    """
+    The parsing store-scores used before tweet_parser, one entry at a time
+    with the errors caught and dropped.
+    """
+    score_docs = []
+    for entry in entries:
+        try:
+            tweet = entry['tweet'].lower()
+            terms = tweet.split(' ')
+            roundid = int(terms[1])
+            attempts = terms[2].split('/')[0]
+            score = calculate_score(attempts)
+            score_docs.append({
+                u'roundid': roundid,
+                u'userid': entry['authorId'],
+                u'score': score,
+                u'attempts': int(attempts) if attempts.isdigit() else 0,
+                u'tweetid': entry['tweetId']
+            })
+        except Exception:
+            pass
+    return score_docs
+
+
+def regex_parse(entries):
+    score_docs, _ = parse_tweets(entries)
+    return score_docs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Regex tweet parser versus split based parsing.')
+    parser.add_argument('--tweets', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per parser, the best is reported')
+    args = parser.parse_args()
+
+    entries = synthetic_tweets(args.tweets)
+    print(f"{'parser':<8}{'best':>10}{'per tweet':>12}{'accepted':>11}")
+    for name, parse in [('split', split_parse), ('regex', regex_parse)]:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            accepted = len(parse(entries))
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(f"{name:<8}{best:>9.2f}s{best / len(entries) * 1e9:>10.0f}ns"
+              f"{accepted:>11}")
+
+
+if __name__ == "__main__":
+    main()
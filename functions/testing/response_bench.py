@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Payload size and encoding time of the average-scores response, per shape
+and content coding, on synthetic leaderboards.
+
+For every leaderboard size it reports the body size, the time to build the
+body once (serialize, then compress) and the time to serve it per request
+once it is cached, next to re-encoding it on every request with Flask's
+pretty-printed `jsonify`, which is how the API answered before.
+
+Brotli is only measured when its package is installed.
+
+Usage:
+    python response_bench.py [--rows 10 100 1000] [--repeat 200]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(FUNCTIONS_DIR, 'api-average-scores', 'python')
+
+
+def synthetic_response(rows):
+    return {
+        'data': [{
+            'username': f'wordler_{i}',
+            'name': f'Wordle Player {i}',
+            'profile_image_url': 'https://pbs.twimg.com/profile_images/'
+                                 f'{1500000000000000000 + i}/a1b2c3_normal.jpg',
+            'average_score': round(5.5 - i / rows, 1),
+            'max_streak': 40 - i % 40,
+            'total_score': 900 - i % 300
+        } for i in range(rows)],
+        'count': rows,
+        'next_cursor': 'WzQuNSwxMjAsMTEsInVzZXIxMjMiXQ'
+    }
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Payload bytes and encoding time of API responses.')
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10, 100, 1000], help='leaderboard sizes')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='timed runs per measurement')
+    args = parser.parse_args()
+
+    sys.path.insert(0, API_DIR)
+    import flask
+    from encoding import ENCODINGS, compress, to_columns
+    from response_cache import CacheEntry
+
+    app = flask.Flask(__name__)
+    app.json.compact = False
+
+    print(f"{'rows':>5}  {'shape':<9}{'coding':<9}{'bytes':>9}"
+          f"{'build':>11}{'cached':>11}")
+    for rows in args.rows:
+        response = synthetic_response(rows)
+        with app.app_context():
+            body, per_request = timed(
+                lambda: flask.jsonify(response).get_data(), args.repeat)
+        print(f"{rows:>5}  {'jsonify':<9}{'-':<9}{len(body):>9}"
+              f"{'-':>11}{per_request * 1e6:>9.0f}us")
+
+        for shape, data in (('rows', response),
+                            ('columnar', to_columns(response))):
+            body, serialize = timed(lambda: json.dumps(
+                data, separators=(',', ':')).encode('utf-8'), args.repeat)
+            entry = CacheEntry(body, 1, 0)
+            for encoding in [None] + ENCODINGS:
+                encoded, build = timed(
+                    lambda: compress(body, encoding) if encoding else body,
+                    args.repeat)
+                entry.encoded(encoding)
+                _, cached = timed(
+                    lambda: entry.encoded(encoding), args.repeat)
+                print(f"{rows:>5}  {shape:<9}{encoding or 'identity':<9}"
+                      f"{len(encoded):>9}"
+                      f"{(serialize + build) * 1e6:>9.0f}us"
+                      f"{cached * 1e6:>9.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures cold start and warm request latency of every function's entry
+point against the in-memory Firestore and Storage fakes.
+
+Each function runs in a fresh interpreter, which reports:
+
+    import      time to import main.py
+    first call  latency of the first invocation, which creates the clients
+                and imports the client libraries
+    warm p50    median latency of the following invocations
+
+Usage:
+    python startup_bench.py [--warm-calls N] [--tweets N] [--latency-ms MS]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTING_DIR = os.path.join(FUNCTIONS_DIR, 'testing')
+
+FUNCTIONS = [
+    'store-scores',
+    'store-usernames',
+    'api-average-scores',
+    'api-round-attempts',
+    'api-user-history',
+]
+
+# request path per API, '/' when not listed
+PATHS = {
+    'api-user-history': '/?userid=user0',
+}
+
+BUCKET = 'bench-bucket'
+
+
+def tweets_file(call, tweets):
+    return json.dumps([{
+        'tweetId': f'{call}-{i}',
+        'authorId': f'user{i}',
+        'tweet': f'Wordle {400 + call} {i % 6 + 1}/6'
+    } for i in range(tweets)])
+
+
+def users_file(call, users):
+    return json.dumps({
+        f'user{i}': {
+            'username': f'user{i}',
+            'name': f'User {i} ({call})',
+            'profile_image_url': f'https://example.com/{i}.png'
+        } for i in range(users)
+    })
+
+
+def seed_apis(db):
+    db.collection('metadata').document('rounds').set({'latest_round': 450})
+    for roundid in range(400, 451):
+        db.collection('round_stats').document(str(roundid)).set({
+            'players': 10,
+            'attempts': {'3': 4, '4': 6}
+        })
+    db.collection('leaderboards').document('average').set({
+        'data': [{
+            'username': f'user{i}', 'name': f'User {i}',
+            'profile_image_url': '', 'average_score': 5 - i / 10,
+            'max_streak': 3, 'total_score': 50
+        } for i in range(10)],
+        'count': 10,
+        'version': 1
+    })
+    db.collection('users').document('user0').set({
+        'userid': 'user0', 'rounds_played': 51, 'last_round': 450,
+        'rounds_base': 400, 'played_bits': b'\xff' * 6 + b'\x07',
+        'round_history': bytes([3, 4] * 25 + [5])
+    })
+
+
+def run_child(function, warm_calls, tweets, latency):
+    """
+    Imports and invokes one function, in this interpreter.
+    """
+    function_dir = os.path.join(FUNCTIONS_DIR, function, 'python')
+    sys.path[:0] = [function_dir, TESTING_DIR]
+    os.chdir(function_dir)
+
+    start = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - start) * 1000
+
+    # the fakes stand in for the clients; they import the client libraries
+    # on first use like the real clients do in production
+    import clients
+    fakes = {}
+
+    def new_firestore_client():
+        from fake_firestore import FakeClient
+        fakes['db'] = FakeClient(latency=latency)
+        if not function.startswith('store-'):
+            seed_apis(fakes['db'])
+        return fakes['db']
+
+    def new_storage_client():
+        from google.cloud import storage  # noqa: F401
+        return fakes['gcs']
+
+    clients._new_firestore_client = new_firestore_client
+    clients._new_storage_client = new_storage_client
+
+    if function.startswith('store-'):
+        from cloudevents.http import CloudEvent
+
+        def invoke(call):
+            name = f'file-{call}.json'
+            if 'gcs' not in fakes:
+                from fake_storage import FakeStorageClient
+                fakes['gcs'] = FakeStorageClient(latency=latency)
+            if function == 'store-scores':
+                fakes['gcs'].put(BUCKET, name, tweets_file(call, tweets))
+            else:
+                fakes['gcs'].put(BUCKET, name, users_file(call, tweets))
+            event = CloudEvent({
+                'type': 'google.cloud.storage.object.v1.finalized',
+                'source': f'//storage.googleapis.com/projects/_/buckets/'
+                          f'{BUCKET}',
+                'id': str(call)
+            }, {'bucket': BUCKET, 'name': name})
+            main.event_receiver(event)
+    else:
+        import flask
+        app = flask.Flask(function)
+
+        def invoke(call):
+            with app.test_request_context(PATHS.get(function, '/')):
+                main.http_receiver(flask.request)
+
+    latencies = []
+    devnull = open(os.devnull, 'w')
+    for call in range(warm_calls + 1):
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = time.perf_counter()
+            invoke(call)
+            latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            sys.stdout = stdout
+
+    return {
+        'function': function,
+        'import_ms': import_ms,
+        'first_call_ms': latencies[0],
+        'warm_p50_ms': statistics.median(latencies[1:] or latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cold start and warm request timings per function.')
+    parser.add_argument('--warm-calls', type=int, default=20)
+    parser.add_argument('--tweets', type=int, default=200,
+                        help='entries per ingested file')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='latency injected per fake RPC')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    latency = args.latency_ms / 1000
+
+    if args.child:
+        print(json.dumps(run_child(
+            args.child, args.warm_calls, args.tweets, latency)))
+        return
+
+    print(f"{'function':<22}{'import':>10}{'first call':>12}{'warm p50':>10}")
+    for function in FUNCTIONS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__),
+             '--child', function,
+             '--warm-calls', str(args.warm_calls),
+             '--tweets', str(args.tweets),
+             '--latency-ms', str(args.latency_ms)],
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{function:<22}"
+              f"{result['import_ms']:>8.1f}ms"
+              f"{result['first_call_ms']:>10.1f}ms"
+              f"{result['warm_p50_ms']:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares reading a tweets file whole (`json.loads(download_as_bytes())`)
+with the streaming reader used by store-scores, on synthetic files.
+
+Each run happens in a fresh interpreter and reports the peak RSS, the time
+until the first Firestore write and the total time. The synthetic files
+are written to a temporary directory and served from disk, and writes go
+to an in-memory Firestore fake that keeps nothing, so neither inflates the
+measured memory.
+
+The whole-file mode needs several times the file size in memory; skip the
+largest size on small machines.
+
+Usage:
+    python streaming_bench.py [--sizes 10 100 1000] [--dir DIR]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTING_DIR = os.path.join(FUNCTIONS_DIR, 'testing')
+STORE_SCORES_DIR = os.path.join(FUNCTIONS_DIR, 'store-scores', 'python')
+
+MODES = ['whole', 'streaming']
+
+
+def synthetic_file(directory, size_mb):
+    """
+    Writes a tweets file of about `size_mb` megabytes, once per size.
+    """
+    path = os.path.join(directory, f'tweets-{size_mb}mb.json')
+    if os.path.exists(path):
+        return path
+
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        i = 0
+        while written < target:
+            entry = json.dumps({
+                'tweetId': str(1570000000000000000 + i),
+                'authorId': str(100000 + i % 50000),
+                'tweet': f'Wordle {400 + i // 50000} {i % 6 + 1}/6\n\n'
+                         '⬛🟨⬛⬛⬛\n🟩⬛🟨⬛⬛\n🟩🟩🟩🟩🟩'
+            }, ensure_ascii=False)
+            if i:
+                f.write(',')
+            f.write(entry)
+            written += len(entry.encode('utf-8')) + 1
+            i += 1
+        f.write(']')
+    return path
+
+
+def run_child(mode, path):
+    sys.path[:0] = [STORE_SCORES_DIR, TESTING_DIR]
+
+    import main
+    from fake_firestore import FakeClient
+    from json_stream import iter_array, prefetch
+
+    class DiscardingClient(FakeClient):
+        """Counts writes like FakeClient but keeps nothing."""
+
+        first_write = None
+
+        def _commit(self, writes):
+            if self.first_write is None:
+                self.first_write = time.perf_counter()
+            self._rpc('commit')
+            self.doc_writes += len(writes)
+
+    class FileBlob:
+        def __init__(self, path):
+            self.path = path
+
+        def download_as_bytes(self):
+            with open(self.path, 'rb') as f:
+                return f.read()
+
+        def open(self, mode='rb', chunk_size=None):
+            return open(self.path, 'rb', buffering=chunk_size or -1)
+
+    db = DiscardingClient()
+    blob = FileBlob(path)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.perf_counter()
+    try:
+        if mode == 'whole':
+            main.save_scores(db, json.loads(blob.download_as_bytes()))
+        else:
+            with main.open_blob(blob) as stream:
+                main.save_scores(db, prefetch(iter_array(stream)))
+    finally:
+        sys.stdout = stdout
+    end = time.perf_counter()
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'mode': mode,
+        'peak_rss_mb': peak_kb / 1024,
+        'added_rss_mb': (peak_kb - baseline_kb) / 1024,
+        'first_write_s': db.first_write - start,
+        'total_s': end - start,
+        'writes': db.doc_writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Peak memory and time to first write, whole file versus '
+                    'streaming.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000], help='file sizes in MB')
+    parser.add_argument('--dir', help='where the synthetic files are kept')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(*args.child)))
+        return
+
+    directory = args.dir or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    print(f"{'size':>7}  {'mode':<10}{'peak rss':>11}{'added':>11}"
+          f"{'first write':>13}{'total':>10}")
+    for size_mb in args.sizes:
+        path = synthetic_file(directory, size_mb)
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__),
+                 '--child', mode, path],
+                check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{size_mb:>5}MB  {mode:<10}"
+                  f"{result['peak_rss_mb']:>9.0f}MB"
+                  f"{result['added_rss_mb']:>9.0f}MB"
+                  f"{result['first_write_s']:>12.2f}s"
+                  f"{result['total_s']:>9.2f}s")
+
+
+if __name__ == "__main__":
+    main()